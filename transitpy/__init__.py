@@ -4,8 +4,11 @@ from transitpy.datasource.PAN import PAN_Datasource as PAN_Datasource
 
 from transitpy.feed import Feed as Feed
 from transitpy.feed import is_gtfs_path as is_gtfs_path
+from transitpy.feed import normalized_feed as normalized_feed
 
 from transitpy.spatial import match_to_grid as match_to_grid
+from transitpy.spatial import match_to_grid_chunks as match_to_grid_chunks
+from transitpy.spatial import match_to_grid_parquet as match_to_grid_parquet
 from transitpy.spatial import feed_geometries as feed_geometries
 
 from transitpy.statistics import route_stats as route_stats
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+# calendar.txt day columns, in numpy weekday order (monday = 0)
+days = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+# number of services expanded to days at once
+chunk_size = 4096
+
+
+class Service_calendar(object):
+    """
+    Compact service calendar, one bit by service and day in a packed numpy matrix
+
+    attributes :
+        service_ids : Index of service_id, one by matrix row
+        start : first day, numpy datetime64[D]
+        n_days : number of days
+        bits : packed uint8 matrix of shape (services, ceil(n_days / 8))
+        date_dtype : dtype of dates in calendar_dates
+    """
+
+    def __init__(self, service_ids, start, n_days, bits=None, date_dtype="datetime64[us]"):
+
+        self.service_ids = pd.Index(service_ids)
+        self.start = np.datetime64(start, "D")
+        self.n_days = int(n_days)
+        self.date_dtype = date_dtype
+
+        if bits is None:
+            bits = np.zeros((len(self.service_ids), (self.n_days + 7) // 8), dtype=np.uint8)
+        self.bits = bits
+
+    def __len__(self):
+        return len(self.service_ids)
+
+    @classmethod
+    def from_gtfs(cls, calendar=None, calendar_dates=None):
+        """
+        build from calendar and calendar_dates DataFrames, exceptions in calendar_dates
+        are applied to calendar, services only in calendar_dates are added
+        """
+
+        dates = []
+        ids = []
+        if calendar is not None:
+            dates.extend([calendar.start_date, calendar.end_date])
+            ids.append(calendar.service_id)
+        if calendar_dates is not None:
+            dates.append(calendar_dates.date)
+            ids.append(calendar_dates.service_id)
+
+        dates = pd.concat(dates, ignore_index=True).dropna()
+        ids = pd.concat(ids, ignore_index=True).dropna().drop_duplicates()
+        if len(dates) == 0:
+            return cls(ids, "1970-01-01", 0)
+
+        n_days = _days(dates.max()) - _days(dates.min()) + 1
+        res = cls(ids, dates.min(), n_days, date_dtype=dates.dtype)
+
+        if calendar is not None:
+            res._set_calendar(calendar)
+
+        if calendar_dates is not None:
+            df = calendar_dates.loc[calendar_dates.date.notna()]
+            if "exception_type" in df.columns:
+                removed = (df.exception_type == 2).to_numpy(dtype=bool, na_value=False)
+            else:
+                removed = np.zeros(len(df), dtype=bool)
+            res._set_days(df.loc[~removed], True)
+            res._set_days(df.loc[removed], False)
+
+        return res
+
+    def _set_calendar(self, calendar):
+        """set bits of calendar rows, by weekday between start_date and end_date"""
+
+        rows = self.service_ids.get_indexer(calendar.service_id)
+        first = _days(calendar.start_date) - _days(self.start)
+        last = _days(calendar.end_date) - _days(self.start)
+        weekdays = calendar[days].fillna(0).to_numpy(dtype=bool)
+
+        offsets = np.arange(self.n_days)
+        day_weekday = (offsets + _weekday(self.start)) % 7
+
+        for i in range(0, len(calendar), chunk_size):
+            s = slice(i, i + chunk_size)
+            mask = (offsets >= first[s, None]) & (offsets <= last[s, None])
+            mask &= weekdays[s][:, day_weekday]
+            self.bits[rows[s]] |= np.packbits(mask, axis=1)
+
+        return None
+
+    def _set_days(self, df, value):
+        """set or clear bits of service_id and date rows of df"""
+
+        if len(df) == 0:
+            return None
+
+        rows = self.service_ids.get_indexer(df.service_id)
+        offsets = _days(df.date) - _days(self.start)
+        byte = offsets >> 3
+        bit = (np.uint8(128) >> (offsets & 7)).astype(np.uint8)
+
+        if value:
+            np.bitwise_or.at(self.bits, (rows, byte), bit)
+        else:
+            np.bitwise_and.at(self.bits, (rows, byte), ~bit)
+
+        return None
+
+    def matrix(self):
+        """return the unpacked boolean matrix of services by days"""
+
+        return np.unpackbits(self.bits, axis=1, count=self.n_days).astype(bool)
+
+    def dates(self):
+        """return the DatetimeIndex of matrix columns"""
+
+        return pd.DatetimeIndex(self.start + np.arange(self.n_days)).astype(self.date_dtype)
+
+    def services_on(self, dates):
+        """return the Index of service_ids with service on at least one of dates"""
+
+        offsets = _days(pd.Series(dates)) - _days(self.start)
+        offsets = offsets[(offsets >= 0) & (offsets < self.n_days)]
+
+        bit = (np.uint8(128) >> (offsets & 7)).astype(np.uint8)
+        mask = (self.bits[:, offsets >> 3] & bit) != 0
+
+        return self.service_ids[mask.any(axis=1)]
+
+    def to_calendar_dates(self, exception_type=None):
+        """
+        return a calendar_dates DataFrame of service_id, date, ordered by service and date
+        exception_type : optional dtype of an exception_type column set to 1
+        """
+
+        rows, offsets = np.nonzero(self.matrix())
+        df = pd.DataFrame(
+            {
+                "service_id": self.service_ids[rows],
+                "date": self.start + offsets.astype("timedelta64[D]"),
+            }
+        )
+        df["date"] = df["date"].astype(self.date_dtype)
+        if exception_type is not None:
+            df["exception_type"] = pd.Series(1, index=df.index, dtype=exception_type)
+
+        return df
+
+    def unique(self):
+        """
+        group services with the same days, rows of the packed bit matrix are compared
+        return a tuple of an array of group numbers by service and a Service_calendar of groups,
+        groups are ordered as sorted tuples of days
+        """
+
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64), self._subset([], [])
+
+        bits, codes = np.unique(self.bits, axis=0, return_inverse=True)
+        codes = codes.reshape(-1)
+
+        # order groups by their tuples of days, padded with -1 as a shorter tuple is first
+        rows, offsets = np.nonzero(np.unpackbits(bits, axis=1, count=self.n_days))
+        counts = np.bincount(rows, minlength=len(bits))
+        days = np.full((len(bits), max(counts.max(initial=0), 1)), -1, dtype=np.int64)
+        days[rows, np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)] = offsets
+        order = np.lexsort(days.T[::-1])
+
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+
+        res = Service_calendar(
+            np.arange(len(bits)), self.start, self.n_days, bits[order], date_dtype=self.date_dtype
+        )
+
+        return rank[codes], res
+
+    def combine(self, groups):
+        """
+        return a Service_calendar of the union of days of services by group
+
+        groups : Series of group labels, aligned on services, the index of the result
+        """
+
+        labels, uniques = pd.factorize(groups, sort=True)
+        if len(uniques) == 0:
+            return self._subset(uniques, [])
+
+        sort = np.argsort(labels, kind="stable")
+        starts = np.flatnonzero(np.r_[True, np.diff(labels[sort]) != 0])
+
+        res = self._subset(uniques, [])
+        res.bits = np.bitwise_or.reduceat(self.bits[sort], starts, axis=0)
+
+        return res
+
+    def take(self, rows, service_ids=None):
+        """
+        return a Service_calendar of rows positions, with new service_ids if not None,
+        rows at -1 have no days
+        """
+
+        if service_ids is None:
+            service_ids = self.service_ids[rows]
+
+        return self._subset(service_ids, rows)
+
+    def _subset(self, service_ids, rows):
+        """return a Service_calendar with same days and bits of rows"""
+
+        rows = np.asarray(rows, dtype=np.int64)
+        bits = self.bits[rows]
+        bits[rows < 0] = 0
+
+        return Service_calendar(
+            service_ids, self.start, self.n_days, bits, date_dtype=self.date_dtype
+        )
+
+
+def _days(dates):
+    """number of days since epoch of a date, a Series or a numpy datetime64"""
+
+    if isinstance(dates, pd.Series):
+        return dates.to_numpy().astype("datetime64[D]").astype(np.int64)
+    return np.datetime64(dates, "D").astype(np.int64)
+
+
+def _weekday(date):
+    """weekday of a numpy datetime64, monday = 0"""
+
+    # 1970-01-01 is a thursday
+    return (_days(date) + 3) % 7
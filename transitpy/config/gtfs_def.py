@@ -143,13 +143,14 @@ optional_files = {
     },
     "frequencies.txt": {
         "rid": ["trip_id"],
+        "timedelta": ["start_time", "end_time"],
         "required": {
             "trip_id": str_dtype,
             "start_time": str_dtype,
             "end_time": str_dtype,
             "headway_secs": "UInt32",
         },
-        "optional": {"exact_times": str_dtype},
+        "optional": {"exact_times": "UInt8"},
     },
     "transfers.txt": {
         "rid": ["from_stop_id", "to_stop_id"],
@@ -179,6 +180,54 @@ optional_files = {
 }
 
 
+# id columns by id type, values of an id type share the same categories
+id_columns = {
+    "stop_id": [
+        ("stops", "stop_id"),
+        ("stop_times", "stop_id"),
+        ("transfers", "from_stop_id"),
+        ("transfers", "to_stop_id"),
+    ],
+    "trip_id": [
+        ("trips", "trip_id"),
+        ("stop_times", "trip_id"),
+        ("frequencies", "trip_id"),
+    ],
+    "route_id": [
+        ("routes", "route_id"),
+        ("trips", "route_id"),
+        ("fare_rules", "route_id"),
+    ],
+    "service_id": [
+        ("trips", "service_id"),
+        ("calendar", "service_id"),
+        ("calendar_dates", "service_id"),
+    ],
+    "shape_id": [("trips", "shape_id"), ("shapes", "shape_id")],
+}
+
+
+# foreign keys checked by prune_ids, in pruning order
+# unique : primary key, values must be unique
+# others : values must be in all columns
+# optionals : values must be in unique or others
+foreign_keys = [
+    {
+        "unique": ("stops", "stop_id"),
+        "others": [("stop_times", "stop_id")],
+        "optionals": [("transfers", "from_stop_id"), ("transfers", "to_stop_id")],
+    },
+    {"unique": ("agency", "agency_id"), "others": [("routes", "agency_id")]},
+    {
+        "unique": ("routes", "route_id"),
+        "others": [("trips", "route_id")],
+        "optionals": [("fare_rules", "route_id")],
+    },
+    {"others": [("trips", "service_id"), ("calendar_dates", "service_id")]},
+    {"others": [("trips", "trip_id"), ("stop_times", "trip_id")]},
+]
+
+
 # extra files, added on feed creation
 extra_files = {"parent_stations.txt": {"uid": "parent_station", "optional": True}}
 
@@ -195,5 +244,13 @@ def gtfs_extra_files():
     return extra_files
 
 
+def gtfs_id_columns():
+    return id_columns
+
+
+def gtfs_foreign_keys():
+    return foreign_keys
+
+
 def gtfs_all_files():
     return {**{**required_files, **optional_files}, **extra_files}
\ No newline at end of file
@@ -1,30 +1,45 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
 import os
+import shutil
+import tempfile
 import zipfile
 from doctest import DocFileCase
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 from pandas.api.types import is_string_dtype
 
-from transitpy.config.gtfs_def import (gtfs_all_files, gtfs_extra_files,
-                                       gtfs_optional_files,
-                                       gtfs_required_files)
+from transitpy.calendars import Service_calendar
+from transitpy.config.gtfs_def import (gtfs_all_files, gtfs_foreign_keys,
+                                       gtfs_id_columns, gtfs_required_files)
 from transitpy.filters import Filter_functions
 from transitpy.normalize import Normalize_functions
+from transitpy.readers import GTFS_Source, read_files_arrow
 from transitpy.shapes import Shapes_functions
+from transitpy.spatial import Stop_index
+from transitpy.utils import (cached, content_hash, copy_on_write, gtfs_seconds,
+                             requires, total_seconds)
 
 
 def is_gtfs_path(path):
-    """ test if path has all necessary files for GTFS """
-    if zipfile.is_zipfile(path):
-        with zipfile.ZipFile(path, "r") as zipObj:
-            files = set([os.path.basename(x) for x in zipObj.namelist()])
-    elif os.path.isdir(path):
-        files = set(os.listdir(path))
-    else:
+    """ test if path has all necessary files for GTFS, path may be a GTFS_Source """
+
+    if isinstance(path, GTFS_Source):
+        return _is_gtfs_files(path.files)
+
+    if not zipfile.is_zipfile(path) and not os.path.isdir(path):
         return False
 
+    with GTFS_Source(path) as source:
+        return _is_gtfs_files(source.files)
+
+
+def _is_gtfs_files(files):
+    """ test if a set of file names has all necessary files for GTFS """
+
     # test files content to match GTFS specification
     required_files = set(gtfs_required_files().keys())
 
@@ -38,6 +53,75 @@ def is_gtfs_path(path):
     return True
 
 
+# columns of dropped and name columns of dropped ids by id type
+dropped_columns = ["step", "type", "id", "name"]
+dropped_names = {"stop_id": "stop_name", "route_id": "route_short_name"}
+
+# version of the parquet cache format, change to invalidate existing caches
+cache_version = 1
+
+
+def normalized_feed(path, cache_dir, year=None, crs=4326, feed_kwargs=None, **kwargs):
+    """
+    return a normalized feed, read from cache_dir if the same file was already
+    normalized with the same parameters, else normalize and store in cache_dir
+
+    Args :
+        path : GTFS zip file or directory
+        cache_dir : directory of cached feeds, one sub directory by feed
+        year, crs : see Feed
+        feed_kwargs : optional dict of other Feed parameters (engine, time_format...)
+        kwargs : normalize parameters
+
+    cache key is made of the content hash of path and of all parameters
+    """
+
+    feed_kwargs = {} if feed_kwargs is None else feed_kwargs
+    params = {
+        "version": cache_version,
+        "year": year,
+        "crs": crs,
+        "feed": feed_kwargs,
+        "normalize": kwargs,
+    }
+    params = json.dumps(params, sort_keys=True, default=str)
+
+    key = hashlib.sha256((content_hash(path) + params).encode("utf-8")).hexdigest()
+    feed_dir = os.path.join(cache_dir, key)
+
+    if os.path.exists(feed_dir):
+        return Feed.from_parquet(feed_dir)
+
+    feed = Feed(path, year=year, crs=crs, **feed_kwargs)
+    feed.normalize(**kwargs)
+
+    # write in a temporary directory, then move to make cache entry atomic
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        feed.to_parquet(tmp_dir)
+        os.replace(tmp_dir, feed_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.exists(feed_dir):
+            raise
+
+    return feed
+
+
+def _read_only(value):
+    """set numpy arrays attributes of a cached object as read only, return value"""
+
+    if isinstance(value, (pd.DataFrame, pd.Series)) or not hasattr(value, "__dict__"):
+        return value
+
+    for v in vars(value).values():
+        if isinstance(v, np.ndarray):
+            v.flags.writeable = False
+
+    return value
+
+
 class Feed(Normalize_functions, Filter_functions, Shapes_functions
 ):
     """
@@ -68,7 +152,16 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
                     and reason (step column)
     """
 
-    def __init__(self, path=None, year=None, crs=4326):
+    def __init__(
+        self,
+        path=None,
+        year=None,
+        crs=4326,
+        engine="pandas",
+        time_format="timedelta",
+        categorical_ids=False,
+        lazy=False,
+    ):
         """
         Import a gtfs zip file, folder or url in a new object with paramaters for
         each file, optionaly set to None
@@ -78,13 +171,40 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
             year : filter data to a year, if None filter to the most year with most trips
             used in normalization
             crs : optional projected crs for distance calculation
+            engine : "pandas" to read files one by one with pandas,
+                     "arrow" to parse all files concurrently with the multithreaded pyarrow reader
+            time_format : "timedelta" to store arrival_time and departure_time as timedelta64,
+                          "seconds" to store them as Int32 seconds since service day start
+            categorical_ids : if True, store ids as categoricals shared by all files, see encode_ids
+            lazy : if True, each file is parsed on first access, calendars merge, stations
+                   simplification and ids pruning are delayed to load()
         """
 
+        if engine not in ("pandas", "arrow"):
+            raise ValueError("engine must be 'pandas' or 'arrow'")
+        if time_format not in ("timedelta", "seconds"):
+            raise ValueError("time_format must be 'timedelta' or 'seconds'")
+
+        # derived data cache, see cached
+        self._versions = {}
+        self._cache = {}
+        self._cache_stats = {}
+
         # set special attributes not in GTFS definition
-        self.dropped = pd.DataFrame(columns=["step", "type", "id", "name"])
+        self.dropped = pd.DataFrame(columns=dropped_columns)
         self.projected_crs = crs
+        self.time_format = time_format
         self.name = None
 
+        # loading parameters
+        self._engine = engine
+        self._year = year
+        self._categorical_ids = categorical_ids
+        self._path = path
+        self._source = None
+        self._pending = {}
+        self._prepared = True
+
         if path is None:
             self._open_empty()
             return None
@@ -92,76 +212,216 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
         if not os.path.exists(path):
             raise ValueError("{0} doesnt exist".format(path))
 
+        # zip file is opened and indexed once for all files
+        source = GTFS_Source(path)
+
         # check path is a valid GTFS file or directory
-        if not is_gtfs_path(path):
-            raise ValueError("{0} file is not valid GTFS data".format(self.name))
-
-        # set feed name and change path if zip
-        is_zip = zipfile.is_zipfile(path)
-        if is_zip:
-            fname = os.path.splitext(os.path.basename(path))[0]
-            self.name = fname
-            path = zipfile.ZipFile(path)
+        if not is_gtfs_path(source):
+            source.close()
+            raise ValueError("{0} file is not valid GTFS data".format(path))
+
+        self.name = source.name
+
+        # files are pending until parsed, missing files are None
+        self._source = source
+        self._prepared = False
+        for file_name in gtfs_all_files().keys():
+            if file_name in source.files:
+                self._pending[file_name[:-4]] = file_name
+            else:
+                setattr(self, file_name[:-4], None)
+
+        if not lazy:
+            self.load()
+
+        return None
+
+    @property
+    def dropped(self):
+        """DataFrame of dropped ids, pending dropped ids are added on access"""
+
+        if len(self._dropped_chunks) > 0:
+            self._dropped = self._materialize_dropped()
+            self._dropped_chunks = []
+
+        return self._dropped
+
+    @dropped.setter
+    def dropped(self, df):
+        self._dropped = df
+        self._dropped_chunks = []
+
+    def __setattr__(self, name, value):
+        # count assignments of public attributes to invalidate cached data
+        if not name.startswith("_"):
+            self._modified([name])
+        super().__setattr__(name, value)
+
+    def _modified(self, names):
+        """increase the version of attributes, cached data using them is invalid"""
+
+        versions = self.__dict__.setdefault("_versions", {})
+        for name in names:
+            versions[name] = versions.get(name, 0) + 1
+
+        return None
+
+    def _cached_call(self, func, names, args, kwargs):
+        """return cached result of func if attributes in names are unchanged, else call func"""
+
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        versions = tuple((self._versions.get(n, 0), self._table_signature(n)) for n in names)
+        stats = self._cache_stats.setdefault(func.__name__, [0, 0])
+
+        if key in self._cache and self._cache[key][0] == versions:
+            stats[0] += 1
         else:
-            self.name = os.path.splitext(os.path.basename(path))[0]
-
-        # open files
-        for file_name, spec in gtfs_all_files().items():
-            df = self._open_file(path, file_name, is_zip, spec)
-         
-            # set geometries
-            if file_name == "stops.txt" and df is not None:
-                df = self._stop_geometries(df, crs=crs)
-            elif file_name == "shapes.txt" and df is not None:
-                df = self._shape_geometries(df, crs=crs)
-            
-            # store as attribute
-            setattr(self, file_name[:-4], df)
-                
-        # set default value to agency_id
-        self.default_agencyid()
-       
-        # force stop_times order
-        self.stop_times = self.stop_times.sort_values(
-            ["trip_id", "stop_sequence"], ascending=True
-        ).reset_index(drop=True)
+            stats[1] += 1
+            self._cache[key] = (versions, _read_only(func(self, *args, **kwargs)))
+
+        # callers may modify the result, return a copy
+        value = self._cache[key][1]
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            value = value.copy(deep=not copy_on_write())
+
+        return value
+
+    def _table_signature(self, name):
+        """shape and columns of a table attribute, changes if rows or columns change in place"""
+
+        value = self.__dict__.get(name)
+        if isinstance(value, pd.DataFrame):
+            return value.shape, tuple(value.columns)
+
+        return None
+
+    def cache_info(self):
+        """return a DataFrame of cache hits and misses by method"""
+
+        return pd.DataFrame.from_dict(
+            self._cache_stats, orient="index", columns=["hits", "misses"]
+        )
+
+    def clear_cache(self):
+        """drop cached data and reset counters"""
+
+        self._cache = {}
+        self._cache_stats = {}
+
+        return None
+
+    def __getattr__(self, name):
+        # only called if name is not an attribute, parse pending file
+        pending = self.__dict__.get("_pending")
+        if pending is not None and name in pending:
+            self.load_tables([name])
+            return self.__dict__[name]
+
+        raise AttributeError(
+            "'{0}' object has no attribute '{1}'".format(type(self).__name__, name)
+        )
+
+    def load_tables(self, tables):
+        """
+        parse pending files of tables, a list of attribute names (stops, trips...),
+        files already parsed are not reloaded
+        """
+
+        pending = self.__dict__.get("_pending", {})
+        files = [pending[t] for t in tables if t in pending]
+        if len(files) == 0:
+            return None
+
+        if self._engine == "arrow":
+            dfs = self._open_files_arrow(self._source, files)
+        else:
+            dfs = {f: self._open_file(self._source, f, gtfs_all_files()[f]) for f in files}
+
+        for file_name, df in dfs.items():
+            del pending[file_name[:-4]]
+            setattr(self, file_name[:-4], self._prepare_file(file_name, df))
+
+            # set default value to agency_id
+            if file_name == "agency.txt":
+                self.default_agencyid()
+
+        if len(pending) == 0:
+            self._source.close()
+            self._source = None
+
+        return None
+
+    def load(self):
+        """
+        parse all pending files and apply feed creation steps :
+        calendars merge, stations simplification and unused ids pruning
+        """
+
+        self.load_tables(list(self._pending.keys()))
+
+        if self._prepared:
+            return self
+
+        # set before steps, they may call load
+        self._prepared = True
 
         # normalize calendars
-        self.merge_calendars(year)
+        self.merge_calendars(self._year)
 
         # replace stops in stations by stations
         self.simplify_stations()
 
+        # joins between files are made on shared integer codes from here
+        if self._categorical_ids:
+            self.encode_ids()
+
         # drop unused values
         self.prune_ids(step_text="unused")
 
-        self._flat = None
+        return self
 
-        return None
+    def _prepare_file(self, file_name, df):
+        """set geometries and stop_times order of a parsed file"""
+
+        if df is None:
+            return None
+
+        # set geometries
+        if file_name == "stops.txt":
+            df = self._stop_geometries(df, crs=self.projected_crs)
+        elif file_name == "shapes.txt":
+            df = self._shape_geometries(df, crs=self.projected_crs)
+
+        # force stop_times order
+        elif file_name == "stop_times.txt":
+            df = df.sort_values(["trip_id", "stop_sequence"], ascending=True)
+            df = df.reset_index(drop=True)
+
+        return df
 
     def _open_empty(self):
         """ Fill attributes as None"""
-        self._flat = None
         for file_name in gtfs_required_files().keys():
             setattr(self, file_name[:-4], None)
         return None
 
-    def _column_dtypes(self, path, spec):
+    def _column_dtypes(self, header, spec, file=None):
+        """return a dict of column : dtype for columns of header in spec"""
 
-        header = set(pd.read_csv(path, nrows=0))
         dtypes = {k: v for k, v in spec["required"].items()}
         req_set = set(dtypes.keys())
 
         # check required columns
         if not req_set.issubset(header):
-            raise ValueError("Invalid GTFS : required columns are missing from {0}".format(path))
+            raise ValueError("Invalid GTFS : required columns are missing from {0}".format(file))
 
         if "optional" in spec:
             for k, v in spec["optional"].items():
                 if k in header:
                     dtypes[k] = v
 
-        return dtypes
+        # keep file column order
+        return {k: dtypes[k] for k in header if k in dtypes}
 
 
     def _stop_geometries(self, stops, crs=None):
@@ -201,32 +461,57 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
         return shapes
 
 
-    def _open_file(self, path, file, is_zip, spec):
-        """Open a file according to spec and add to self, return None"""
+    def _open_file(self, source, file, spec):
+        """Open a file of a GTFS_Source according to spec, return None if file is missing"""
 
-        # check if file exists, otherwise set object attribute to None and return
-        if is_zip:
-            f_list = {os.path.basename(x): x for x in path.namelist()}
-            if file in f_list:
-                f = path.open(f_list[file])
-                dtypes = self._column_dtypes(f, spec)
-                f = path.open(f_list[file])           # reopen file
-            else:
-                return None
+        # header and body are read from the same stream
+        opened = source.open_with_header(file)
+        if opened is None:
+            return None
 
-        elif os.path.exists(os.path.join(path, file)):
-            f = os.path.join(path, file)
-            dtypes = self._column_dtypes(f, spec)
-        else:
-            return None    
-       
-        df = pd.read_csv(
-            f,
-            dtype=dtypes,
-            usecols=list(dtypes.keys()),
-            encoding="utf-8",
-            dtype_backend="pyarrow"
-        )
+        header, f = opened
+        dtypes = self._column_dtypes(header, spec, file)
+
+        with f:
+            df = pd.read_csv(
+                f,
+                header=None,
+                names=header,
+                dtype=dtypes,
+                usecols=list(dtypes.keys()),
+                encoding="utf-8",
+                dtype_backend="pyarrow"
+            )
+
+        return self._format_file(df, spec)
+
+    def _open_files_arrow(self, source, files):
+        """Parse files concurrently with pyarrow, return a dict of file : DataFrame or None"""
+
+        sources = {}
+        for file in files:
+            spec = gtfs_all_files()[file]
+            opened = source.open_with_header(file)
+            if opened is None:
+                continue
+
+            header, f = opened
+            sources[file] = (f, self._column_dtypes(header, spec, file), header)
+
+        try:
+            tables = read_files_arrow(sources)
+        finally:
+            for f, _, _ in sources.values():
+                f.close()
+
+        return {
+            file: self._format_file(tables[file], gtfs_all_files()[file])
+            if file in tables else None
+            for file in files
+        }
+
+    def _format_file(self, df, spec):
+        """convert dates and timedelta, fix uid of a file read according to spec"""
 
         # convert dates
         for c in spec.get("dates", []):
@@ -238,10 +523,12 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
                 df[spec["uid"]] = df[spec["name"]].copy()
             df = df.drop_duplicates(subset=spec["uid"])
 
-        # convert timedelta columns
+        # convert time columns to seconds, then to timedelta
         if "timedelta" in spec:
             for col in spec["timedelta"]:
-                df[col] = pd.to_timedelta(df[col])
+                df[col] = gtfs_seconds(df[col])
+                if self.time_format == "timedelta":
+                    df[col] = pd.to_timedelta(df[col], unit="s").astype("timedelta64[ns]")
 
         return df
 
@@ -288,15 +575,133 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
                         os.path.join(dest_path, f), index=False, sep=csv_separator
                     )
 
-    def copy(self):
+    def to_parquet(self, path):
+        """
+        Save feed to a directory of parquet files, one by GTFS file,
+        stops and shapes as GeoParquet, dropped values and feed attributes
+        (name, projected_crs, time format) are kept
+        """
+
+        self.load()
+        os.makedirs(path, exist_ok=True)
+
+        tables = []
+        geo_tables = []
+        for f in gtfs_all_files().keys():
+            df = getattr(self, f[:-4], None)
+            if df is None:
+                continue
+
+            # categories are shared between files, store original values
+            categoricals = {
+                c: df[c].dtype.categories.dtype
+                for c in df.columns
+                if isinstance(df[c].dtype, pd.CategoricalDtype)
+            }
+            df = df.astype(categoricals)
+
+            df.to_parquet(os.path.join(path, f[:-4] + ".parquet"), index=False)
+            tables.append(f[:-4])
+            if isinstance(df, gpd.GeoDataFrame):
+                geo_tables.append(f[:-4])
+
+        # ids of different types may be mixed in dropped
+        dropped = self.dropped.astype({"id": str})
+        dropped.to_parquet(os.path.join(path, "dropped.parquet"), index=False)
+
+        meta = {
+            "name": self.name,
+            "projected_crs": self.projected_crs,
+            "time_format": self.time_format,
+            "categorical_ids": self.has_categorical_ids(),
+            "tables": tables,
+            "geo_tables": geo_tables,
+        }
+        with open(os.path.join(path, "feed.json"), "w") as f:
+            json.dump(meta, f, default=str)
+
+        return None
+
+    @classmethod
+    def from_parquet(cls, path):
+        """
+        Read a feed saved by to_parquet, files are memory mapped
+        """
+
+        with open(os.path.join(path, "feed.json")) as f:
+            meta = json.load(f)
+
+        feed = cls(
+            crs=meta["projected_crs"],
+            time_format=meta["time_format"],
+            categorical_ids=meta["categorical_ids"],
+        )
+        feed._read_parquet(path)
+
+        return feed
+
+    def _read_parquet(self, path):
+        """replace all files and attributes of self by the feed saved by to_parquet in path"""
+
+        with open(os.path.join(path, "feed.json")) as f:
+            meta = json.load(f)
+
+        # files not parsed yet are replaced
+        if self._source is not None:
+            self._source.close()
+        self._source = None
+        self._pending = {}
+        self._prepared = True
+
+        self.name = meta["name"]
+        self.projected_crs = meta["projected_crs"]
+        self.time_format = meta["time_format"]
+
+        for f in gtfs_all_files().keys():
+            t = f[:-4]
+            if t not in meta["tables"]:
+                setattr(self, t, None)
+                continue
+
+            p = os.path.join(path, t + ".parquet")
+            if t in meta["geo_tables"]:
+                setattr(self, t, gpd.read_parquet(p, memory_map=True))
+            else:
+                setattr(self, t, pd.read_parquet(p, memory_map=True))
+
+        # same object columns as dropped values added by steps
+        dropped = pd.read_parquet(os.path.join(path, "dropped.parquet"))
+        self.dropped = dropped.astype(object)
+
+        if meta["categorical_ids"]:
+            self.encode_ids()
+
+        return None
+
+    def copy(self, deep=None):
         """
         Return a copy of self
+
+        Args :
+            deep : copy DataFrame data, by default only when pandas copy on write is off,
+                   with copy on write, tables of the copy share the data of self until modified
         """
+
+        if deep is None:
+            deep = not copy_on_write()
+
+        # the copy starts with an empty cache
         newfeed = Feed()
-        for key in [k for k in vars(self).keys() if k != "self"]:
+        cache = ["_versions", "_cache", "_cache_stats"]
+        for key in [k for k in vars(self).keys() if k != "self" and k not in cache]:
             value = getattr(self, key)
             if isinstance(value, pd.DataFrame):
+                value = value.copy(deep=deep)
+            elif key in ["_pending", "_dropped_chunks"]:
                 value = value.copy()
+            elif isinstance(value, GTFS_Source):
+                # pending files of the copy are read from a new handle
+                value = GTFS_Source(value.path)
             setattr(newfeed, key, value)
 
         return newfeed
@@ -310,38 +715,175 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
     # -----------------------------------------------------------------------------
     # ids coherency
 
-    def _add_dropped(self, ids, type_text, step_text=None):
+    def _add_dropped(self, ids, type_text, step_text=None, names=None):
         """
-        add ids to dropped,
+        add ids to dropped, ids are kept in a list of chunks added to dropped
+        when it is read
 
         args :
             ids : Series of ids
             type_text : name of id (stop_id...)
             step_text : optional, calculation step name
+            names : optional Series of names of ids, same length as ids
         """
 
         if len(ids) == 0:
             return None
 
-        df = ids.to_frame("id")
-        df["type"] = type_text
+        self._dropped_chunks.append((step_text, type_text, ids, names))
+
+        return None
+
+    @staticmethod
+    def _dropped_names(df, type_text, mask):
+        """return names of rows of df in mask for dropped, None if ids have no names in df"""
+
+        name_col = dropped_names.get(type_text)
+        if name_col not in df.columns:
+            return None
+
+        return df.loc[mask, name_col]
+
+    def _materialize_dropped(self):
+        """return dropped with pending chunks"""
+
+        dfs = []
+        for step_text, type_text, ids, names in self._dropped_chunks:
+            df = pd.DataFrame(
+                {"step": step_text, "type": type_text, "id": ids.to_numpy(), "name": np.nan},
+                columns=dropped_columns,
+            )
+            if names is not None:
+                df["name"] = names.to_numpy()
+            dfs.append(df)
+
+        return pd.concat([self._dropped] + dfs, ignore_index=True, sort=False)
+
+    def _id_columns(self, id_types=None):
+        """
+        return a dict of id type : list of (file, column) existing in self,
+        restricted to id_types if not None
+        """
+
+        res = {}
+        for id_type, columns in gtfs_id_columns().items():
+            if id_types is not None and id_type not in id_types:
+                continue
+            l = [
+                (f, c)
+                for f, c in columns
+                if getattr(self, f, None) is not None and c in getattr(self, f).columns
+            ]
+            if len(l) > 0:
+                res[id_type] = l
+
+        return res
+
+    def encode_ids(self, id_types=None):
+        """
+        store id columns as categoricals, all columns of an id type (stop_id, trip_id,
+        route_id, service_id, shape_id) share the same categories so that joins between
+        files are made on integer codes, values are still read as original ids,
+        categories are the sorted used values, ids are ordered as original values
+
+        id_types : optional list of id types to encode, default to all
+        """
+
+        for id_type, columns in self._id_columns(id_types).items():
+
+            values = [getattr(self, f)[c] for f, c in columns]
+            values = [
+                v.cat.remove_unused_categories().cat.categories.to_series()
+                if isinstance(v.dtype, pd.CategoricalDtype)
+                else v.drop_duplicates()
+                for v in values
+            ]
+            categories = pd.concat(values, ignore_index=True).dropna().drop_duplicates()
+            try:
+                categories = categories.sort_values()
+            except TypeError:
+                pass
+            dtype = pd.CategoricalDtype(categories.to_numpy())
+
+            for f, c in columns:
+                setattr(self, f, getattr(self, f).astype({c: dtype}))
+
+        return None
+
+    def decode_ids(self, id_types=None):
+        """
+        convert categorical id columns back to their original values
+
+        id_types : optional list of id types to decode, default to all
+        """
+
+        for id_type, columns in self._id_columns(id_types).items():
+            for f, c in columns:
+                df = getattr(self, f)
+                if isinstance(df[c].dtype, pd.CategoricalDtype):
+                    setattr(self, f, df.astype({c: df[c].dtype.categories.dtype}))
+
+        return None
+
+    def has_categorical_ids(self, id_types=None):
+        """
+        True if id columns are encoded as shared categoricals
+
+        id_types : optional list of id types to test, default to all
+        """
+
+        return any(
+            isinstance(getattr(self, f)[c].dtype, pd.CategoricalDtype)
+            for columns in self._id_columns(id_types).values()
+            for f, c in columns
+        )
+
+    def _key_columns(self, unique=None, others=None, optionals=None):
+        """return the list of existing (file, id column) of a foreign key"""
+
+        l = [] if unique is None else [unique]
+        l = l + (others or []) + (optionals or [])
+
+        return [(f, n) for f, n in l if getattr(self, f) is not None]
+
+    def _add_codes(self, columns, codes):
+        """
+        add integer codes of id columns to codes, a dict of (file, id column) : array of
+        codes aligned on file rows, codes are shared by all columns, missing values have a code
+
+        Returns the number of codes
+        """
+
+        values = pd.concat(
+            [getattr(self, f)[n].reset_index(drop=True) for f, n in columns],
+            ignore_index=True,
+        )
+        c, uniques = pd.factorize(values, use_na_sentinel=False)
+        c = c.astype(np.int32)
+
+        start = 0
+        for f, n in columns:
+            l = getattr(self, f).shape[0]
+            codes[(f, n)] = c[start : start + l]
+            start += l
+
+        return len(uniques)
 
-        if step_text is not None:
-            df["step"] = step_text
+    def _keep_rows(self, file, mask, codes):
+        """keep rows of file in a boolean mask, and their codes"""
 
-        if type_text == "stop_id":
-            names = self.stops.loc[self.stops.stop_id.isin(ids), "stop_name"]
-            df.loc[names.index, "name"] = names
-        elif type_text == "route_id":
-            names = self.routes.loc[self.routes.route_id.isin(ids), "route_short_name"]
-            df.loc[names.index, "name"] = names
+        mask = np.asarray(mask, dtype=bool)
+        setattr(self, file, getattr(self, file).loc[mask])
 
-        df = pd.concat([self.dropped, df], ignore_index=True, sort=False)
-        self.dropped = df.reset_index(drop=True)
+        for k in codes:
+            if k[0] == file:
+                codes[k] = codes[k][mask]
 
         return None
 
-    def _prune(self, unique=None, others=None, optionals=None, step_text=None):
+    def _prune(
+        self, unique=None, others=None, optionals=None, step_text=None, n_codes=None, codes=None
+    ):
         """
         prune ids columns values, drop non unique
         id values must be in both unique and others
@@ -354,6 +896,9 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
             others : optionnal, list of tuples (file, id_name)
             optionals : optional, list of tuples (file, id_name)
             drop_text : text to comment in dropped data
+            n_codes, codes : number of codes and dict of codes of columns, see _add_codes,
+                             codes also holds stop_times sequence ids,
+                             computed if None
         """
 
         if others is None and unique is None:
@@ -361,87 +906,108 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
         if unique is not None and unique[0] == "stop_times":
             raise ValueError("stop_times cannot be unique")
 
+        if codes is None:
+            codes = {}
+        if ("stop_times", "sequence_id") not in codes and self.stop_times is not None:
+            codes[("stop_times", "sequence_id")] = self._sequence_ids().to_numpy(np.int64)
+
         # drop duplicates in unique
         if unique is not None and getattr(self, unique[0]) is not None:
 
             df = getattr(self, unique[0])
+            duplicated = df.duplicated()
 
             self._add_dropped(
-                ids=df.loc[df.duplicated(), unique[1]],
+                ids=df.loc[duplicated, unique[1]],
                 type_text=unique[1],
                 step_text="duplicated",
+                names=self._dropped_names(df, unique[1], duplicated),
             )
 
-            setattr(self, unique[0], df.loc[~df.duplicated(keep=False)])
-
-        # find minimum common set of id_names values
-        if others is not None:
-            l = [(f, n) for f, n in others if getattr(self, f) is not None]
-            ids = [set(getattr(self, f)[n].to_list()) for f, n in l]
-        else:
-            ids = []
+            self._keep_rows(unique[0], ~df.duplicated(keep=False), codes)
 
-        # add ids in unique
-        if unique is not None and getattr(self, unique[0]) is not None:
-            ids.append(set(getattr(self, unique[0])[unique[1]].to_list()))
+        if n_codes is None:
+            n_codes = self._add_codes(self._key_columns(unique, others, optionals), codes)
 
-        ids = set.intersection(*ids)
-        len_ids = len(ids)
+        # find minimum common set of id_names values, as a mask of codes
+        l = self._key_columns(unique, others)
+        ids = np.ones(n_codes, dtype=bool)
+        for f, n in l:
+            present = np.zeros(n_codes, dtype=bool)
+            present[codes[(f, n)]] = True
+            ids &= present
 
-        # drop missing ids in unique, if stop_times, drop full sequence
+        # drop missing ids in unique
 
         if unique is not None and getattr(self, unique[0]) is not None:
             df = getattr(self, unique[0])
+            mask = ids[codes[unique]]
 
-            if len_ids != len(df[unique[1]]):
-
-                mask = df[unique[1]].isin(ids)
+            if not mask.all():
 
                 self._add_dropped(
                     ids=df.loc[~mask, unique[1]],
                     type_text=unique[1],
                     step_text=step_text,
+                    names=self._dropped_names(df, unique[1], ~mask),
                 )
 
-                setattr(self, unique[0], df.loc[mask])
+                self._keep_rows(unique[0], mask, codes)
 
         # drop missing ids in others or optional, if stop_times, drop full sequence
 
-        if optionals is not None:
-            l.extend([(f, n) for f, n in optionals if getattr(self, f) is not None])
+        for f, n in self._key_columns(others=others, optionals=optionals):
+            mask = ids[codes[(f, n)]]
 
-        for f, n in l:
-            if f == "stop_times":
-                df = getattr(self, f)
-                i = df.loc[~df[n].isin(ids), "sequence_id"].drop_duplicates()
-                if len(i) != 0:
-                    setattr(self, f, df.loc[~df.sequence_id.isin(i)])
+            if mask.all():
+                continue
 
+            if f == "stop_times":
+                seq = codes[("stop_times", "sequence_id")]
+                bad = np.zeros(seq.max() + 1, dtype=bool)
+                bad[seq[~mask]] = True
+                self._keep_rows(f, ~bad[seq], codes)
             else:
-                df = getattr(self, f)
-                setattr(self, f, df.loc[df[n].isin(ids)])
+                self._keep_rows(f, mask, codes)
 
         return None
 
-    def _min_stop_times_length(self):
+    def _min_stop_times_length(self, codes=None):
         """
-        drop stop_times rows if only one stop
+        drop stop_times rows if only one stop,
+        codes : optional dict of codes, see _add_codes, may hold stop_times sequence ids
         """
-        if "sequence_id" not in self.stop_times.columns:
-            self.stop_times["sequence_id"] = self._sequence_ids()
 
-        df = self.stop_times.groupby("sequence_id")["sequence_id"].transform("count")
+        if codes is None:
+            codes = {}
+        if ("stop_times", "sequence_id") not in codes:
+            codes[("stop_times", "sequence_id")] = self._sequence_ids().to_numpy(np.int64)
+
+        seq = codes[("stop_times", "sequence_id")]
+        counts = np.bincount(seq)[seq]
 
         self._add_dropped(
-            ids=self.stop_times.loc[df == 1, "trip_id"].drop_duplicates(),
+            ids=self.stop_times.loc[counts == 1, "trip_id"].drop_duplicates(),
             type_text="trip_id",
             step_text="trips with one stop",
         )
 
-        self.stop_times = self.stop_times.loc[df > 1].copy()
+        if (counts == 1).any():
+            self._keep_rows("stop_times", counts > 1, codes)
 
         return None
 
+    @requires(
+        "stop_times",
+        "stops",
+        "transfers",
+        "agency",
+        "routes",
+        "fare_rules",
+        "trips",
+        "calendar_dates",
+        "shapes",
+    )
     def prune_ids(self, step_text=None):
         """
         prune bad ids :
@@ -449,67 +1015,75 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
             duplicated ids that should be unique
             not used stop_id, service_id or route_id
         all consecutive stops are drops in stop_times if one id is missing
+
+        ids of each foreign key (see gtfs_def) are coded as integers once,
+        a foreign key is checked again only if one of its files lost rows
         """
 
-        l = self.all_gtfs_lengths() + 1
+        # sequence ids of stop_times and integer codes of id columns by (file, column),
+        # aligned on rows of files, files are not modified in place
+        codes = {("stop_times", "sequence_id"): self._sequence_ids().to_numpy(np.int64)}
 
-        # add sequence_ids to stop_times
-        self.stop_times["sequence_id"] = self._sequence_ids()
+        keys = gtfs_foreign_keys()
+        files = [{f for f, n in self._key_columns(**k)} for k in keys]
+        n_codes = [self._add_codes(self._key_columns(**k), codes) for k in keys]
 
-        while l > self.all_gtfs_lengths():
+        def lengths():
+            return {
+                f[:-4]: getattr(self, f[:-4]).shape[0]
+                for f in gtfs_all_files().keys()
+                if getattr(self, f[:-4]) is not None
+            }
 
-            l = self.all_gtfs_lengths()
+        # files changed since the last check of each key, all files at start
+        changed = set(lengths().keys())
+        checked = {i: set(changed) for i in range(len(keys))}
 
-            # stop_times must have at least 2 stops in a sequence
-            self._min_stop_times_length()
+        while len(changed) > 0:
 
-            # prune each id
+            before = lengths()
 
-            self._prune(
-                unique=("stops", "stop_id"),
-                others=[("stop_times", "stop_id")],
-                optionals=[("transfers", "from_stop_id"), ("transfers", "to_stop_id")],
-                step_text=step_text,
-            )
+            # stop_times must have at least 2 stops in a sequence
+            if "stop_times" in changed:
+                l = self.stop_times.shape[0]
+                self._min_stop_times_length(codes)
+                if self.stop_times.shape[0] != l:
+                    for i in checked:
+                        checked[i].add("stop_times")
 
-            self._prune(
-                unique=("agency", "agency_id"),
-                others=[("routes", "agency_id")],
-                step_text=step_text,
-            )
+            # prune each id
+            for i, k in enumerate(keys):
 
-            self._prune(
-                unique=("routes", "route_id"),
-                others=[("trips", "route_id")],
-                optionals=[("fare_rules", "route_id")],
-                step_text=step_text,
-            )
+                if len(checked[i] & files[i]) == 0:
+                    continue
 
-            self._prune(
-                others=[("trips", "service_id"), ("calendar_dates", "service_id")],
-                step_text=step_text,
-            )
+                l = lengths()
+                self._prune(
+                    unique=k.get("unique"),
+                    others=k.get("others"),
+                    optionals=k.get("optionals"),
+                    step_text=step_text,
+                    n_codes=n_codes[i],
+                    codes=codes,
+                )
+                checked[i] = set()
 
-            self._prune(
-                others=[("trips", "trip_id"), ("stop_times", "trip_id")],
-                step_text=step_text,
-            )
+                diff = {f for f, n in lengths().items() if n != l[f]}
+                for j in checked:
+                    checked[j] |= diff
 
-        # drop sequence_ids from stop_times
-        self.stop_times = self.stop_times.drop(columns=["sequence_id"])
+            changed = {f for f, n in lengths().items() if n != before[f]}
 
         # prune shape_ids
         if self.shapes is not None:
             self.shapes = self.shapes.loc[self.shapes.shape_id.isin(self.trips.shape_id.drop_duplicates())]
 
-        # invalidate flat cache
-        self._flat = None
-
         return None
 
     # -------------------------------------------------------------------------
     # minimal normalization of dataframes
     
+    @requires("agency")
     def default_agencyid(self):
         """add an agency_id and drop duplicates if missing column"""
 
@@ -519,6 +1093,7 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
         self.agency["agency_id"] = self.agency["agency_name"].copy()
         return None
 
+    @requires("calendar", "calendar_dates", "trips")
     def merge_calendars(self, year):
         """Calendar data is unified in calendar_dates"""
         
@@ -530,42 +1105,14 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
             self.calendar = None
             return None
 
-        days = [
-            "monday",
-            "tuesday",
-            "wednesday",
-            "thursday",
-            "friday",
-            "saturday",
-            "sunday",
-        ]
-
-        df = self.calendar.copy()
-       
-        df["repeats"] = df["end_date"] - df["start_date"]
-        df["repeats"] = df["repeats"].dt.days + 1
-
-        df = df.reindex(index=df.index.repeat(df["repeats"]))
-        service_count = df.groupby("service_id").cumcount()
-        service_count = pd.to_timedelta(service_count, unit='day')
-        df["date"] = df["start_date"] + service_count
-        df["day"] = df["date"].dt.day_name().str.lower()
-
-        # keep only if value is 1
-        for d in days:
-            df = df.loc[(df.day != d) | (df[d] == 1)]
+        # expand calendar and apply exceptions as a service by day bit matrix
+        calendar = Service_calendar.from_gtfs(self.calendar, self.calendar_dates)
 
-        df = df[["service_id", "date"]].copy()
-
-        # merge calendar_dates
+        exception_type = None
         if self.calendar_dates is not None:
-            df = pd.merge(
-                df, self.calendar_dates, on=["service_id", "date"], how="outer"
-            )
-            df['exception_type'] = df['exception_type'].fillna(1)
-            df = df.loc[df.exception_type != 2]
+            exception_type = self.calendar_dates.exception_type.dtype
 
-        self.calendar_dates = df.copy()
+        self.calendar_dates = calendar.to_calendar_dates(exception_type=exception_type)
         self.calendar = None
 
         # max duration to one_year
@@ -597,6 +1144,7 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
 
         return None
 
+    @requires("stops", "stop_times", "transfers")
     def simplify_stations(self):
         """Replace stops in stations by station, drop entrances, generic nodes and boarding areas"""
 
@@ -640,6 +1188,7 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
     # -------------------------------------------------------------------------
     # cross-dataframe data
 
+    @cached("stops", "stop_times")
     def stops_as_stoptimes(self):
         """
         return a dataframe aligned to stoptimes with stop content
@@ -652,6 +1201,7 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
 
         return df
 
+    @cached("routes", "trips")
     def routes_as_trips(self):
         """
         return routes data aligned on trips
@@ -668,6 +1218,19 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
 
         return df
 
+    @cached(
+        "agency",
+        "routes",
+        "trips",
+        "stop_times",
+        "stops",
+        "calendar",
+        "calendar_dates",
+        "shapes",
+        "transfers",
+        "fare_rules",
+        "projected_crs",
+    )
     def flat(self):
         """
         returns and cache a flat representation of all services in a week
@@ -687,9 +1250,7 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
             - geometry in projected coordinates
         """
 
-        # return cached flat dataframe
-        if self._flat is not None:
-            return self._flat
+        self.load()
 
         # limit to one week
         if len(self.valid_weeks()) > 0:
@@ -749,28 +1310,41 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
         df["spacing"] = df["spacing"].astype(int)
 
         # first and last stop_sequence
-        df["first_seq"] = df.groupby(["trip_id"])["stop_sequence"].transform("min")
-        df["last_seq"] = df.groupby(["trip_id"])["stop_sequence"].transform("max")
+        df["first_seq"] = df.groupby(["trip_id"], observed=True)["stop_sequence"].transform("min")
+        df["last_seq"] = df.groupby(["trip_id"], observed=True)["stop_sequence"].transform("max")
 
         # time from first stop in trip
         start = df[["trip_id", "departure_time"]].drop_duplicates("trip_id")
         start = start.rename(columns={"departure_time": "time"})
         df = pd.merge(df, start, on="trip_id", how="left")
         df["time"] = df["arrival_time"] - df["time"]
-        df["time"] = df["time"].dt.total_seconds()
+        df["time"] = total_seconds(df["time"])
 
         df = df.set_geometry("geometry", crs=self.projected_crs)
 
         df["day"] = df["date"].dt.dayofweek
 
-        # put in cache
-        self._flat = df
-
         return df
 
     # --------------------------------------------------------------
     # utilities
     
+    @cached("stops", "projected_crs")
+    def stop_index(self):
+        """
+        return the spatial index of stops in projected_crs, see spatial.Stop_index,
+        built once until stops are modified
+        """
+
+        return Stop_index.from_stops(self.stops)
+
+    @cached("calendar", "calendar_dates")
+    def service_calendar(self):
+        """return calendar and calendar_dates as a Service_calendar, one bit by service and day"""
+
+        return Service_calendar.from_gtfs(self.calendar, self.calendar_dates)
+
+    @cached("calendar", "calendar_dates", "trips")
     def trips_by_date(self):
         """
         returns a DataFrame with service_id and pd.datetime.date of one day as value
@@ -784,21 +1358,52 @@ class Feed(Normalize_functions, Filter_functions, Shapes_functions
             del df["exception_type"]
         
         trips = self.trips.drop_duplicates(["trip_id", "service_id"])
-        trips = trips.groupby(["service_id"]).size().to_frame("trips")
+        trips = trips.groupby(["service_id"], observed=True).size().to_frame("trips")
         df = pd.merge(df, trips, on=["service_id"], how="left")
 
         return df.drop_duplicates(subset=["service_id", "date"]).reset_index(drop=True)
     
-    def valid_weeks(self):
-        """return a list (week, year) with service"""
+    @cached("calendar", "calendar_dates", "trips")
+    def service_days(self):
+        """
+        returns a DataFrame indexed by the dates with service, with columns :
+            - trips : number of trips
+            - services : number of service_ids
+            - year : calendar year
+            - week : ISO week number
+            - weekday : day number starting as monday = 0
+        service_ids of a date are found with service_calendar().services_on
+        """
+        if self.calendar is not None:
+            raise ValueError("unified calendars needs feed nomalization")
+
+        calendar = self.service_calendar()
+
+        trips = self.trips.drop_duplicates(["trip_id", "service_id"])
+        trips = trips.groupby(["service_id"], observed=True).size()
+        trips = trips.reindex(calendar.service_ids, fill_value=0).to_numpy()
 
-        df = self.trips_by_date()
-        df["week"] = df.date.dt.isocalendar().week
-        df["year"] = df.date.dt.year
-        df = df.groupby(["year", "week"])["trips"].sum()
+        matrix = calendar.matrix()
+        active = matrix.any(axis=0)
+        matrix = matrix[:, active]
+        dates = calendar.dates()[active]
+
+        df = pd.DataFrame(
+            {"trips": trips @ matrix, "services": matrix.sum(axis=0)},
+            index=dates.rename("date"),
+        )
+        df["year"] = dates.year
+        df["week"] = dates.isocalendar().week.array
+        df["weekday"] = dates.weekday
 
         return df
 
+    @cached("calendar", "calendar_dates", "trips")
+    def valid_weeks(self):
+        """return a list (week, year) with service"""
+
+        return self.service_days().groupby(["year", "week"])["trips"].sum()
+
     def all_gtfs_lengths(self):
         return sum(
             [
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 import pandas as pd
-
-from transitpy.spatial import pt_in_bounds
+import shapely as sh
+from scipy import sparse
 
 
 class Filter_functions(object):
@@ -22,6 +23,7 @@ class Filter_functions(object):
             modes : a mode number or list of mode numbers, see gtfs specification for details
         """
 
+        self.load()
         fd = self.copy()
 
         if type(modes) is not list:
@@ -36,50 +38,116 @@ class Filter_functions(object):
 
     def spatial_filter(self, limits):
         """
-        filter stops by coordinates or polygon
+        filter to trips with at least 2 stops in limits
+
         limits : tuple of mininimum longitude, minimum latitude,
-        maximum longitude, maximum latitude or GeoSeries
+        maximum longitude, maximum latitude or GeoSeries of polygons,
+        a stop is in limits if it is in one of the polygons
         """
 
-        fd = self.copy()
+        self.load()
 
         if limits is None:
             return None
 
+        labels, in_limits = self._stops_in_limits(limits)
+        in_limits = sparse.csr_matrix(in_limits.max(axis=0))
+        trip_ids = self._trips_in_limits(in_limits)[0]
+
+        fd = self.copy()
+        fd.trips = fd.trips.loc[fd.trips.trip_id.isin(trip_ids)]
+        fd.prune_ids(step_text="spatial filter")
+
+        return fd
+
+    def spatial_split(self, limits):
+        """
+        filter to trips with at least 2 stops in each polygon of limits, stops are
+        matched to all polygons at once
+
+        limits : GeoSeries or GeoDataFrame of polygons
+
+        yield tuples of limits index value and filtered feed
+        """
+
+        self.load()
+
+        labels, in_limits = self._stops_in_limits(limits)
+        trips = self._trips_in_limits(in_limits)
+
+        for label, trip_ids in zip(labels, trips):
+            fd = self.copy()
+            fd.trips = fd.trips.loc[fd.trips.trip_id.isin(trip_ids)]
+            fd.prune_ids(step_text="spatial filter")
+            yield label, fd
+
+    def _stops_in_limits(self, limits):
+        """
+        return a tuple of limits labels and a sparse boolean matrix of limits by stops
+        of the stop index, polygons are prepared and queried in the stop STRtree
+        """
+
+        index = self.stop_index()
+
         if type(limits) is tuple:
-            bounds = limits
+            xmin, ymin, xmax, ymax = limits
+            stops = self.stops.set_index("stop_id").reindex(index.stop_ids)
+            inside = stops.stop_lon.between(xmin, xmax) & stops.stop_lat.between(ymin, ymax)
+            stop_pos = np.flatnonzero(inside.to_numpy(dtype=bool, na_value=False))
+            limit_pos = np.zeros(len(stop_pos), dtype=np.int64)
+            labels = pd.RangeIndex(1)
+
         else:
             try:
-                l = limits.geom_type.drop_duplicates().to_list()
-                if "Polygon" in l or "MultiPolygon" in l:
-                    bounds = limits.total_bounds
-            except:
+                is_polygon = limits.geom_type.isin(["Polygon", "MultiPolygon"]).all()
+            except AttributeError:
+                is_polygon = False
+            if not is_polygon:
                 raise ValueError(
-                    "Limit but be either a tuple of coordinates or a shapely polygon"
+                    "Limit but be either a tuple of coordinates or a GeoSeries of polygons"
                 )
 
-        # copy coordinates in stop_times
-        df = fd.stops_as_stoptimes()[["stop_lon", "stop_lat", "geometry"]]
+            geoms = limits.geometry
+            if geoms.crs is not None and index.crs is not None:
+                geoms = geoms.to_crs(index.crs)
+            geoms = np.asarray(geoms.array)
+            sh.prepare(geoms)
 
-        # find stop_ids in limits
-        df = pt_in_bounds(df, bounds)
-        df = df[["trip_id", "stop_sequence"]]
+            limit_pos, stop_pos = index.query(geoms, predicate="intersects")
+            labels = limits.index
 
-        # count stops and valid stops
-        df = df.groupby("trip_id").agg(
-            trip_id=("trip_id", "first"),
-            stops=("stop_sequence", "count"),
+        in_limits = sparse.csr_matrix(
+            (np.ones(len(stop_pos), dtype=bool), (limit_pos, stop_pos)),
+            shape=(len(labels), len(index)),
         )
 
-        df = df.loc[df.stops >= 2]["trip_id"].drop_duplicates()
+        return labels, in_limits
 
-        # find corresponding route_ids
-        rids = fd.trips.loc[~fd.trips.trip_id.isin(df), "route_id"].drop_duplicates()
-        fd.routes = fd.routes.loc[fd.routes.route_id.isin(rids)]
+    def _trips_in_limits(self, in_limits):
+        """
+        return a list of arrays of trip_ids with at least 2 stop_times in limits,
+        one by row of in_limits, a sparse boolean matrix of limits by stops
+        """
 
-        fd.prune_ids(step_text="spatial filter")
+        runs = self.stop_sequences()
+        stops = self.stop_index().positions(self.stop_times.stop_id)
+        trips = runs.trip_broadcast(np.arange(len(runs.trip_starts)))
+        valid = stops >= 0
 
-        return fd
+        # number of stop_times rows by stop and trip
+        stop_trips = sparse.csr_matrix(
+            (np.ones(valid.sum(), dtype=np.int64), (stops[valid], trips[valid])),
+            shape=(in_limits.shape[1], len(runs.trip_starts)),
+        )
+        counts = (in_limits.astype(np.int64) @ stop_trips).tocsr()
+
+        trip_ids = self.stop_times.trip_id.to_numpy()[runs.trip_starts]
+        res = []
+        for i in range(counts.shape[0]):
+            row = counts.getrow(i)
+            res.append(trip_ids[row.indices[row.data >= 2]])
+
+        return res
 
     # --------------------------------------------------------------
     # Temporal filtering functions
@@ -93,6 +161,7 @@ class Filter_functions(object):
             if week = None or week not in feed, filter to week with most trips
         """
 
+        self.load()
         if self.calendar is not None:
             raise ValueError("week_filter needs feed nomalization")
 
@@ -110,12 +179,9 @@ class Filter_functions(object):
         else:
             w, y = week
 
-        fd.calendar_dates = fd.calendar_dates.loc[
-            (fd.calendar_dates.date.dt.isocalendar().week == w)
-            & (fd.calendar_dates.date.dt.year == y)
-        ]
-
-        sids = fd.calendar_dates.service_id.drop_duplicates()
+        days = fd.service_days()
+        dates = days.index[(days.week == w) & (days.year == y)]
+        fd.calendar_dates = fd.calendar_dates.loc[fd.calendar_dates.date.isin(dates)]
 
         fd.prune_ids(step_text="week filter")
 
@@ -129,22 +195,20 @@ class Filter_functions(object):
             day:day number starting as monday = 0
         """
 
+        self.load()
         fd = self.copy()
 
-        # days of each calendar_dates
-        df = fd.trips_by_date()
+        # days with service
+        df = fd.service_days()
 
-        # filter to specific day, capitalize to match string format
-        df = df.loc[df.date.dt.weekday == day]
+        # filter to specific day
+        df = df.loc[df.weekday == day]
         if df.shape[0] == 0:
             raise ValueError("No day in feed")
 
-        # keep most used day
-        daydate = df.groupby("date")["trips"].sum().sort_index(ascending=False)
-        daydate = daydate.head(1).index.values[0]
-
-        df = df.loc[df.date == daydate]
-        sids = df.service_id.drop_duplicates()
+        # keep last day
+        daydate = df.index.max()
+        sids = fd.service_calendar().services_on([daydate])
 
         fd.calendar_dates = fd.calendar_dates.loc[
             fd.calendar_dates.service_id.isin(sids)
@@ -161,23 +225,21 @@ class Filter_functions(object):
         if year is None, keep the year with most trips, else year must be an integer
         """
 
+        self.load()
         if self.calendar is not None:
             raise ValueError("year_filter needs feed nomalization")
 
         fd = self.copy()
-        df = self.calendar_dates.copy()
+        days = self.service_days()
 
-        trips = self.trips.drop_duplicates(["trip_id", "service_id"])
-        trips = trips.groupby(["service_id"]).size().to_frame("trips")
-        df = pd.merge(df, trips, on=["service_id"], how="left")
+        y = days.groupby("year")["trips"].sum()
 
-        y = df.groupby(by=df["date"].dt.year)["trips"].sum()
-        
         if year is None:
             y = y.sort_values().index.values[-1]
         else:
             y = year
-            
-        fd.calendar_dates = df.loc[df.date.dt.year == y].drop(columns=["trips"])
+
+        dates = days.index[days.year == y]
+        fd.calendar_dates = fd.calendar_dates.loc[fd.calendar_dates.date.isin(dates)]
 
         return fd
@@ -1,13 +1,82 @@
 # -*- coding: utf-8 -*-
 
-from operator import itemgetter
+import json
+import os
+import shutil
+import tempfile
 
 import numpy as np
 import pandas as pd
 from pandas.api.types import is_numeric_dtype
+from scipy import sparse
+from scipy.sparse import csgraph
 
 from . import spatial, utils
 from .config import defaults
+from .sequences import Stop_sequences
+
+
+# normalization stages, in order : (stage name, function(feed, params), check(feed, params) or None)
+# params are the normalize arguments, a stage is skipped when its check returns True
+normalize_stages = [
+    # defaults and data cleaning
+    # single agency for each folder, optionaly replace agency name
+    ("simple_agency", lambda f, p: f.simple_agency(agency_name=p["agency_name"]), None),
+    (
+        "set_defaults",
+        lambda f, p: f.set_defaults(),
+        lambda f, p: all(f.has_defaults().values()),
+    ),
+    (
+        "unique_route_names",
+        lambda f, p: f.unique_route_names(route_name_length=p["route_name_length"]),
+        None,
+    ),
+    # normalize stops
+    # some feeds mix stop_code and stop_id
+    ("fix_invalid_stopids", lambda f, p: f.fix_invalid_stopids(), None),
+    # correct bad coordinates and duplicated stop_names
+    ("drop_bad_coordinates", lambda f, p: f.drop_bad_coordinates(), None),
+    # decrease spatial precision
+    (
+        "compress_coordinates",
+        lambda f, p: f.compress_coordinates(decimals=p["coordinates"]),
+        lambda f, p: p["coordinates"] is None,
+    ),
+    # normalize trips
+    # unique route_id for each trip_id / service_id
+    (
+        "simplify_routes_on_tripids",
+        lambda f, p: f.simplify_routes_on_tripids(),
+        lambda f, p: f.has_simple_tripids(),
+    ),
+    # check max arrival_time larger than min departure_time
+    ("drop_non_increasing_stoptimes", lambda f, p: f.drop_non_increasing_stoptimes(), None),
+    (
+        "normalize_trips",
+        lambda f, p: f.normalize_trips(),
+        lambda f, p: f.has_normalized_tripids(),
+    ),
+    # fill missing arrival and departure times
+    ("fill_times", lambda f, p: f.fill_times(), lambda f, p: f.has_filled_times()),
+    # normalize shapes and add basic shapes from stop to stop
+    ("simple_shapes", lambda f, p: f.simple_shapes(p["overwrite_shapes"]), None),
+    # group routes
+    (
+        "set_groupid",
+        lambda f, p: f.set_groupid(
+            distance=p["group_distance"],
+            share=p["group_share"],
+            nb_share=p["nb_share"],
+            day=p["default_day"],
+        ),
+        None,
+    ),
+    ("prune_ids", lambda f, p: f.prune_ids(step_text="final cleaning"), None),
+]
+
+# file of the last completed stage in a checkpoint directory
+checkpoint_file = "normalize.json"
 
 
 class Normalize_functions(object):
@@ -27,9 +96,13 @@ class Normalize_functions(object):
         one_year=True,
         overwrite_shapes=False,
         coordinates=6,
+        profile=False,
+        callback=None,
+        checkpoint_dir=None,
+        resume=False,
     ):
         """
-        apply normalization steps and clean un-needed ids
+        apply normalization stages and clean un-needed ids, see normalize_stages
         
         Args :
             - one_year : boolean to filter to only one year
@@ -41,73 +114,94 @@ class Normalize_functions(object):
             - nb_share : minimum nb of common stops
             - default_day : day used for calculation
             - coordinates : number of decimals for longitude and latitude or None
+            - profile : if True, return a DataFrame of time, peak memory and rows
+                        of each step, see utils.Step_profiler
+            - callback : optional function called with the profile record of each step
+            - checkpoint_dir : optional directory dedicated to checkpoints, the feed is
+                               saved as parquet files after each stage and removed
+                               when all stages are completed
+            - resume : if True and checkpoint_dir has a checkpoint of the same source feed
+                       with the same parameters, restart after its last completed stage
         """
 
-        # ----------------------------
-        # defaults and data cleaning
-
-        # single agency for each folder, optionaly replace agency name
-        self.simple_agency(agency_name=agency_name)
-
-        # defaults
-        if not all([v for k, v in self.has_defaults().items()]):
-            self.set_defaults()
-
-        # modify route_names
-        self.unique_route_names(route_name_length=route_name_length)
-
-        # ----------------------------
-        # normalize stops
-
-        # some feeds mix stop_code and stop_id
-        self.fix_invalid_stopids()
+        params = {
+            "agency_name": agency_name,
+            "route_name_length": route_name_length,
+            "group_distance": group_distance,
+            "group_share": group_share,
+            "nb_share": nb_share,
+            "default_day": default_day,
+            "overwrite_shapes": overwrite_shapes,
+            "coordinates": coordinates,
+        }
+
+        if not profile and callback is None:
+            return self._run_stages(
+                lambda step, func, *args, **kwargs: func(*args, **kwargs),
+                params,
+                checkpoint_dir,
+                resume,
+            )
 
-        # correct bad coordinates and duplicated stop_names
-        self.drop_bad_coordinates()
+        with utils.Step_profiler(self, callback=callback) as profiler:
+            self._run_stages(profiler.run, params, checkpoint_dir, resume)
 
-        # decrease spatial precision
-        if coordinates is not None:
-            self.compress_coordinates(decimals=coordinates)
+        if profile:
+            return profiler.to_frame()
 
-        # -----------------------------
-        # normalize trips
+        return None
 
-        # unique route_id for each trip_id / service_id
-        if not self.has_simple_tripids():
-            self.simplify_routes_on_tripids()
+    def _run_stages(self, run, params, checkpoint_dir, resume):
+        """
+        run normalize_stages with run(step name, function, *args, **kwargs),
+        from the last completed stage in checkpoint_dir if resume
+        """
 
-        # check max arrival_time larger than min departure_time
-        self.drop_non_increasing_stoptimes()
+        state = None
+        if checkpoint_dir is not None:
+            # checkpoints are keyed on the source feed content
+            if self._path is None:
+                raise ValueError("checkpoint_dir needs a feed read from a file or directory")
+            params = dict(params, source=utils.content_hash(self._path))
+
+        if checkpoint_dir is not None and resume:
+            state = _read_checkpoint(checkpoint_dir, params)
+
+        if state is not None:
+            run("resume", self._read_parquet, os.path.join(checkpoint_dir, state["feed"]))
+            categorical_ids = state["categorical_ids"]
+            names = [s[0] for s in normalize_stages]
+            stages = normalize_stages[names.index(state["stage"]) + 1 :]
+        else:
+            # parse pending files of a lazy feed
+            run("load", self.load)
 
-        # unique trip_ids
-        if not self.has_normalized_tripids():
-            self.normalize_trips()
+            # encoded ids stay encoded, stages rewriting ids decode them, see utils.raw_ids
+            categorical_ids = self.has_categorical_ids()
+            stages = normalize_stages
 
-        # fill missing arrival and departure times
-        if not self.has_filled_times():
-            self.fill_times()
+        for stage, func, check in stages:
+            if check is not None and check(self, params):
+                continue
 
-        # ----------------------------
-        # normalize shapes and add basic shapes from stop to stop
-        self.simple_shapes(overwrite_shapes)
+            run(stage, func, self, params)
 
-        # ----------------------------
-        # group routes
+            if checkpoint_dir is not None:
+                _write_checkpoint(self, checkpoint_dir, stage, params, categorical_ids)
 
-        self.set_groupid(
-            distance=group_distance,
-            share=group_share,
-            nb_share=nb_share,
-            day=default_day,
-        )
+        if checkpoint_dir is not None:
+            _remove_checkpoint(checkpoint_dir)
 
-        self.prune_ids(step_text="final cleaning")
+        # encode id columns added by stages
+        if categorical_ids:
+            run("encode_ids", self.encode_ids)
 
         return None
 
     # --------------------------------------------------------------------------
     # normalisation functions
 
+    @utils.requires("trips", "routes")
     def simplify_routes_on_tripids(self):
         """
         drop all routes if at least one trip_id is duplicated,
@@ -152,6 +246,7 @@ class Normalize_functions(object):
 
         return rids
 
+    @utils.requires("routes", "trips", "fare_rules")
     def unique_route_names(self, route_name_length=None):
         """
         if non unique route_short_name and no na in route_long_name,
@@ -221,34 +316,44 @@ class Normalize_functions(object):
 
         return None
 
+    @utils.requires("stop_times")
     def drop_non_increasing_stoptimes(self, exclude_last_stop=True):
         """
         drop trips where max arrival_time == min departure_time,
         exclude_last_stop : boolean, dont take into account last stop
         """
 
-        df = self.stop_times.copy()
+        st = self.stop_times
+        if st.shape[0] == 0:
+            return None
 
-        if exclude_last_stop:
-            df["max_seq"] = df.groupby("trip_id")["stop_sequence"].transform("max")
-            df["stops"] = df.groupby("trip_id")["stop_sequence"].transform("count")
-            df = df.loc[(df.stops <= 5) | (df.stop_sequence != df.max_seq)]
+        runs = self.stop_sequences()
 
-        df = df.groupby("trip_id").agg(
-            min_dep=("departure_time", "min"), max_arr=("arrival_time", "max")
-        )
+        dep = utils.total_seconds(st.departure_time).to_numpy(dtype=float, na_value=np.nan)
+        arr = utils.total_seconds(st.arrival_time).to_numpy(dtype=float, na_value=np.nan)
+
+        if exclude_last_stop:
+            seq = st.stop_sequence.to_numpy(dtype=float, na_value=np.nan)
+            max_seq = runs.trip_broadcast(runs.trip_reduce(np.fmax, seq))
+            stops = runs.trip_broadcast(runs.trip_reduce(np.add, ~np.isnan(seq)))
+            kept = (stops <= 5) | (seq != max_seq)
+            dep = np.where(kept, dep, np.nan)
+            arr = np.where(kept, arr, np.nan)
 
-        if df.shape[0] > 0:
-            df = df.loc[df.min_dep == df.max_arr].reset_index()
+        # nan if no time in trip, never equal
+        min_dep = runs.trip_reduce(np.fmin, dep)
+        max_arr = runs.trip_reduce(np.fmax, arr)
+        bad = runs.trip_broadcast(min_dep == max_arr)
 
-            self.stop_times = self.stop_times.loc[
-                ~self.stop_times.trip_id.isin(df.trip_id)
-            ]
+        if bad.any():
+            self.stop_times = st.loc[~st.trip_id.isin(st.trip_id[bad])]
 
-            self.prune_ids(step_text="routes with non increasing stop_times")
+        self.prune_ids(step_text="routes with non increasing stop_times")
 
         return None
 
+    @utils.requires("trips", "stop_times", "frequencies", "calendar_dates")
+    @utils.raw_ids("trip_id", "service_id")
     def normalize_trips(self):
         """
         this step must be done after expanding calendars
@@ -257,15 +362,13 @@ class Normalize_functions(object):
             - no duplicated unique trip_id in trips and one trip_id for each consecutive
               list of stop_sequence in stop_times
             - regroup all service_ids for one trip_ids to one service_ids, then group identical service_ids
-            - convert frequencies to new stop_times (TODO)
+            - convert frequencies to new trips and stop_times
             - trip_id are re-build as integers
             - duplicate and regroup service_ids in calendar_dates, service_ids are re-build as integers
         """
 
         # expand frequencies.txt
         if self.frequencies is not None:
-            raise ValueError("Implement frequencies expansion")
-        else:
             self.expand_frequencies()
 
         # renumber stop_times on continuous sequence_id
@@ -303,56 +406,137 @@ class Normalize_functions(object):
         services_ids are integer
         """
 
-        # difference with smallest day, for faster calendar comparison
-        df = self.calendar_dates
-        df["diff"] = (df.date - df.date.min()).dt.days
+        calendar = self.service_calendar()
 
-        # duplicate calendar_dates if multiple service_ids for one trip_id
-        cals = pd.merge(
-            self.trips[["trip_id", "service_id"]], df, on="service_id", how="outer"
-        )
+        # days of each trip, union of days of its service_ids
+        trips = self.trips[["trip_id", "service_id"]]
+        rows = calendar.service_ids.get_indexer(trips.service_id)
+        calendar = calendar.take(rows, service_ids=trips.index).combine(trips.trip_id)
 
-        # group service_id with same list of date differences ints
-        cals = cals.sort_values(["trip_id", "diff"])
-        cals = pd.merge(
-            cals,
-            cals.groupby("trip_id").agg(days=("diff", tuple)),
-            left_on="trip_id",
-            right_index=True,
-        )
-        cals["new_servid"] = cals.groupby("days").ngroup()
+        # group trips with same days, service_ids are numbered in days order
+        codes, services = calendar.unique()
+        mapper = pd.Series(codes, index=calendar.service_ids)
 
         # copy back new service_id values in calendar_dates
-        self.calendar_dates = cals[
-            ["new_servid", "date", "exception_type"]
-        ].drop_duplicates(["date", "new_servid"])
-        self.calendar_dates = self.calendar_dates.rename(
-            columns={"new_servid": "service_id"}
+        self.calendar_dates = services.to_calendar_dates(
+            exception_type=self.calendar_dates.exception_type.dtype
         )
 
         # copy back new service_id values in trips
-        self.trips = pd.merge(
-            self.trips,
-            cals[["trip_id", "service_id", "new_servid"]],
-            on=["trip_id", "service_id"],
-            how="left",
-        )
-        self.trips = self.trips.drop(columns="service_id").rename(
-            columns={"new_servid": "service_id"}
-        )
+        self.trips = self.trips.drop(columns="service_id").reset_index(drop=True)
+        self.trips["service_id"] = self.trips["trip_id"].map(mapper).to_numpy()
         self.trips = self.trips.drop_duplicates(["trip_id", "service_id"], keep="first")
 
         return None
 
+    @utils.requires("trips", "stop_times", "frequencies")
+    @utils.raw_ids("trip_id")
     def expand_frequencies(self):
         """
-        transform frequencies.txt to stop_times
+        transform frequencies.txt to trips and stop_times, each frequency window of a trip
+        starts a new trip every headway_secs from start_time until end_time (excluded),
+        times of the trip stop_times are shifted to each new start
+
+        windows with an end_time before start_time cross midnight, windows with the same
+        start_time and end_time have no trips,
+        if exact_times is not 1, new stop_times timepoint is set to 0 (approximate times)
+        new trip_ids are the frequency trip_id, an underscore and a number, with more
+        underscores if one of the new trip_ids is an existing trip_id
         """
 
-        # TODO
+        if self.frequencies is None:
+            return None
+
+        st = self.stop_times
+
+        # stop_times positions of each trip, ordered by trip then stop_sequence
+        codes, tids = pd.factorize(st.trip_id)
+        order = np.argsort(codes, kind="stable")
+        counts = np.bincount(codes, minlength=len(tids))
+        first = np.cumsum(counts) - counts
+
+        freq = self.frequencies
+        template = pd.Index(tids).get_indexer(freq.trip_id)
+
+        start = utils.total_seconds(freq.start_time).to_numpy(dtype=float, na_value=np.nan)
+        end = utils.total_seconds(freq.end_time).to_numpy(dtype=float, na_value=np.nan)
+        end = np.where(end < start, end + 86400, end)
+        headway = freq.headway_secs.to_numpy(dtype=float, na_value=0)
+
+        if "exact_times" in freq.columns:
+            exact = (freq.exact_times == 1).to_numpy(dtype=bool, na_value=False)
+        else:
+            exact = np.zeros(len(freq), dtype=bool)
+
+        # number of trips by window
+        valid = (template >= 0) & (headway > 0) & (end > start)
+        n = np.zeros(len(freq), dtype=np.int64)
+        n[valid] = np.ceil((end[valid] - start[valid]) / headway[valid])
+
+        # new trips : window, template trip and start time
+        window = np.repeat(np.arange(len(freq)), n)
+        rank = np.arange(len(window)) - np.repeat(np.cumsum(n) - n, n)
+        departure = start[window] + rank * headway[window]
+        template = template[window]
+
+        # shift template stop_times to each start, from first stop departure
+        dep = utils.total_seconds(st.departure_time).to_numpy(dtype=float, na_value=np.nan)
+        arr = utils.total_seconds(st.arrival_time).to_numpy(dtype=float, na_value=np.nan)
+        t0 = dep[order[first]]
+        t0 = np.where(np.isnan(t0), arr[order[first]], t0)
+
+        length = counts[template]
+        rows = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length)
+        rows = order[np.repeat(first[template], length) + rows]
+        shift = np.repeat(departure - t0[template], length)
+
+        # new trip_ids, numbered by template trip
+        number = pd.Series(template).groupby(template).cumcount().astype(str)
+        old_ids = pd.Series(tids.take(template), dtype=st.trip_id.dtype)
+
+        existing = pd.concat([self.trips.trip_id, st.trip_id]).astype(str).drop_duplicates()
+        sep = "_"
+        new_ids = old_ids.astype(str) + sep + number
+        while new_ids.isin(existing).any():
+            sep = sep + "_"
+            new_ids = old_ids.astype(str) + sep + number
+        new_ids = new_ids.astype(st.trip_id.dtype)
+
+        df = st.iloc[rows].reset_index(drop=True)
+        df["trip_id"] = np.repeat(new_ids.to_numpy(), length)
+        for c, times in [("arrival_time", arr), ("departure_time", dep)]:
+            df[c] = utils.to_time(pd.Series(times[rows] + shift), st[c]).astype(st[c].dtype)
+
+        if not exact.all():
+            if "timepoint" not in df.columns:
+                df["timepoint"] = pd.Series(pd.NA, index=df.index, dtype="UInt8")
+            df.loc[np.repeat(~exact[window], length), "timepoint"] = 0
+
+        trips = pd.DataFrame({"trip_id": old_ids, "_new": new_ids})
+        trips = pd.merge(trips, self.trips, on="trip_id", how="inner")
+        trips = trips.drop(columns="trip_id").rename(columns={"_new": "trip_id"})
+
+        # replace template trips by new trips
+        templates = self.trips.trip_id.isin(freq.trip_id)
+        self.trips = pd.concat(
+            [self.trips.loc[~templates], trips[self.trips.columns]], ignore_index=True
+        )
+        self.stop_times = pd.concat(
+            [st.loc[~st.trip_id.isin(freq.trip_id)], df], ignore_index=True
+        )
+        self.frequencies = None
 
         return None
 
+    @utils.cached("stop_times")
+    def stop_sequences(self):
+        """
+        return trip runs and sequences of stop_times, see Stop_sequences,
+        computed once until stop_times are modified
+        """
+
+        return Stop_sequences.from_stop_times(self.stop_times)
+
     def _sequence_ids(self):
         """
         create a sequence_id column when bewteen 2 consecutive rows :
@@ -361,30 +545,25 @@ class Normalize_functions(object):
         return ids for stop_times
         """
 
-        df_shift = self.stop_times[["stop_sequence", "trip_id"]].shift(1)
-
-        mask_seq = self.stop_times.stop_sequence < df_shift.stop_sequence
-        mask_trip = self.stop_times.trip_id != df_shift.trip_id
-
-        df_change = self.stop_times.loc[(mask_seq) | (mask_trip)][["stop_sequence"]]
-
-        # sequence_number
-        df_change["_id"] = 1
-        df_change["sequence_id"] = df_change["_id"].cumsum()
-
-        return df_change.reindex(index=self.stop_times.index, method="ffill")[
-            "sequence_id"
-        ]
+        return pd.Series(
+            self.stop_sequences().ids.copy(), index=self.stop_times.index, name="sequence_id"
+        )
 
+    @utils.requires("stop_times")
     def fill_times(self):
         """
         fill departure_time and arrival_time with values
-        if neither exists and between 2 stops, interpolate with shape_dist_traveled or mean
-        else use existing value
+        if only one is empty, use the other value
+        if both are empty, interpolate between known times of the trip with
+        shape_dist_traveled or stop order, add or remove one minute by stop after
+        the last or before the first known time
+        drop trips without any time
         """
 
+        runs = self.stop_sequences()
+
         # one column is not empty
-        self.stop_times = self.stop_times.fillna(
+        df = self.stop_times.fillna(
             value={
                 "arrival_time": self.stop_times.departure_time,
                 "departure_time": self.stop_times.arrival_time,
@@ -392,52 +571,26 @@ class Normalize_functions(object):
         )
 
         # arrival and departure are empty
-
-        # first stop, delete one minute
-        self.stop_times.loc[
-            (self.stop_times.trip_id != self.stop_times.trip_id.shift(1))
-            & (self.stop_times.arrival_time.isna()),
-            "arrival_time",
-        ] = self.stop_times.arrival_time - pd.Timedelta(seconds=60)
-
-        self.stop_times.loc[
-            (self.stop_times.trip_id != self.stop_times.trip_id.shift(1))
-            & (self.stop_times.departure_time.isna()),
-            "departure_time",
-        ] = self.stop_times.departure_time - pd.Timedelta(seconds=60)
-
-        # last stop, add one minute
-        self.stop_times.loc[
-            (self.stop_times.trip_id != self.stop_times.trip_id.shift(-1))
-            & (self.stop_times.arrival_time.isna()),
-            "arrival_time",
-        ] = self.stop_times.arrival_time + pd.Timedelta(seconds=60)
-
-        self.stop_times.loc[
-            (self.stop_times.trip_id != self.stop_times.trip_id.shift(-1))
-            & (self.stop_times.departure_time.isna()),
-            "departure_time",
-        ] = self.stop_times.departure_time + pd.Timedelta(seconds=60)
-
-        # middle stop, mean of after and before
-        df = (
-            self.stop_times.departure_time.shift(1)
-            + self.stop_times.departure_time.shift(-1)
-        ) / 2
-        self.stop_times.loc[
-            (self.stop_times.departure_time.isna()) & (df.notna()), "departure_time"
-        ] = df
-
-        df = (
-            self.stop_times.arrival_time.shift(1)
-            + self.stop_times.arrival_time.shift(-1)
-        ) / 2
-        self.stop_times.loc[
-            (self.stop_times.arrival_time.isna()) & (df.notna()), "arrival_time"
-        ] = df
-
-        # Last case : multiple continous rows with na arrival_times and departure_times
-        # TODO : drop all_trip_ids
+        distances = None
+        if "shape_dist_traveled" in df.columns:
+            distances = df.shape_dist_traveled.to_numpy(dtype=float, na_value=np.nan)
+
+        for c in ["arrival_time", "departure_time"]:
+            times = utils.total_seconds(df[c]).to_numpy(dtype=float, na_value=np.nan)
+            if not np.isnan(times).any():
+                continue
+            times = runs.interpolate(times, distances=distances)
+            df[c] = utils.to_time(pd.Series(times, index=df.index), df[c]).astype(df[c].dtype)
+
+        self.stop_times = df
+
+        # trips without any time
+        missing = df.arrival_time.isna() | df.departure_time.isna()
+        if missing.any():
+            trip_ids = df.loc[missing, "trip_id"].drop_duplicates()
+            self._add_dropped(trip_ids, "trip_id", "trips without times")
+            self.stop_times = df.loc[~df.trip_id.isin(trip_ids)]
+            self.prune_ids(step_text="trips without times")
 
         return None
 
@@ -470,6 +623,7 @@ class Normalize_functions(object):
 
         return None
 
+    @utils.requires("agency", "routes", "fare_attributes", "stops", "trips", "stop_times")
     def set_defaults(self, defaults=defaults.defaults):
         """
         set defaults values
@@ -493,11 +647,16 @@ class Normalize_functions(object):
 
         return None
 
+    @utils.requires("stops", "stop_times", "trips", "routes")
     def drop_bad_coordinates(self, max_speed=None):
         """
         for each stop times, speed to previous stop, minimum time to 1 minute
         max speed by route_type, filter above value for each route_type
         if None, use defaults in defaults
+
+        distances are planar in a projected crs, else haversine on stop_lon, stop_lat
+        return a DataFrame of stops dropped for speed, indexed by stop_id,
+        with stop_name, minimum speed in km/h, route_type and max_speed
         """
 
         # drop stops if coordinates == 0 or missing coordinates
@@ -511,35 +670,57 @@ class Normalize_functions(object):
         self.prune_ids(step_text="empty, nil or not in range coordinates")
 
         # check speed
+        st = self.stop_times
+        stops = self.stops
+        runs = self.stop_sequences()
+
+        # stop position of each stop time, -1 takes the appended nan
+        rows = pd.Index(stops.stop_id).get_indexer(st.stop_id)
+
+        crs = stops.geometry.crs
+        if crs is not None and crs.is_projected:
+            x = np.append(stops.geometry.x.to_numpy(), np.nan)[rows]
+            y = np.append(stops.geometry.y.to_numpy(), np.nan)[rows]
+            dist = np.hypot(np.diff(x), np.diff(y))
+        else:
+            x = np.append(stops.stop_lon.to_numpy(dtype=float), np.nan)[rows]
+            y = np.append(stops.stop_lat.to_numpy(dtype=float), np.nan)[rows]
+            dist = spatial.haversine(x[:-1], y[:-1], x[1:], y[1:])
 
-        df = self.stop_times[
-            ["arrival_time", "departure_time", "trip_id", "stop_id", "stop_sequence"]
-        ].copy()
-
-        df = df.set_geometry(
-            self.stops_as_stoptimes()["geometry"], crs=self.stops.geometry.crs
-        )
-        df["dist"] = spatial.dist_traveled(df, "trip_id", accumulate=False)
-
-        df["time"] = (
-            df["departure_time"].iloc[1:].dt.seconds
-            - df["arrival_time"].shift(1).iloc[1:].dt.seconds
-        )
-        df.loc[df.trip_id != df.trip_id.shift(1), "time"] = 0
-        df["time"] = df["time"].fillna(60).div(60).clip(lower=1)
-        df = df.eval("speed = 60 * dist / (time * 1000)")
-
+        dist = np.round(np.append(0, dist))
+        dist[runs.trip_first] = 0
 
-        # add route_type to select max_speed
-        df_t = self.trips[["trip_id", "route_id"]].copy()
-        df_t["route_type"] = self.routes_as_trips()["route_type"]
-        df_t = df_t.drop_duplicates(["trip_id", "route_id"])
+        # minutes from previous arrival to departure, at least one minute
+        dep = utils.day_seconds(st.departure_time).to_numpy(dtype=float, na_value=np.nan)
+        arr = utils.day_seconds(st.arrival_time).to_numpy(dtype=float, na_value=np.nan)
+        time = np.append(np.nan, dep[1:] - arr[:-1])
+        time[runs.trip_first[1:].nonzero()[0] + 1] = 0
+        time = np.clip(np.nan_to_num(time, nan=60) / 60, 1, None)
 
-        df = pd.merge(df, df_t, on="trip_id", how="left")
+        speed = 60 * dist / (time * 1000)
 
-        df = df.groupby("stop_id").agg(
-            speed=("speed", "min"),
-            route_type=("route_type", "first"),
+        # route_type of the first route of each trip
+        route_types = pd.Series(
+            self.routes_as_trips()["route_type"].to_numpy(), index=self.trips.trip_id
+        )
+        route_types = route_types.loc[~route_types.index.duplicated()]
+        route_type = route_types.reindex(st.trip_id).to_numpy(dtype=float, na_value=np.nan)
+
+        # minimum speed and first route_type by stop
+        used = np.flatnonzero(rows >= 0)
+        order = used[np.argsort(rows[used], kind="stable")]
+        starts = np.flatnonzero(np.diff(rows[order], prepend=-1) != 0)
+
+        valid = np.where(np.isnan(route_type[order]), len(order), np.arange(len(order)))
+        first = np.minimum.reduceat(valid, starts) if len(order) > 0 else valid
+        first = np.append(route_type[order], np.nan)[first]
+
+        df = pd.DataFrame(
+            {
+                "speed": np.fmin.reduceat(speed[order], starts) if len(order) > 0 else [],
+                "route_type": first,
+            },
+            index=stops.stop_id.iloc[rows[order[starts]]],
         )
 
         # add maxspeed
@@ -547,24 +728,18 @@ class Normalize_functions(object):
         if max_speed is None:
             max_speed = defaults.max_speed
 
-        df = pd.merge(
-            df,
-            pd.Series(max_speed).to_frame("max_speed"),
-            left_on="route_type",
-            right_index=True,
-            how="left",
-        )
-                
+        df["max_speed"] = pd.Series(max_speed, dtype=float).reindex(df.route_type).to_numpy()
+
         # filter when speed above max_speed km/h or
-        df = df.loc[(df.speed < df.max_speed)]
-        
-        # clean columns
+        bad = ~(df.speed < df.max_speed)
+        df.insert(0, "stop_name", stops.set_index("stop_id").stop_name.reindex(df.index))
 
-        self.stops = self.stops.loc[self.stops.stop_id.isin(df.index)].copy()
+        self.stops = stops.loc[stops.stop_id.isin(df.index[~bad])].copy()
         self.prune_ids(step_text="impossible speed")
 
-        return None
+        return df.loc[bad]
 
+    @utils.requires("agency", "routes", "fare_attributes")
     def simple_agency(self, agency_name):
         """
         one agency for the GTFS, set route/agency_id if missing, and set to 1
@@ -596,6 +771,8 @@ class Normalize_functions(object):
 
         return None
 
+    @utils.requires("stops", "stop_times")
+    @utils.raw_ids("stop_id")
     def fix_invalid_stopids(self):
         """
         stop_ids and stop_codes may be mismatched
@@ -619,6 +796,7 @@ class Normalize_functions(object):
 
         return None
 
+    @utils.requires("stops", "shapes")
     def compress_coordinates(self, decimals):
         """
         compress stops coordinates to decimals, 6 decimals = aprox. 1 meter precision
@@ -636,22 +814,12 @@ class Normalize_functions(object):
     # -------------------------------------------------------------------------
     # find groups of routes sharing stops
 
-    def _group_routes(self, row):
-        """
-        return a tuple of route_ids ordered by decreasing trips
-        """
-        r = list(row["grproutes"]) + [row["route_id_l"]]
-        t = list(row["grptrips"]) + [row["trips"]]
-        l = list(zip(r, t))
-        l.sort(key=itemgetter(1, 0), reverse=True)
-        l = [x[0] for x in l]
-
-        return l[0]
-
+    @utils.requires("trips", "routes", "stop_times", "stops")
     def set_groupid(self, distance=20, share=0.65, nb_share=10, day=1):
         """
         add a group_id to routes by grouping routes sharing many stops
-        group_id is the route_id of the route with most trips with a group exists
+        groups are connected routes in the graph of routes sharing stops,
+        group_id is the route_id of the route with most trips of the group
 
         arguments:
             - distance : maximum distance between stops of routes, in projected_crs
@@ -663,10 +831,13 @@ class Normalize_functions(object):
             - day : number between 0 and 6, day to to filter stops
 
         results : update self by adding a group_id column to routes
+
+        shared stops of two routes and directions are stops of each one with a stop
+        of the other one in distance, counted on a sparse stops x routes matrix
         """
 
         # prepare data
-        df = (
+        trips = (
             self.trips.groupby("trip_id")
             .agg(
                 trips=("trip_id", "count"),
@@ -675,102 +846,74 @@ class Normalize_functions(object):
             )
             .reset_index()
         )
-
-        df = pd.merge(
-            df,
-            self.routes[["route_id", "route_type", "route_short_name"]],
-            on="route_id",
-            how="left",
+        trips["route_type"] = (
+            self.routes.drop_duplicates("route_id")
+            .set_index("route_id")
+            .route_type.reindex(trips.route_id)
+            .to_numpy()
         )
 
-        df2 = self.stop_times[["stop_id", "trip_id"]].copy()
-        df2 = df2.set_geometry(
-            self.stops_as_stoptimes()["geometry"], crs=self.stops.geometry.crs
-        )
+        # unique route, direction and stop, attributes of its first stop_time
+        ix = pd.Index(trips.trip_id).get_indexer(self.stop_times.trip_id)
+        nodes = trips.iloc[ix[ix >= 0]][["route_id", "direction_id", "trips", "route_type"]]
+        nodes["stop_id"] = self.stop_times.stop_id.to_numpy()[ix >= 0]
+        nodes = nodes.drop_duplicates(["route_id", "direction_id", "stop_id"])
 
-        df = pd.merge(df2, df, on="trip_id", how="left").drop(columns="trip_id")
-        df = df.drop_duplicates(["route_id", "direction_id", "stop_id"])
+        # route and direction number, nodes without route or direction are ignored
+        rd = nodes.groupby(["route_id", "direction_id"], sort=False).ngroup()
+        rd = rd.fillna(-1).to_numpy(dtype=np.int64)
+        nodes = nodes.loc[rd >= 0]
+        rd = rd[rd >= 0]
+        rds = nodes.groupby(rd).first()
+        route = pd.factorize(rds.route_id)[0]
 
         # count stops by route_id
-        stops = df.groupby(["route_id", "direction_id"]).size().to_frame("stops")
-
-        # make pairs by distance
-        df = spatial.query_pairs(df, distance=distance, self_pairs=False)
-        df = df.loc[df.route_id_l != df.route_id_r]
-
-        # drop duplicated pairs
-        df = df.drop_duplicates(
-            [
-                "route_id_l",
-                "direction_id_l",
-                "stop_id_l",
-                "route_id_r",
-                "direction_id_r",
-            ]
+        stops = np.bincount(rd, minlength=len(rds))
+
+        # stops in distance of each stop
+        index = self.stop_index()
+        s_ix, s = np.unique(index.positions(nodes.stop_id), return_inverse=True)
+        near = index.neighbours(distance)[s_ix][:, s_ix]
+
+        # routes and directions in distance of each stop
+        incidence = sparse.csr_matrix(
+            (np.ones(len(rd), dtype=bool), (s, rd)), shape=(len(s_ix), len(rds))
         )
-        df = df.drop_duplicates(
-            [
-                "route_id_l",
-                "direction_id_l",
-                "route_id_r",
-                "direction_id_r",
-                "stop_id_r",
-            ]
+        near = (near @ incidence).tocsr()
+
+        # pairs of node route and direction, and route and direction in distance
+        counts = np.diff(near.indptr)[s]
+        pos = np.repeat(near.indptr[s], counts) + _ranks(counts)
+        df = pd.DataFrame(
+            {
+                "_l": np.repeat(rd, counts),
+                "_r": near.indices[pos],
+                "trips": np.repeat(nodes.trips.to_numpy(), counts),
+            }
         )
+        df = df.loc[route[df._l.to_numpy()] != route[df._r.to_numpy()]]
 
-        grp = df.groupby(
-            ["route_id_l", "direction_id_l", "route_id_r", "direction_id_r"]
-        ).agg(
-            name_l=("route_short_name_l", "first"),
-            name_r=("route_short_name_r", "first"),
-            trips_l=("trips_l", "min"),
-            trips_r=("trips_r", "min"),
-            route_type_l=("route_type_l", "min"),
-            route_type_r=("route_type_r", "min"),
+        grp = df.groupby(["_l", "_r"]).agg(
+            shared=("trips", "size"), trips_l=("trips", "min")
         )
-
-        # groups must be of same route_type
-        grp = grp.loc[grp.route_type_l == grp.route_type_r]
-
-        grp["shared"] = df.groupby(
-            ["route_id_l", "direction_id_l", "route_id_r", "direction_id_r"]
-        ).size()
-
         grp = grp.reset_index()
 
-        # merge number of stops by route and direction
-        grp = pd.merge(
-            grp,
-            stops.reset_index(),
-            left_on=["route_id_l", "direction_id_l"],
-            right_on=["route_id", "direction_id"],
-            how="left",
-        ).drop(columns=["route_id", "direction_id"])
-
-        # reverse pair must exist
-        grp = pd.merge(
-            grp,
-            grp[
-                [
-                    "route_id_r",
-                    "direction_id_r",
-                    "route_id_l",
-                    "direction_id_l",
-                    "stops",
-                ]
-            ],
-            left_on=["route_id_l", "direction_id_l", "route_id_r", "direction_id_r"],
-            right_on=["route_id_r", "direction_id_r", "route_id_l", "direction_id_l"],
-            suffixes=("", "_rev"),
-            how="left",
-        ).drop(
-            columns=[
-                "route_id_r_rev",
-                "direction_id_r_rev",
-                "route_id_l_rev",
-                "direction_id_l_rev",
-            ]
+        # reverse pair always exists, shared stops are the smaller count
+        rev = pd.MultiIndex.from_frame(grp[["_l", "_r"]]).get_indexer(
+            pd.MultiIndex.from_arrays([grp._r, grp._l])
         )
+        grp["trips_r"] = grp.trips_l.to_numpy()[rev]
+        grp["shared"] = np.minimum(grp.shared.to_numpy(), grp.shared.to_numpy()[rev])
+
+        for k in ["l", "r"]:
+            codes = grp["_" + k].to_numpy()
+            grp["route_id_" + k] = rds.route_id.to_numpy()[codes]
+            grp["route_type_" + k] = rds.route_type.to_numpy()[codes]
+        grp["stops"] = stops[grp._l.to_numpy()]
+        grp["stops_rev"] = stops[grp._r.to_numpy()]
+
+        # groups must be of same route_type
+        grp = grp.loc[grp.route_type_l == grp.route_type_r]
 
         # filter by share of stops
 
@@ -805,21 +948,33 @@ class Normalize_functions(object):
             ["route_id_l", "route_id_r"]
         )
 
-        # create list of route_id in same group and list of other number of trips
-        grp = (
-            grp.groupby("route_id_l")
-            .agg(
-                grproutes=("route_id_r", tuple),
-                grptrips=("trips_r", tuple),
-                trips=("trips_l", "min"),
-            )
-            .reset_index()
+        # groups are connected routes, transitively
+        codes, route_ids = pd.factorize(
+            pd.concat([grp.route_id_l, grp.route_id_r], ignore_index=True)
+        )
+        n = len(route_ids)
+        graph = sparse.csr_matrix(
+            (np.ones(len(grp), dtype=bool), (codes[: len(grp)], codes[len(grp) :])),
+            shape=(n, n),
+        )
+        components = csgraph.connected_components(graph, directed=False)[1]
+
+        # select route_id with most trips as group_id, route_id is compared on equal trips
+        routes = pd.DataFrame(
+            {
+                "route_id_l": route_ids,
+                "trips": grp.groupby("route_id_l").trips_l.min().reindex(route_ids).to_numpy(),
+                "component": components,
+            }
         )
+        first = routes.sort_values(["trips", "route_id_l"], ascending=False).drop_duplicates(
+            "component"
+        )
+        group_ids = first.set_index("component").route_id_l
 
-        # select route_id with most trips as route_id
-        grp = grp.assign(group_id=grp.apply(self._group_routes, axis=1))[
-            ["route_id_l", "group_id"]
-        ]
+        grp = routes[["route_id_l"]].assign(
+            group_id=group_ids.reindex(components).to_numpy()
+        )
 
         # add route_short name to group_id
         grp = pd.merge(
@@ -919,6 +1074,8 @@ class Normalize_functions(object):
         correspond to a unique list of continuous stop_sequences
         and trip_id is an int
         """
+        if self.frequencies is not None:
+            return False
         if self.trips.loc[self.trips.trip_id.duplicated()].shape[0] > 0:
             return False
         t1 = self.trips.trip_id.drop_duplicates().sort_values().to_numpy()
@@ -984,3 +1141,86 @@ class Normalize_functions(object):
             return b
         else:
             return all([v for k, v in b.items()])
+
+
+def _read_checkpoint(checkpoint_dir, params):
+    """
+    return the state dict of the last completed stage in checkpoint_dir,
+    None if there is no checkpoint, raise a ValueError if the source feed
+    or params are different
+    """
+
+    path = os.path.join(checkpoint_dir, checkpoint_file)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        state = json.load(f)
+
+    previous = json.loads(state["params"])
+    if previous.get("source") != params["source"]:
+        raise ValueError("{0} has a checkpoint of another source feed".format(checkpoint_dir))
+
+    if state["params"] != json.dumps(params, sort_keys=True, default=str):
+        raise ValueError(
+            "{0} has a checkpoint with other normalize parameters".format(checkpoint_dir)
+        )
+
+    return state
+
+
+def _write_checkpoint(feed, checkpoint_dir, stage, params, categorical_ids):
+    """
+    save feed after stage in a new directory of checkpoint_dir, then replace
+    the state file and remove the previous feed directory
+    """
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = os.path.join(checkpoint_dir, checkpoint_file)
+
+    previous = None
+    if os.path.exists(path):
+        with open(path) as f:
+            previous = json.load(f)["feed"]
+
+    feed_dir = tempfile.mkdtemp(prefix=stage + "_", dir=checkpoint_dir)
+    feed.to_parquet(feed_dir)
+
+    state = {
+        "stage": stage,
+        "feed": os.path.basename(feed_dir),
+        "params": json.dumps(params, sort_keys=True, default=str),
+        "categorical_ids": categorical_ids,
+    }
+
+    # state file is replaced at once, a killed run keeps the previous checkpoint
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+    if previous is not None and previous != state["feed"]:
+        shutil.rmtree(os.path.join(checkpoint_dir, previous), ignore_errors=True)
+
+    return None
+
+
+def _remove_checkpoint(checkpoint_dir):
+    """remove the state file and feed directory of the last checkpoint in checkpoint_dir"""
+
+    path = os.path.join(checkpoint_dir, checkpoint_file)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        previous = json.load(f)["feed"]
+
+    os.remove(path)
+    shutil.rmtree(os.path.join(checkpoint_dir, previous), ignore_errors=True)
+
+    return None
+
+
+def _ranks(counts):
+    """position of each element in its group, for groups of counts elements"""
+
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+
+# arrow types of the dtypes used in gtfs_def
+arrow_types = {
+    "UInt8": pa.uint8(),
+    "UInt16": pa.uint16(),
+    "UInt32": pa.uint32(),
+    float: pa.float64(),
+    int: pa.int64(),
+    str: pa.string(),
+}
+
+# default block size for the multithreaded csv parser, in bytes
+block_size = 1 << 24
+
+
+def arrow_type(dtype):
+    """return the arrow type of a gtfs_def dtype"""
+
+    if dtype in arrow_types:
+        return arrow_types[dtype]
+    return pa.from_numpy_dtype(pd.api.types.pandas_dtype(dtype))
+
+
+def _types_mapper(dtypes):
+    """
+    return a types_mapper for pyarrow.Table.to_pandas converting arrow types
+    to the same pandas dtypes as pd.read_csv with the gtfs_def dtypes
+    """
+
+    mapper = {}
+    for dtype in set(dtypes.values()):
+        pd_dtype = pd.api.types.pandas_dtype(dtype)
+        if isinstance(pd_dtype, pd.api.extensions.ExtensionDtype):
+            mapper[arrow_type(dtype)] = pd_dtype
+
+    return mapper.get
+
+
+class GTFS_Source(object):
+    """
+    Access to the files of a GTFS zip file or directory
+
+    a zip file is opened once and its members are indexed once by file name,
+    files are opened as binary streams that can be passed to pandas or pyarrow
+    parsers without a temporary copy
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.is_zip = zipfile.is_zipfile(path)
+
+        if self.is_zip:
+            self._zip = zipfile.ZipFile(path)
+            self.members = {os.path.basename(x): x for x in self._zip.namelist()}
+        elif os.path.isdir(path):
+            self._zip = None
+            self.members = {x: os.path.join(path, x) for x in os.listdir(path)}
+        else:
+            raise ValueError("{0} is not a zip file or a directory".format(path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def files(self):
+        """set of file names"""
+        return set(self.members.keys())
+
+    @property
+    def name(self):
+        """name of zip file or directory, without extension"""
+        return os.path.splitext(os.path.basename(os.path.normpath(self.path)))[0]
+
+    def open(self, file):
+        """return a binary stream of file, None if file is missing"""
+
+        if file not in self.members:
+            return None
+
+        if self.is_zip:
+            return self._zip.open(self.members[file])
+
+        return open(self.members[file], "rb")
+
+    def open_with_header(self, file):
+        """
+        return a tuple of column names and the binary stream positioned after the header,
+        None if file is missing
+        """
+
+        f = self.open(file)
+        if f is None:
+            return None
+
+        line = f.readline().decode("utf-8-sig")
+        header = next(csv.reader(io.StringIO(line)), [])
+
+        return header, f
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+
+
+def _is_empty(source):
+    """True if nothing is left to read in a buffered binary stream"""
+
+    return hasattr(source, "peek") and len(source.peek(1)) == 0
+
+
+def read_csv_arrow(source, dtypes, column_names=None, use_threads=True):
+    """
+    read a csv file with the multithreaded pyarrow parser, file is split in
+    blocks parsed in parallel, column types are set at parse time
+
+    Args :
+        source : path or file-like object
+        dtypes : dict of column name : gtfs_def dtype, other columns are not read
+        column_names : optional list of column names if header is already read from source
+
+    Returns a DataFrame with same dtypes as pd.read_csv
+    """
+
+    if column_names is not None and _is_empty(source):
+        # header only file, pyarrow refuses an empty stream
+        table = pa.table(
+            {k: pa.array([], type=arrow_type(v)) for k, v in dtypes.items() if k in column_names}
+        )
+        return table.to_pandas(types_mapper=_types_mapper(dtypes))
+
+    table = pv.read_csv(
+        source,
+        read_options=pv.ReadOptions(
+            use_threads=use_threads, block_size=block_size, column_names=column_names
+        ),
+        convert_options=pv.ConvertOptions(
+            column_types={k: arrow_type(v) for k, v in dtypes.items()},
+            include_columns=list(dtypes.keys()),
+            strings_can_be_null=True,
+        ),
+    )
+
+    return table.to_pandas(types_mapper=_types_mapper(dtypes))
+
+
+def read_files_arrow(sources, max_workers=None):
+    """
+    parse csv files concurrently
+
+    Args :
+        sources : dict of file name : (path or file-like object, dtypes, column names or None)
+        max_workers : number of files parsed at the same time, default to the number of files
+
+    Returns a dict of file name : DataFrame
+    """
+
+    if len(sources) == 0:
+        return {}
+
+    if max_workers is None:
+        max_workers = len(sources)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            k: executor.submit(read_csv_arrow, source, dtypes, column_names)
+            for k, (source, dtypes, column_names) in sources.items()
+        }
+        return {k: f.result() for k, f in futures.items()}
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+
+class Stop_sequences(object):
+    """
+    Runs of consecutive stop_times rows, computed in one pass over trip_id and stop_sequence
+
+    a trip run starts when trip_id changes, a sequence starts when trip_id changes or
+    stop_sequence decreases, stop_times are ordered by trip_id and stop_sequence on load
+    so that trip runs are trips
+
+    attributes, numpy arrays :
+        trip_first, trip_last : boolean by row, first or last row of a trip run
+        trip_starts : positions of the first row of each trip run
+        ids : sequence number by row, from 1
+        starts : positions of the first row of each sequence
+        counts : number of rows of each sequence
+        offsets : position of each row in its sequence
+    """
+
+    def __init__(self, trip_ids, stop_sequence):
+
+        n = len(trip_ids)
+
+        trips = _values(trip_ids)
+        seq = pd.Series(stop_sequence).to_numpy(dtype=float, na_value=np.nan)
+
+        self.trip_first = np.ones(n, dtype=bool)
+        self.trip_first[1:] = trips[1:] != trips[:-1]
+        self.trip_last = np.ones(n, dtype=bool)
+        self.trip_last[:-1] = self.trip_first[1:]
+        self.trip_starts = np.flatnonzero(self.trip_first)
+
+        first = self.trip_first.copy()
+        first[1:] |= seq[1:] < seq[:-1]
+
+        self.ids = np.cumsum(first)
+        self.starts = np.flatnonzero(first)
+        self.counts = np.diff(np.append(self.starts, n))
+        self.offsets = np.arange(n) - np.repeat(self.starts, self.counts)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_stop_times(cls, stop_times):
+        """build from a stop_times DataFrame"""
+
+        return cls(stop_times.trip_id, stop_times.stop_sequence)
+
+    def row_counts(self):
+        """number of rows of the sequence of each row"""
+
+        return np.repeat(self.counts, self.counts)
+
+    def trip_reduce(self, ufunc, values):
+        """
+        reduce values by trip run with a numpy ufunc (np.fmin, np.maximum...),
+        return an array with one value by trip run
+        """
+
+        if len(values) == 0:
+            return np.asarray(values)[:0]
+
+        return ufunc.reduceat(np.asarray(values), self.trip_starts)
+
+    def interpolate(self, values, distances=None, step=60):
+        """
+        fill nan values of each trip run from its known values, in one pass :
+            - between two known values, linear interpolation on distances if they increase
+              along the gap, else on row positions
+            - before the first or after the last known value, step by row from it
+            - trip runs without known values stay nan
+
+        values : float array of times in seconds
+        distances : optional float array of distances, shape_dist_traveled
+        step : seconds added by row before or after known values
+        """
+
+        values = np.asarray(values, dtype=float)
+        n = len(values)
+        rows = np.arange(n)
+        known = ~np.isnan(values)
+
+        # previous and next known rows, in the same trip run
+        start = self.trip_broadcast(self.trip_starts)
+        end = self.trip_broadcast(np.append(self.trip_starts[1:], n)) - 1
+        prev = np.maximum.accumulate(np.where(known, rows, -1))
+        nxt = np.minimum.accumulate(np.where(known, rows, n)[::-1])[::-1]
+        has_prev = ~known & (prev >= start)
+        has_next = ~known & (nxt <= end)
+
+        res = values.copy()
+
+        between = np.flatnonzero(has_prev & has_next)
+        p, q = prev[between], nxt[between]
+        weight = (between - p) / (q - p)
+        if distances is not None:
+            d = np.asarray(distances, dtype=float)
+            # distances are only divided where they increase along the gap
+            increase = d[q] > d[p]
+            d_weight = np.divide(
+                d[between] - d[p], d[q] - d[p], out=np.zeros(len(between)), where=increase
+            )
+            valid = increase & (d_weight >= 0) & (d_weight <= 1)
+            weight = np.where(valid, d_weight, weight)
+        res[between] = values[p] + weight * (values[q] - values[p])
+
+        before = np.flatnonzero(has_next & ~has_prev)
+        res[before] = values[nxt[before]] - step * (nxt[before] - before)
+
+        after = np.flatnonzero(has_prev & ~has_next)
+        res[after] = values[prev[after]] + step * (after - prev[after])
+
+        return res
+
+    def trip_broadcast(self, values):
+        """repeat one value by trip run to all rows of the run"""
+
+        counts = np.diff(np.append(self.trip_starts, len(self.trip_first)))
+        return np.repeat(values, counts)
+
+
+def _values(ids):
+    """numpy array of ids that can be compared row by row, categorical codes if categorical"""
+
+    if isinstance(ids.dtype, pd.CategoricalDtype):
+        return ids.cat.codes.to_numpy()
+    return ids.to_numpy()
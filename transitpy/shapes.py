@@ -5,6 +5,7 @@ import pandas as pd
 import streetpy as st
 
 from .spatial import dist_traveled, linestring_coordinates, _shape_linestrings
+from .utils import cached, raw_ids, requires
 
 
 class Shapes_functions(object):
@@ -13,6 +14,8 @@ class Shapes_functions(object):
     Shape functions
     """
 
+    @requires("stop_times", "stops", "trips", "shapes")
+    @raw_ids("shape_id")
     def simple_shapes(self, overwrite=False):
         """
         create shapes.txt from stop to stop if shapes.txt is absent or
@@ -29,7 +32,7 @@ class Shapes_functions(object):
         ]
 
         # find a shape id for each trip_id with same sequence of stops
-        df = paths.groupby("trip_id")["stop_id"].agg(tuple).to_frame("shape_id")
+        df = paths.groupby("trip_id", observed=True)["stop_id"].agg(tuple).to_frame("shape_id")
         df["shape_id"] = df["shape_id"].astype("category").cat.codes
 
         # conform paths to shapes.txt content
@@ -176,6 +179,7 @@ class Shapes_functions(object):
 
         return traj
 
+    @cached("shapes", "projected_crs")
     def shape_geometries(self, projected_crs=True):
         """
         returns a GeoSeries of the shape geometries, shape_id as index
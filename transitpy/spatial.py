@@ -1,13 +1,166 @@
 # -*- coding: utf-8 -*-
+import os
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 import shapely as sh
 import scipy.spatial as sp
+from scipy import sparse
 
 from transitpy.utils import format_timedelta
 
+# mean earth radius, in meters
+earth_radius = 6371008.8
+
+# default side of grid tiles matched at once, in projected crs units
+grid_tile_size = 10000
+
+# number of grid cells projected at once to find their tile
+grid_chunk_size = 100000
+
+# ------------------------------------------------------------------------------
+# stops spatial index
+
+
+class Stop_index(object):
+    """
+    Spatial index of stops, a KD-tree of projected coordinates built on creation
+    and a shapely STRtree of stop geometries built on first use
+
+    attributes :
+        stop_ids : Index of stop_id, by position in the index
+        coords : (stops, 2) array of coordinates
+        crs : crs of coordinates
+    """
+
+    def __init__(self, stop_ids, geometry):
+
+        if geometry.isna().any():
+            raise ValueError("stops must not contain empty geometries")
+
+        self.stop_ids = pd.Index(stop_ids)
+        self.crs = geometry.crs
+        self.coords = np.column_stack([geometry.x.to_numpy(), geometry.y.to_numpy()])
+        self.tree = sp.cKDTree(self.coords)
+        self._geometries = geometry.array
+        self._strtree = None
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    @classmethod
+    def from_stops(cls, stops):
+        """build from a stops GeoDataFrame"""
+
+        return cls(stops.stop_id, stops.geometry)
+
+    @property
+    def strtree(self):
+        """shapely STRtree of stop geometries"""
+
+        if self._strtree is None:
+            self._strtree = sh.STRtree(self._geometries)
+        return self._strtree
+
+    def positions(self, stop_ids):
+        """positions of stop_ids in the index, -1 if missing"""
+
+        return self.stop_ids.get_indexer(stop_ids)
+
+    def pairs(self, distance, self_pairs=True, items=None):
+        """
+        return arrays of left positions, right positions and distances of pairs of stops
+        at most at distance, in both directions, ordered by left then right position
+
+        items : optional array of stop positions of items (stops by route...),
+                pairs are made between items at stops in distance
+        """
+
+        # items at the same stop are pairs of different items
+        left, right, dist = _tree_pairs(self.tree, distance, self_pairs or items is not None)
+
+        if items is None:
+            return left, right, dist
+
+        left, right, dist = _item_pairs(np.asarray(items), left, right, dist, len(self))
+
+        if not self_pairs:
+            mask = left != right
+            left, right, dist = left[mask], right[mask], dist[mask]
+
+        order = np.lexsort((right, left))
+
+        return left[order], right[order], dist[order]
+
+    def neighbours(self, distance):
+        """sparse boolean matrix of stops at most at distance, stops are their own neighbours"""
+
+        n = len(self)
+        pairs = self.tree.query_pairs(r=distance, output_type="ndarray")
+
+        rows = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(n)])
+        cols = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(n)])
+
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n, n)
+        )
+
+    def radius(self, coords, distance, items=None):
+        """
+        return arrays of point positions, stop positions and distances of stops
+        at most at distance of points, ordered by point then stop position
+
+        coords : (points, 2) array of coordinates in the index crs
+        items : optional array of stop positions of items, stop positions are replaced
+                by positions of items at these stops
+        """
+
+        tree = sp.cKDTree(np.asarray(coords, dtype=float).reshape(-1, 2))
+        pairs = tree.sparse_distance_matrix(self.tree, distance, output_type="ndarray")
+        pairs = np.sort(pairs, order=["i", "j"])
+        points, stops, dist = pairs["i"], pairs["j"], pairs["v"]
+
+        if items is not None:
+            pos, stops = _stop_items(np.asarray(items), stops, len(self))
+            points, dist = points[pos], dist[pos]
+
+        return points, stops, dist
+
+    def nearest(self, coords, k=1, distance=np.inf):
+        """
+        return arrays of point positions, stop positions and distances of the k nearest
+        stops at most at distance of points, ordered by point then distance
+
+        coords : (points, 2) array of coordinates in the index crs
+        """
+
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        dist, stops = self.tree.query(coords, k=k, distance_upper_bound=distance)
+
+        points = np.repeat(np.arange(len(coords)), k)
+        dist, stops = dist.reshape(-1), stops.reshape(-1)
+        found = stops < len(self)
+
+        return points[found], stops[found], dist[found]
+
+    def bbox(self, xmin, ymin, xmax, ymax):
+        """return sorted positions of stops in a bounding box"""
+
+        return np.sort(self.strtree.query(sh.box(xmin, ymin, xmax, ymax)))
+
+    def query(self, geometries, predicate="intersects", distance=None):
+        """
+        return arrays of geometry positions and stop positions matching predicate,
+        see shapely STRtree.query, geometries are in the index crs
+        """
+
+        res = self.strtree.query(
+            np.asarray(geometries), predicate=predicate, distance=distance
+        )
+        return res[0], res[1]
+
+
 # ------------------------------------------------------------------------------
 # spatial functions
 
@@ -98,68 +251,111 @@ def dist_traveled(geom, group, accumulate=False, as_integer=True):
     return df["_distance"]
 
 
-def query_pairs(
-    points, distance, self_pairs=True, left_suffix="_l", right_suffix="_r", line=False
-):
+def haversine(lon_1, lat_1, lon_2, lat_2):
     """
-    Create a GeoDataframe of pairs between points geometries
+    return an array of distances in meters between arrays of WGS84 coordinates
+    """
+
+    lon_1, lat_1, lon_2, lat_2 = map(np.radians, (lon_1, lat_1, lon_2, lat_2))
+
+    a = (
+        np.sin((lat_2 - lat_1) / 2) ** 2
+        + np.cos(lat_1) * np.cos(lat_2) * np.sin((lon_2 - lon_1) / 2) ** 2
+    )
+
+    return 2 * earth_radius * np.arcsin(np.sqrt(a))
+
+
+def pair_indices(points, distance, self_pairs=True):
+    """
+    find pairs of points at most at distance, in both directions
 
     Args :
-        points : geodataframe, no interesting value in index
+        points : GeoSeries or GeoDataFrame of points, in a projected crs
         distance : max_distance to make pairs
         self_pairs : add same point pairs
-        left_suffix, right_suffix : suffix to differentiate from and to points
-        line : if True, add a linestring column from left to right
 
-    ---------
-    Res : geodataframe of pairs of points, geomtry is left point if line is False else geometry is line
+    Returns a tuple of arrays of left positions, right positions and distances,
+    ordered by left then right position
     """
 
-    if len(points.loc[points.geometry.isna()]) > 0:
+    if points.geometry.isna().any():
         raise ValueError("points must not contain empty geometries")
 
-    # index as integer values
-    df = points.reset_index(drop=True).copy()
-    coords = points.geometry.x.to_frame("x")
-    coords["y"] = points.geometry.y
+    coords = np.column_stack([points.geometry.x.to_numpy(), points.geometry.y.to_numpy()])
 
-    # paires avec index spatial
-    tr = sp.cKDTree(coords.to_numpy())
+    return _tree_pairs(sp.cKDTree(coords), distance, self_pairs)
 
-    ix_l = "_ix" + left_suffix
-    ix_r = "_ix" + right_suffix
-    geom_l = points.geometry.name + left_suffix
-    geom_r = points.geometry.name + right_suffix
 
-    pairs = pd.DataFrame(
-        data=tr.query_pairs(r=distance, output_type="ndarray"),
-        columns=[ix_l, ix_r],
-    )
+def _tree_pairs(tree, distance, self_pairs):
+    """pairs of points of a cKDTree at most at distance, see pair_indices"""
 
-    # result are from smaller id to bigger id
-    # duplicate in other direction
-    pairs = pd.concat(
-        [pairs, pairs.rename(columns={ix_l: ix_r, ix_r: ix_l})],
-        ignore_index=True,
-        sort=False,
-    )
+    pairs = tree.sparse_distance_matrix(tree, distance, output_type="ndarray")
+    pairs = np.sort(pairs, order=["i", "j"])
 
-    # add self pairs
-    if self_pairs:
-        self_pairs = pd.DataFrame(data={ix_l: df.index.values, ix_r: df.index.values})
-        pairs = pd.concat([pairs, self_pairs], ignore_index=True, sort=False)
+    if not self_pairs:
+        pairs = pairs[pairs["i"] != pairs["j"]]
 
-    # valeurs originales
-    pairs = pairs.merge(
-        df.add_suffix(left_suffix), left_on=ix_l, right_index=True, how="left"
-    )
+    return pairs["i"], pairs["j"], pairs["v"]
 
-    pairs = pairs.merge(
-        df.add_suffix(right_suffix), left_on=ix_r, right_index=True, how="left"
+
+def take_pairs(points, left, right, columns=None, left_suffix="_l", right_suffix="_r"):
+    """
+    return a DataFrame of columns of points at left and right positions, with suffixes
+
+    Args :
+        points : dataframe
+        left, right : arrays of positions, see pair_indices
+        columns : optional list of columns, default to all columns
+    """
+
+    df = points if columns is None else points[columns]
+
+    return pd.concat(
+        [
+            pd.DataFrame(df.take(left)).add_suffix(left_suffix).reset_index(drop=True),
+            pd.DataFrame(df.take(right)).add_suffix(right_suffix).reset_index(drop=True),
+        ],
+        axis=1,
     )
 
-    pairs = pairs.set_geometry(geom_l, crs=points.crs)
-    pairs["distance"] = pairs[geom_l].distance(pairs[[geom_r]].set_geometry(geom_r, crs=points.crs))
+
+def query_pairs(
+    points,
+    distance,
+    self_pairs=True,
+    left_suffix="_l",
+    right_suffix="_r",
+    line=False,
+    columns=None,
+):
+    """
+    Create a GeoDataframe of pairs between points geometries
+
+    Args :
+        points : geodataframe, no interesting value in index
+        distance : max_distance to make pairs
+        self_pairs : add same point pairs
+        left_suffix, right_suffix : suffix to differentiate from and to points
+        line : if True, add a linestring column from left to right
+        columns : optional list of columns of points in pairs, default to all columns
+
+    ---------
+    Res : geodataframe of pairs of points, geomtry is left point if line is False else geometry is line
+    """
+
+    left, right, dist = pair_indices(points, distance, self_pairs=self_pairs)
+
+    g = points.geometry.name
+    geom_l = g + left_suffix
+    geom_r = g + right_suffix
+
+    if columns is not None and g not in columns:
+        columns = list(columns) + [g]
+
+    pairs = take_pairs(points, left, right, columns, left_suffix, right_suffix)
+    pairs = gpd.GeoDataFrame(pairs, geometry=geom_l, crs=points.crs)
+    pairs["distance"] = dist
 
     if line:
         pairs["geometry"] = sh.shortest_line(pairs[geom_l].array,
@@ -167,7 +363,7 @@ def query_pairs(
         )
         pairs = pairs.set_geometry("geometry")
 
-    return pairs.drop(columns=[ix_l, ix_r])
+    return pairs
 
 
 def match_to_grid(feed, grid, distance, min_default=True):
@@ -184,6 +380,76 @@ def match_to_grid(feed, grid, distance, min_default=True):
         a geodataframe with grid index and geometry, agency_name, route_name, direction_id, stop_name, day, time (average stop time from start on a trip)
     """
 
+    routes = _grid_routes(feed, grid, distance, min_default)
+
+    return _match_cells(feed, routes, grid)
+
+
+def match_to_grid_chunks(feed, grid, distance, min_default=True, tile_size=grid_tile_size):
+    """
+    Same as match_to_grid by square tiles of the grid, memory is bounded by the tile size
+
+    Args :
+        feed : a GTFS feed
+        grid : a grid (or irregular zones) geodataframe, use index as unique id
+        distance : a single distance or a dictionary of route_type : distance,
+        min_default : if True, missing route type distance is the minimum distance, else maximum
+        tile_size : side of tiles in feed projected crs units, a cell is in the tile of its centroid
+
+    Yields a geodataframe of match_to_grid results by tile
+    """
+
+    routes = _grid_routes(feed, grid, distance, min_default)
+
+    for cells in _grid_tiles(grid, feed.projected_crs, tile_size):
+        yield _match_cells(feed, routes, grid.iloc[cells])
+
+
+def match_to_grid_parquet(
+    feed, grid, distance, path, min_default=True, tile_size=grid_tile_size, overwrite=False
+):
+    """
+    Write match_to_grid results to a parquet dataset, a directory of one file by tile,
+    tiles without matches are not written
+
+    Args :
+        path : directory of the dataset, created if missing
+        overwrite : if True, remove part files of a previous dataset in path,
+                    else raise a ValueError if path is not empty
+        other args : see match_to_grid_chunks
+
+    Returns the list of written files
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    # files of a previous run would be read with the new dataset
+    existing = os.listdir(path)
+    if existing and not overwrite:
+        raise ValueError("{0} is not empty".format(path))
+    for f in existing:
+        if f.startswith("part-") and f.endswith(".parquet"):
+            os.remove(os.path.join(path, f))
+
+    files = []
+    chunks = match_to_grid_chunks(feed, grid, distance, min_default, tile_size)
+    for i, df in enumerate(chunks):
+        if len(df) == 0:
+            continue
+        f = os.path.join(path, "part-{0:05d}.parquet".format(i))
+        df.to_parquet(f, index=False)
+        files.append(f)
+
+    return files
+
+
+def _grid_routes(feed, grid, distance, min_default):
+    """
+    aggregate feed by route, direction, stop and day for match_to_grid
+    return a tuple of the aggregated dataframe, distance, stop position
+    and route, direction and day group of each row
+    """
+
     # check that grip index is unique
     if not grid.index.is_unique:
         raise ValueError("Grid index must be unique")
@@ -195,67 +461,146 @@ def match_to_grid(feed, grid, distance, min_default=True):
 
     # simplify feed data
     df = (
-        df.groupby(["route_id", "direction_id", "stop_id", "day"])
+        df.groupby(["route_id", "direction_id", "stop_id", "day"], observed=True)
         .agg(
             agency_name=("agency_name", "first"),
             route_name=("route_short_name", "first"),
             route_type=("route_type", "first"),
             stop_name=("stop_name", "first"),
             trips=("trip_id", "size"),
-            stop_geom=("geometry", "first"),
             time=("time", "max"),
             start=('departure_time', 'min'),
             end=('arrival_time', 'max'),
         )
         .reset_index()
     )
-    df = df.set_geometry("stop_geom", crs=feed.projected_crs)
-
     # format timedelta to simple HH:MM text
     df['start'] = format_timedelta(df['start'])
     df['end'] = format_timedelta(df['end'])
 
-    # spatial join on full feed : stop ids may change between trips
+    # match on full feed : stop ids may change between trips
     # TODO : groupby trips with same sequence of stop ids
-    #        or sjoin on feed.stops
 
     if isinstance(distance, int) or isinstance(distance, float):
-        dist = distance
+        dist = np.full(len(df), distance, dtype=float)
     elif isinstance(distance, dict):
         dist = df["route_type"].map(distance)
         if min_default:
             dist = dist.fillna(min(distance.values()))
         else:
             dist = dist.fillna(max(distance.values()))
+        dist = dist.to_numpy(dtype=float)
     else:
         raise ValueError("distance must be a numeric or a dictionary")
 
-    df["_buffer"] = df["stop_geom"].centroid.buffer(dist)
-    df = df.set_geometry("_buffer", crs=feed.projected_crs)
+    # stops missing from the index are moved after the last stop, never in range
+    index = feed.stop_index()
+    items = index.positions(df["stop_id"])
+    items = np.where(items < 0, len(index), items)
 
-    # create grid centroid
-    df_grid = grid.to_crs(epsg=feed.projected_crs)
-    df_grid = df_grid.rename_geometry("_gridgeom")
-    df_grid["_centgeom"] = df_grid.centroid
-    df_grid = df_grid.set_geometry("_centgeom", crs=feed.projected_crs)
+    groups = df.groupby(["route_id", "direction_id", "day"], observed=True, sort=False).ngroup()
 
-    df = gpd.sjoin(df, df_grid, predicate="intersects")
-    df["dist"] = df["stop_geom"].distance(df["_gridgeom"].centroid)
+    return df, dist, items, groups.to_numpy()
+
+
+def _grid_tiles(grid, crs, tile_size):
+    """
+    split grid rows in square tiles of tile_size by the projected centroid of cells,
+    return a list of arrays of row positions, tiles are ordered by x then y
+
+    centroids are computed by chunks of grid_chunk_size cells, only tiles are kept
+    """
+
+    if len(grid) == 0:
+        return []
+
+    tx = np.empty(len(grid), dtype=np.int64)
+    ty = np.empty(len(grid), dtype=np.int64)
+    geometry = grid.geometry.array
+
+    for start in range(0, len(grid), grid_chunk_size):
+        chunk = slice(start, start + grid_chunk_size)
+        centroids = sh.centroid(np.asarray(geometry[chunk]))
+        centroids = gpd.GeoSeries(centroids, crs=grid.crs).to_crs(epsg=crs)
+        tx[chunk] = np.floor(np.nan_to_num(centroids.x.to_numpy()) / tile_size)
+        ty[chunk] = np.floor(np.nan_to_num(centroids.y.to_numpy()) / tile_size)
+
+    order = np.lexsort((ty, tx))
+    starts = np.flatnonzero(np.r_[True, (np.diff(tx[order]) != 0) | (np.diff(ty[order]) != 0)])
+
+    return np.split(order, starts[1:])
 
-    # each grid cell is connected to one stop for a route and direction
-    df = df.sort_values("dist").drop_duplicates(
-        ["index_right", "route_id", "direction_id", "day"], keep="first"
-    )
+
+def _match_cells(feed, routes, grid):
+    """
+    connect grid cells to the closest stop of aggregated routes from _grid_routes,
+    return a geodataframe in feed projected crs
+    """
+
+    df, dist, items, groups = routes
+
+    # grid centroids in stops crs
+    df_grid = grid.to_crs(epsg=feed.projected_crs)
+    centroids = df_grid.centroid
+    coords = np.column_stack([centroids.x.to_numpy(), centroids.y.to_numpy()])
+
+    # rows at stops in distance of each grid centroid
+    index = feed.stop_index()
+    cells, rows, d = index.radius(coords, dist.max(initial=0), items=items)
+    mask = d <= dist[rows]
+    cells, rows, d = cells[mask], rows[mask], d[mask]
+
+    # each grid cell is connected to one stop for a route and direction, the closest one
+    g = groups[rows]
+    order = np.lexsort((d, g, cells))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (np.diff(cells[order]) != 0) | (np.diff(g[order]) != 0)
+    order = order[first]
+    cells, rows, d = cells[order], rows[order], d[order]
 
     if grid.index.name is None:
         gr_name = "grid_index"
     else:
         gr_name = grid.index.name
 
-    df = df.rename(columns={"index_right": gr_name, "_gridgeom": grid.geometry.name})
-    df = df.set_geometry(grid.geometry.name, crs=feed.projected_crs)
+    # add grid data and geometry at the end
+    res = df.iloc[rows].copy()
+    res[gr_name] = df_grid.index.take(cells)
+    for c in df_grid.columns:
+        res[c] = df_grid[c].take(cells).to_numpy()
+    res["dist"] = d
+
+    return gpd.GeoDataFrame(res, geometry=grid.geometry.name, crs=df_grid.crs)
+
+
+def _stop_items(items, stops, n_stops):
+    """
+    expand stop positions to positions of items at these stops, items are ordered
+    return arrays of positions in stops and of items
+    items : array of stop positions of items
+    """
+
+    order = np.argsort(items, kind="stable")
+    counts = np.bincount(items, minlength=n_stops)
+    starts = np.cumsum(counts) - counts
+
+    n = counts[stops]
+    pos = np.repeat(np.arange(len(stops)), n)
+    rank = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+
+    return pos, order[starts[stops][pos] + rank]
+
+
+def _item_pairs(items, left, right, dist, n_stops):
+    """
+    expand pairs of stops to pairs of items at these stops,
+    items : array of stop positions of items
+    """
+
+    pos_l, items_l = _stop_items(items, left, n_stops)
+    pos_r, items_r = _stop_items(items, right[pos_l], n_stops)
 
-    return df.drop(columns=["stop_geom", "_buffer"])
+    return items_l[pos_r], items_r, dist[pos_l][pos_r]
 
 
 def _geo_shift(gdf, shift_value):
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 import pandas as pd
 
-from transitpy.utils import format_timedelta, simple_list
+from transitpy.utils import (day_seconds, days, format_timedelta, simple_list,
+                             to_time, total_seconds)
 
 
 def route_stats(feed, group_directions=False, by_hour=True, max_arrival_hour=3):
@@ -34,16 +35,17 @@ def route_stats(feed, group_directions=False, by_hour=True, max_arrival_hour=3):
 
     df = feed.flat()
 
-    df["hour"] = df.departure_time.dt.seconds // 3600
+    df["hour"] = day_seconds(df.departure_time) // 3600
 
     # Pandas 1.0 has no mode aggregation function
     # find most_used hour by trip_id and day
-    df_H = df.groupby(["trip_id", "day", "hour"]).size().to_frame("size").reset_index()
+    df_H = df.groupby(["trip_id", "day", "hour"], observed=True).size()
+    df_H = df_H.to_frame("size").reset_index()
     df_H = df_H.sort_values("size", ascending=False).drop_duplicates(["trip_id", "day"])
 
     # statistics by trip
     df = (
-        df.groupby(["trip_id", "day"])
+        df.groupby(["trip_id", "day"], observed=True)
         .agg(
             agency_name=("agency_name", "first"),
             route_id=("route_id", "first"),
@@ -66,7 +68,7 @@ def route_stats(feed, group_directions=False, by_hour=True, max_arrival_hour=3):
         df, df_H[["trip_id", "day", "hour"]], on=["trip_id", "day"], how="left"
     )
     df["time"] = df.arrival - df.departure
-    df["time"] = df.time.dt.total_seconds()
+    df["time"] = total_seconds(df.time)
     df["speed"] = df.length / df.time * 3.6
 
     # statistics by route
@@ -80,13 +82,13 @@ def route_stats(feed, group_directions=False, by_hour=True, max_arrival_hour=3):
 
     # filter arrival next day after 3:00 to
     df.loc[
-        (df["arrival"].dt.days > 0)
-        & (df["arrival"].dt.seconds > max_arrival_hour * 3600),
+        (days(df["arrival"]) > 0)
+        & (day_seconds(df["arrival"]) > max_arrival_hour * 3600),
         "arrival",
-    ] = pd.Timedelta(seconds=0)
+    ] = to_time(0, df["arrival"])
 
     df = (
-        df.groupby(grp_list)
+        df.groupby(grp_list, observed=True)
         .agg(
             agency_name=("agency_name", "first"),
             group_name=("group_name", "first"),
@@ -157,14 +159,14 @@ def stop_stats(feed, max_arrival_hour=3):
     # filter arrival next day after 3:00 to
     df["arrival"] = df["arrival_time"].copy()
     df.loc[
-        (df["arrival"].dt.days > 0)
-        & (df["arrival"].dt.seconds > max_arrival_hour * 3600),
+        (days(df["arrival"]) > 0)
+        & (day_seconds(df["arrival"]) > max_arrival_hour * 3600),
         "arrival",
-    ] = pd.Timedelta(seconds=0)
+    ] = to_time(0, df["arrival"])
 
     # statistics by day, stop, route and direction
     df = (
-        df.groupby(["route_id", "direction_id", "stop_id", "day"])
+        df.groupby(["route_id", "direction_id", "stop_id", "day"], observed=True)
         .agg(
             agency_name=("agency_name", "first"),
             route_name=("route_short_name", "first"),
@@ -209,7 +211,7 @@ def transfer_route_stats(transfers, max_text_length=200):
     df = transfers.copy()
 
     # hour
-    df["hour"] = df["time"].dt.components.hours
+    df["hour"] = day_seconds(df["time"]) // 3600
 
     # wait time less than 10 and 20 minutes
     df["transf_10"] = df.wait <= 10
@@ -369,11 +371,14 @@ def transfer_stop_stats(
 
     df = transfers.copy()
 
+    def peak(t):
+        return to_time(td_from_str(t).total_seconds(), df.time)
+
     # time in peakhour
 
     df.loc[
-        ((df.time >= td_from_str(min_HPM)) & (df.time <= td_from_str(max_HPM)))
-        | ((df.time >= td_from_str(min_HPS)) & (df.time <= td_from_str(max_HPS))),
+        ((df.time >= peak(min_HPM)) & (df.time <= peak(max_HPM)))
+        | ((df.time >= peak(min_HPS)) & (df.time <= peak(max_HPS))),
         "wait_hp",
     ] = df["wait"]
 
@@ -0,0 +1,118 @@
+"""
+Small GTFS feeds written in temporary directories, shared by tests
+"""
+
+import os
+
+import pytest
+
+
+def _time(seconds):
+    return "{0:02d}:{1:02d}:{2:02d}".format(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+def write_gtfs(path):
+    """
+    write a GTFS directory of 7 routes of 8 trips, with missing times, a trip after
+    midnight, a trip of one stop, a trip of a missing route, a station and an unused stop
+    """
+
+    files = {}
+    files["agency.txt"] = [
+        "agency_id,agency_name,agency_url,agency_timezone",
+        "A1,Agency,http://a,Europe/Paris",
+    ]
+
+    routes = ["route_id,agency_id,route_short_name,route_long_name,route_type"]
+    for r in range(6):
+        routes.append("R{0},A1,L{0},Long {0},3".format(r))
+    routes.append("R9,A1,L9,Long 9,0")
+    files["routes.txt"] = routes
+
+    stops = ["stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station"]
+    for s in range(40):
+        stops.append(
+            "S{0},Stop {0},{1:.6f},{2:.6f},0,".format(s, 45.0 + s * 0.003, 4.80 + (s % 7) * 0.002)
+        )
+    stops.append("ST1,Station,45.5,4.9,1,")
+    stops.append("S100,Stop in station,45.5001,4.9001,0,ST1")
+    stops.append("S999,Unused,45.1,4.85,0,")
+    files["stops.txt"] = stops
+
+    trips = ["route_id,service_id,trip_id,direction_id,shape_id"]
+    stop_times = ["trip_id,arrival_time,departure_time,stop_id,stop_sequence,shape_dist_traveled"]
+    t = 0
+    for r in range(7):
+        route_id = "R{0}".format(r) if r < 6 else "R9"
+        route_stops = ["S{0}".format((r * 3 + k) % 40) for k in range(8)]
+        if r == 6:
+            route_stops = route_stops[:5] + ["S100"]
+        for d in range(2):
+            p = route_stops if d == 0 else route_stops[::-1]
+            for k in range(4):
+                trip_id = "T{0}".format(t)
+                t += 1
+                trips.append("{0},{1},{2},{3},".format(route_id, "WK" if k < 3 else "WE", trip_id, d))
+                start = 6 * 3600 + k * 1800 + r * 60 + (86400 if (r == 1 and k == 3) else 0)
+                for i, s in enumerate(p):
+                    time = _time(start + i * 120)
+                    if (r == 2 and 0 < i < 6 and k == 0) or (r == 3 and i == 3):
+                        time = ""
+                    stop_times.append(
+                        "{0},{1},{1},{2},{3},{4}".format(trip_id, time, s, i + 1, i * 300)
+                    )
+
+    trips.append("R0,WK,T_lonely,0,")
+    stop_times.append("T_lonely,07:00:00,07:00:00,S1,1,0")
+    trips.append("RX,WK,T_orphan,0,")
+    stop_times.append("T_orphan,07:00:00,07:00:00,S1,1,0")
+    stop_times.append("T_orphan,07:10:00,07:10:00,S2,2,0")
+    files["trips.txt"] = trips
+    files["stop_times.txt"] = stop_times
+
+    files["calendar.txt"] = [
+        "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date",
+        "WK,1,1,1,1,1,0,0,20240101,20241231",
+        "WE,0,0,0,0,0,1,1,20240101,20241231",
+    ]
+    files["calendar_dates.txt"] = [
+        "service_id,date,exception_type",
+        "WK,20240501,2",
+        "WE,20240501,1",
+        "WK,20250105,1",
+    ]
+
+    os.makedirs(path, exist_ok=True)
+    for name, lines in files.items():
+        with open(os.path.join(path, name), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    return path
+
+
+def write_frequencies(path):
+    """add frequencies.txt windows on trips T0 and T1 to a GTFS directory"""
+
+    lines = [
+        "trip_id,start_time,end_time,headway_secs,exact_times",
+        "T0,06:00:00,08:00:00,900,1",
+        "T1,23:30:00,24:30:00,1200,0",
+    ]
+    with open(os.path.join(path, "frequencies.txt"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    return path
+
+
+@pytest.fixture(scope="session")
+def gtfs_path(tmp_path_factory):
+    """path of a small GTFS directory"""
+
+    return write_gtfs(str(tmp_path_factory.mktemp("gtfs")))
+
+
+@pytest.fixture(scope="session")
+def gtfs_freq_path(tmp_path_factory):
+    """path of a small GTFS directory with frequencies"""
+
+    return write_frequencies(write_gtfs(str(tmp_path_factory.mktemp("gtfs_freq"))))
@@ -0,0 +1,110 @@
+"""
+Tests of cached feed data against data computed again after feed changes
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import transitpy as tp
+from transitpy import utils
+
+
+@pytest.fixture
+def feed(gtfs_path):
+    feed = tp.Feed(gtfs_path, crs=2154)
+    feed.clear_cache()
+    return feed
+
+
+def test_cached_until_assigned(feed):
+
+    res = feed.routes_as_trips()
+    pd.testing.assert_frame_equal(feed.routes_as_trips(), res)
+    assert feed.cache_info().loc["routes_as_trips"].tolist() == [1, 1]
+
+    feed.trips = feed.trips.head(5)
+    res = feed.routes_as_trips()
+
+    assert len(res) == 5
+    assert feed.cache_info().loc["routes_as_trips"].tolist() == [1, 2]
+
+
+def test_cached_result_is_a_copy(feed):
+
+    res = feed.routes_as_trips()
+    res["route_type"] = 99
+
+    assert (feed.routes_as_trips().route_type != 99).all()
+
+
+def test_cached_after_other_file_assigned(feed):
+
+    first = feed.stops_as_stoptimes()
+    pd.testing.assert_frame_equal(feed.stops_as_stoptimes(), first)
+
+    feed.stop_times = feed.stop_times.loc[feed.stop_times.trip_id != "T0"]
+    res = feed.stops_as_stoptimes()
+
+    assert len(res) == len(feed.stop_times)
+    pd.testing.assert_frame_equal(res, first.loc[res.index])
+
+
+def test_clear_cache(feed):
+
+    feed.routes_as_trips()
+    feed.clear_cache()
+
+    assert len(feed.cache_info()) == 0
+    feed.routes_as_trips()
+    assert feed.cache_info().loc["routes_as_trips"].tolist() == [0, 1]
+
+
+def test_cached_after_in_place_changes(feed):
+
+    n = len(feed.routes_as_trips())
+
+    feed.trips.drop(feed.trips.index[:5], inplace=True)
+    assert len(feed.routes_as_trips()) == n - 5
+
+    feed.trips["new"] = 1
+    feed.routes_as_trips()
+    assert feed.cache_info().loc["routes_as_trips"].tolist() == [0, 3]
+
+
+def test_requires_invalidates_cache(gtfs_path):
+
+    class Renamed_feed(tp.Feed):
+        @utils.requires("routes")
+        def rename_routes(self):
+            # values changed in place, rows and columns are the same
+            self.routes["route_short_name"] = "X"
+            return self.routes_as_trips()
+
+    feed = Renamed_feed(gtfs_path, crs=2154)
+    feed.routes_as_trips()
+
+    assert (feed.rename_routes().route_short_name == "X").all()
+    assert (feed.routes_as_trips().route_short_name == "X").all()
+
+
+def test_cached_arrays_read_only(feed):
+
+    calendar = feed.service_calendar()
+    arrays = [v for v in vars(calendar).values() if isinstance(v, np.ndarray)]
+
+    assert len(arrays) > 0
+    for a in arrays:
+        assert not a.flags.writeable
+
+
+def test_copy_cache(feed):
+
+    feed.routes_as_trips()
+    fd = feed.copy()
+
+    assert len(fd.cache_info()) == 0
+
+    fd.trips = fd.trips.head(5)
+    assert len(fd.routes_as_trips()) == 5
+    assert len(feed.routes_as_trips()) == len(feed.trips)
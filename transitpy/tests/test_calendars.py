@@ -0,0 +1,131 @@
+"""
+Regression tests of Service_calendar and service days against expanded dates
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import transitpy as tp
+from transitpy.calendars import Service_calendar, days
+
+
+def random_calendars(seed, n=30):
+    """calendar and calendar_dates DataFrames, with services only in calendar_dates"""
+
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 60, n), unit="D")
+    calendar = pd.DataFrame(
+        {
+            "service_id": ["S{0}".format(i) for i in range(n)],
+            "start_date": start,
+            "end_date": start + pd.to_timedelta(rng.integers(0, 90, n), unit="D"),
+        }
+    )
+    # a few repeated weekday patterns so that some services are identical
+    patterns = rng.integers(0, 2, (4, 7))
+    calendar[days] = patterns[rng.integers(0, 4, n)]
+    calendar.loc[calendar.index % 3 == 0, "end_date"] = calendar.start_date + pd.Timedelta(days=13)
+    calendar.loc[calendar.index % 3 == 0, "start_date"] = pd.Timestamp("2024-02-05")
+
+    m = 40
+    calendar_dates = pd.DataFrame(
+        {
+            "service_id": ["S{0}".format(i) for i in rng.integers(0, n + 5, m)],
+            "date": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 150, m), unit="D"),
+            "exception_type": rng.integers(1, 3, m),
+        }
+    )
+
+    return calendar, calendar_dates
+
+
+def reference_dates(calendar, calendar_dates):
+    """set of service_id and date, calendar rows expanded by day then exceptions applied"""
+
+    res = set()
+    for row in calendar.itertuples():
+        for d in pd.date_range(row.start_date, row.end_date):
+            if getattr(row, days[d.weekday()]) == 1:
+                res.add((row.service_id, d))
+
+    for row in calendar_dates.itertuples():
+        if row.exception_type == 1:
+            res.add((row.service_id, row.date))
+    for row in calendar_dates.itertuples():
+        if row.exception_type == 2:
+            res.discard((row.service_id, row.date))
+
+    return res
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_from_gtfs_as_expanded_dates(seed):
+
+    calendar, calendar_dates = random_calendars(seed)
+    cal = Service_calendar.from_gtfs(calendar, calendar_dates)
+    df = cal.to_calendar_dates()
+
+    assert set(zip(df.service_id, df.date)) == reference_dates(calendar, calendar_dates)
+
+    # ordered by service then date
+    order = np.lexsort((df.date.to_numpy(), cal.service_ids.get_indexer(df.service_id)))
+    np.testing.assert_array_equal(order, np.arange(len(df)))
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_unique_groups_identical_services(seed):
+
+    calendar, calendar_dates = random_calendars(seed)
+    cal = Service_calendar.from_gtfs(calendar, calendar_dates)
+    groups, res = cal.unique()
+
+    dates = cal.to_calendar_dates().groupby("service_id").date.apply(tuple)
+    dates = dates.reindex(cal.service_ids).apply(lambda x: x if isinstance(x, tuple) else ())
+
+    # same group if and only if same days
+    for i in range(len(cal)):
+        for j in range(len(cal)):
+            assert (groups[i] == groups[j]) == (dates.iloc[i] == dates.iloc[j])
+
+    # group days are the days of their services, groups are ordered by tuples of days
+    assert len(res) == groups.max() + 1
+    matrix = res.matrix()
+    np.testing.assert_array_equal(matrix[groups], cal.matrix())
+    keys = [tuple(np.flatnonzero(row)) for row in matrix]
+    assert keys == sorted(keys)
+
+
+def test_unique_empty():
+
+    cal = Service_calendar(["A", "B"], "2024-01-01", 0)
+    groups, res = cal.unique()
+
+    np.testing.assert_array_equal(groups, [0, 0])
+    assert len(res) == 1
+
+
+def test_service_days_as_calendar_dates(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    res = feed.service_days()
+
+    trips = feed.trips.groupby("service_id", observed=True).size().rename("n")
+    df = feed.calendar_dates.merge(trips, left_on="service_id", right_index=True, how="left")
+    df = df.groupby("date").agg(trips=("n", "sum"), services=("service_id", "nunique"))
+
+    np.testing.assert_array_equal(res.index.to_numpy(), df.index.to_numpy())
+    np.testing.assert_array_equal(res.trips.to_numpy(), df.trips.to_numpy())
+    np.testing.assert_array_equal(res.services.to_numpy(), df.services.to_numpy())
+    np.testing.assert_array_equal(res.weekday.to_numpy(), res.index.weekday)
+
+
+def test_services_on(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    cal = feed.service_calendar()
+    cd = feed.calendar_dates
+
+    for date in cd.date.drop_duplicates():
+        expected = set(cd.loc[cd.date == date, "service_id"].astype(str))
+        assert set(cal.services_on([date]).astype(str)) == expected
@@ -0,0 +1,104 @@
+"""
+Tests of normalize resumed from checkpoints against normalize run at once
+"""
+
+import json
+import os
+import random
+import shutil
+
+import pandas as pd
+import pytest
+
+import transitpy as tp
+
+tables = ["agency", "routes", "trips", "stop_times", "stops", "calendar_dates", "shapes"]
+
+
+def normalized(path, **kwargs):
+    random.seed(0)
+    feed = tp.Feed(path, crs=2154)
+    feed.normalize(**kwargs)
+    return feed
+
+
+def fail(*args, **kwargs):
+    raise RuntimeError("killed")
+
+
+def killed(path, checkpoint_dir, monkeypatch, **kwargs):
+    """run normalize stopped at set_groupid, return the last completed stage"""
+
+    with monkeypatch.context() as m:
+        m.setattr(tp.Feed, "set_groupid", fail)
+        with pytest.raises(RuntimeError):
+            normalized(path, checkpoint_dir=checkpoint_dir, **kwargs)
+
+    with open(os.path.join(checkpoint_dir, "normalize.json")) as f:
+        return json.load(f)["stage"]
+
+
+def test_resume_as_normalize(gtfs_path, tmp_path, monkeypatch):
+
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    assert killed(gtfs_path, checkpoint_dir, monkeypatch) == "simple_shapes"
+
+    # completed stages are not run again
+    with monkeypatch.context() as m:
+        m.setattr(tp.Feed, "fill_times", fail)
+        feed = normalized(gtfs_path, checkpoint_dir=checkpoint_dir, resume=True)
+
+    expected = normalized(gtfs_path)
+    for t in tables:
+        pd.testing.assert_frame_equal(
+            getattr(feed, t).reset_index(drop=True),
+            getattr(expected, t).reset_index(drop=True),
+            obj=t,
+        )
+
+
+def test_resume_other_parameters(gtfs_path, tmp_path, monkeypatch):
+
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    killed(gtfs_path, checkpoint_dir, monkeypatch)
+
+    with pytest.raises(ValueError):
+        normalized(gtfs_path, checkpoint_dir=checkpoint_dir, resume=True, group_distance=50)
+
+
+def test_resume_other_source(gtfs_path, tmp_path, monkeypatch):
+
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    killed(gtfs_path, checkpoint_dir, monkeypatch)
+
+    path = shutil.copytree(gtfs_path, str(tmp_path / "gtfs"))
+    with open(os.path.join(path, "agency.txt"), "a") as f:
+        f.write("A2,Other,http://b,Europe/Paris\n")
+
+    with pytest.raises(ValueError):
+        normalized(path, checkpoint_dir=checkpoint_dir, resume=True)
+
+
+def test_checkpoints_removed(gtfs_path, tmp_path, monkeypatch):
+
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    killed(gtfs_path, checkpoint_dir, monkeypatch)
+
+    # without resume, all stages run again
+    calls = []
+    with monkeypatch.context() as m:
+        m.setattr(tp.Feed, "fill_times", lambda self: calls.append("fill_times"))
+        normalized(gtfs_path, checkpoint_dir=checkpoint_dir)
+
+    assert calls == ["fill_times"]
+    assert os.listdir(checkpoint_dir) == []
+
+
+def test_checkpoints_need_source(gtfs_path, tmp_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    feed.to_parquet(str(tmp_path / "feed"))
+    feed = tp.Feed.from_parquet(str(tmp_path / "feed"))
+
+    with pytest.raises(ValueError):
+        feed.normalize(checkpoint_dir=str(tmp_path / "checkpoints"))
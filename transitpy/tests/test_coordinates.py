@@ -0,0 +1,90 @@
+"""
+Tests of drop_bad_coordinates against stop speeds computed stop time by stop time
+"""
+
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import transitpy as tp
+from transitpy.config import defaults
+
+
+@pytest.fixture(scope="module")
+def bad_gtfs_path(gtfs_path, tmp_path_factory):
+    """fixture feed with stop S5 moved 100 km away and stop S22 at 0, 0"""
+
+    path = shutil.copytree(gtfs_path, str(tmp_path_factory.mktemp("bad") / "gtfs"))
+    with open(os.path.join(path, "stops.txt")) as f:
+        lines = f.read().split("\n")
+
+    for i, line in enumerate(lines):
+        if line.startswith("S5,"):
+            lines[i] = "S5,Stop 5,45.915000,4.820000,0,"
+        elif line.startswith("S22,"):
+            lines[i] = "S22,Stop 22,0,0,0,"
+
+    with open(os.path.join(path, "stops.txt"), "w") as f:
+        f.write("\n".join(lines))
+
+    return path
+
+
+def reference_speeds(feed):
+    """minimum speed in km/h to each stop from the previous stop of its trips"""
+
+    xy = dict(zip(feed.stops.stop_id, zip(feed.stops.geometry.x, feed.stops.geometry.y)))
+    speeds = {}
+    previous = None
+    for row in feed.stop_times.itertuples():
+        speed = 0
+        if previous is not None and previous.trip_id == row.trip_id:
+            (x0, y0), (x1, y1) = xy[previous.stop_id], xy[row.stop_id]
+            dist = np.round(np.hypot(x1 - x0, y1 - y0))
+            time = (row.departure_time - previous.arrival_time).total_seconds()
+            time = max(60 if np.isnan(time) else time, 60) / 60
+            speed = 60 * dist / (time * 1000)
+        speeds[row.stop_id] = min(speeds.get(row.stop_id, np.inf), speed)
+        previous = row
+
+    return speeds
+
+
+def test_drop_bad_coordinates_as_speeds(bad_gtfs_path):
+
+    feed = tp.Feed(bad_gtfs_path, crs=2154)
+    stops = set(feed.stops.stop_id)
+
+    res = feed.drop_bad_coordinates()
+
+    # routes of the stop at 0, 0 are dropped first
+    dropped = feed.dropped
+    assert "S22" not in set(feed.stops.stop_id)
+    assert {"R5", "R9"} <= set(dropped.loc[dropped.step != "impossible speed", "id"])
+    assert list(res.index) == ["S5"]
+    assert {"R0", "R1"} <= set(dropped.loc[dropped.step == "impossible speed", "id"])
+    assert "S5" not in set(feed.stops.stop_id)
+    assert len(feed.stops) < len(stops) - 1
+
+    # speed of the remaining stops of the feed before the check
+    feed = tp.Feed(bad_gtfs_path, crs=2154)
+    feed.stops = feed.stops.loc[feed.stops.stop_id != "S22"]
+    feed.prune_ids()
+    speeds = reference_speeds(feed)
+
+    assert res.loc["S5", "speed"] == pytest.approx(speeds["S5"])
+    assert res.loc["S5", "speed"] > res.loc["S5", "max_speed"]
+    assert res.loc["S5", "max_speed"] == defaults.max_speed[3]
+    assert res.loc["S5", "stop_name"] == "Stop 5"
+    assert all(v < defaults.max_speed[3] for k, v in speeds.items() if k != "S5")
+
+
+def test_drop_bad_coordinates_max_speed(bad_gtfs_path):
+
+    feed = tp.Feed(bad_gtfs_path, crs=2154)
+    res = feed.drop_bad_coordinates(max_speed={0: 10**6, 3: 10**6})
+
+    assert len(res) == 0
+    assert "S5" in set(feed.stops.stop_id)
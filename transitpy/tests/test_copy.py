@@ -0,0 +1,53 @@
+"""
+Tests of feed copies sharing table data until modified
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import transitpy as tp
+from transitpy import utils
+
+tables = ["agency", "routes", "trips", "stop_times", "stops", "calendar_dates"]
+
+
+def shared(left, right):
+    return np.shares_memory(left.stops.stop_lat.to_numpy(), right.stops.stop_lat.to_numpy())
+
+
+@pytest.mark.skipif(not utils.copy_on_write(), reason="pandas copy on write is off")
+def test_copy_shares_data(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+
+    assert shared(feed.copy(), feed)
+    assert not shared(feed.copy(deep=True), feed)
+
+
+@pytest.mark.parametrize("deep", [None, True])
+def test_copy_modified_apart(gtfs_path, deep):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    before = {t: getattr(feed, t).copy(deep=True) for t in tables}
+
+    fd = feed.copy(deep=deep)
+    fd.stops.loc[fd.stops.index[0], "stop_lat"] = 0
+    fd.trips = fd.trips.head(3)
+    fd.prune_ids()
+
+    assert not shared(fd, feed)
+    for t in tables:
+        pd.testing.assert_frame_equal(getattr(feed, t), before[t], obj=t)
+
+
+def test_filter_keeps_feed(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    before = {t: getattr(feed, t).copy(deep=True) for t in tables}
+
+    res = feed.modal_filter(0)
+
+    assert len(res.routes) == 1
+    for t in tables:
+        pd.testing.assert_frame_equal(getattr(feed, t), before[t], obj=t)
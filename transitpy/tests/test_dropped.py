@@ -0,0 +1,83 @@
+"""
+Tests of dropped ids against ids removed from feed files
+"""
+
+import pandas as pd
+
+import transitpy as tp
+
+
+def names(df, id_col, name_col):
+    return dict(zip(df[id_col].astype(str), df[name_col]))
+
+
+def test_dropped_as_removed_ids(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    stops = feed.stops.copy()
+    routes = feed.routes.copy()
+    before = len(feed.dropped)
+
+    # duplicated stops and a route without trips
+    feed.stops = pd.concat([feed.stops, feed.stops.loc[feed.stops.stop_id.isin(["S1", "S2"])]])
+    feed.trips = feed.trips.loc[feed.trips.route_id != "R0"]
+    feed.prune_ids(step_text="test")
+
+    df = feed.dropped
+    assert list(df.columns) == ["step", "type", "id", "name"]
+    assert not df.head(before).step.isin(["test", "duplicated"]).any()
+
+    # duplicated rows have their own step
+    assert set(df.loc[df.step == "duplicated", "id"].astype(str)) == {"S1", "S2"}
+
+    df = df.loc[df.step.isin(["test", "duplicated"])]
+    removed = set(stops.stop_id.astype(str)) - set(feed.stops.stop_id.astype(str))
+    assert {"S1", "S2"} <= removed
+    assert set(df.loc[df.type == "stop_id", "id"].astype(str)) == removed
+    assert set(df.loc[df.type == "route_id", "id"].astype(str)) == {"R0"}
+
+    # names are names of dropped ids when they were dropped
+    for id_type, table, name_col in [
+        ("stop_id", stops, "stop_name"),
+        ("route_id", routes, "route_short_name"),
+    ]:
+        d = df.loc[df.type == id_type]
+        expected = d.id.astype(str).map(names(table, id_type, name_col))
+        assert d.name.tolist() == expected.tolist()
+
+    # trips have no names
+    assert df.loc[df.type == "trip_id", "name"].isna().all()
+
+
+def test_dropped_read_once(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    first = feed.dropped
+
+    feed.trips = feed.trips.loc[feed.trips.route_id != "R0"]
+    feed.prune_ids(step_text="first")
+    feed.trips = feed.trips.loc[feed.trips.route_id != "R1"]
+    feed.prune_ids(step_text="second")
+
+    df = feed.dropped
+    pd.testing.assert_frame_equal(df.head(len(first)), first)
+    assert list(df.step.drop_duplicates())[-2:] == ["first", "second"]
+
+    # reading dropped again does not add ids
+    pd.testing.assert_frame_equal(feed.dropped, df)
+
+
+def test_dropped_names_of_dropped_rows(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    feed.trips = feed.trips.loc[feed.trips.route_id != "R0"]
+    feed.prune_ids(step_text="test")
+
+    # names are taken from the dropped rows, later changes of the file are not read
+    feed.routes = feed.routes.assign(route_short_name="renamed")
+    feed.stops = None
+
+    df = feed.dropped
+    df = df.loc[df.step == "test"]
+    assert df.loc[df.type == "route_id", "name"].tolist() == ["L0"]
+    assert df.loc[df.type == "stop_id", "name"].notna().all()
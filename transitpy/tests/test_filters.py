@@ -0,0 +1,101 @@
+"""
+Regression tests of spatial filters against stops tested one by one
+"""
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+import shapely
+
+import transitpy as tp
+
+tables = ["routes", "trips", "stop_times", "stops", "calendar_dates"]
+
+
+@pytest.fixture(scope="module")
+def feed(gtfs_path):
+    return tp.Feed(gtfs_path, crs=2154)
+
+
+@pytest.fixture(scope="module")
+def polygons(feed):
+    c = feed.stops.geometry.iloc[10]
+    return gpd.GeoSeries(
+        [
+            c.buffer(800),
+            shapely.Polygon([(c.x - 300, c.y - 3000), (c.x, c.y + 3000), (c.x + 300, c.y - 3000)]),
+            shapely.Point(c.x + 5000, c.y).buffer(2500),
+        ],
+        crs=2154,
+        index=["a", "b", "c"],
+    )
+
+
+def reference_filter(feed, in_limits):
+    """feed of trips with at least 2 stop_times at stops in_limits, a function of stops"""
+
+    inside = feed.stops.loc[in_limits(feed.stops), "stop_id"]
+    st = feed.stop_times.loc[feed.stop_times.stop_id.isin(inside)]
+    counts = st.groupby("trip_id", observed=True).size()
+
+    fd = feed.copy()
+    fd.trips = fd.trips.loc[fd.trips.trip_id.isin(counts.index[counts >= 2])]
+    fd.prune_ids()
+
+    return fd
+
+
+def assert_same_feed(left, right):
+    for t in tables:
+        pd.testing.assert_frame_equal(
+            getattr(left, t).reset_index(drop=True),
+            getattr(right, t).reset_index(drop=True),
+            obj=t,
+        )
+
+
+def test_spatial_filter_polygons(feed, polygons):
+
+    expected = reference_filter(
+        feed, lambda stops: stops.geometry.intersects(polygons.union_all()).to_numpy()
+    )
+    res = feed.spatial_filter(polygons.to_crs(4326))
+
+    assert 0 < len(res.trips) < len(feed.trips)
+    assert_same_feed(res, expected)
+
+
+def test_spatial_filter_bounds(feed):
+
+    lon, lat = feed.stops.stop_lon, feed.stops.stop_lat
+    bounds = (lon.quantile(0.3), lat.quantile(0.3), lon.quantile(0.7), lat.quantile(0.7))
+
+    expected = reference_filter(
+        feed,
+        lambda stops: (
+            stops.stop_lon.between(bounds[0], bounds[2])
+            & stops.stop_lat.between(bounds[1], bounds[3])
+        ).to_numpy(),
+    )
+    res = feed.spatial_filter(bounds)
+
+    assert 0 < len(res.trips) < len(feed.trips)
+    assert_same_feed(res, expected)
+
+
+def test_spatial_split(feed, polygons):
+
+    res = dict(feed.spatial_split(polygons))
+
+    assert list(res.keys()) == list(polygons.index)
+    for label, polygon in polygons.items():
+        expected = reference_filter(
+            feed, lambda stops: stops.geometry.intersects(polygon).to_numpy()
+        )
+        assert_same_feed(res[label], expected)
+
+
+def test_spatial_filter_points(feed):
+
+    with pytest.raises(ValueError):
+        feed.spatial_filter(gpd.GeoSeries([shapely.Point(0, 0)]))
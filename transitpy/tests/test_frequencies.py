@@ -0,0 +1,88 @@
+"""
+Regression tests of expand_frequencies against trips built window by window
+"""
+
+import numpy as np
+import pandas as pd
+
+import transitpy as tp
+from transitpy import utils
+
+
+def reference_trips(feed):
+    """list of (template trip_id, first departure in seconds) of frequencies windows"""
+
+    res = []
+    for row in feed.frequencies.itertuples():
+        start = int(row.start_time.total_seconds())
+        end = int(row.end_time.total_seconds())
+        if end < start:
+            end += 86400
+        t = start
+        while t < end:
+            res.append((row.trip_id, t))
+            t += row.headway_secs
+
+    return res
+
+
+def test_expand_frequencies_as_windows(gtfs_freq_path):
+
+    feed = tp.Feed(gtfs_freq_path, crs=2154)
+    templates = feed.stop_times.loc[feed.stop_times.trip_id.isin(feed.frequencies.trip_id)]
+    expected = reference_trips(feed)
+
+    feed.expand_frequencies()
+    st = feed.stop_times
+
+    assert feed.frequencies is None
+    assert not st.trip_id.isin(templates.trip_id).any()
+    assert feed.trips.trip_id.is_unique
+
+    new = st.loc[st.trip_id.astype(str).str.match(r"T[01]_+\d+$")]
+    first = new.groupby("trip_id", observed=True, sort=False).departure_time.first()
+    assert len(first) == len(expected)
+
+    for (template, start), (trip_id, departure) in zip(expected, first.items()):
+        assert str(trip_id).startswith(template + "_")
+        assert int(departure.total_seconds()) == start
+
+        # template times shifted to the new start
+        t = templates.loc[templates.trip_id == template]
+        n = new.loc[new.trip_id == trip_id]
+        shift = start - utils.total_seconds(t.departure_time).iloc[0]
+        np.testing.assert_array_equal(
+            utils.total_seconds(n.arrival_time).to_numpy(),
+            utils.total_seconds(t.arrival_time).to_numpy() + shift,
+        )
+        np.testing.assert_array_equal(n.stop_id.to_numpy(), t.stop_id.to_numpy())
+
+
+def test_expand_frequencies_empty_window(gtfs_freq_path):
+
+    feed = tp.Feed(gtfs_freq_path, crs=2154)
+    windows = feed.frequencies.head(1).copy()
+    windows["end_time"] = windows["start_time"]
+    feed.frequencies = windows
+    trips = len(feed.trips)
+
+    feed.expand_frequencies()
+
+    # the template trip is replaced by no trip
+    assert len(feed.trips) == trips - 1
+
+
+def test_expand_frequencies_existing_trip_ids(gtfs_freq_path):
+
+    feed = tp.Feed(gtfs_freq_path, crs=2154)
+    existing = {"T2": "T0_0", "T3": "T1_1"}
+    feed.trips = feed.trips.assign(trip_id=feed.trips.trip_id.replace(existing))
+    feed.stop_times = feed.stop_times.assign(trip_id=feed.stop_times.trip_id.replace(existing))
+
+    feed.expand_frequencies()
+    trip_ids = feed.trips.trip_id.astype(str)
+
+    assert trip_ids.is_unique
+    assert set(existing.values()) <= set(trip_ids)
+    assert pd.Index(feed.stop_times.trip_id.astype(str)).isin(trip_ids).all()
+    assert (feed.stop_times.trip_id.astype(str) == "T0_0").sum() == 8
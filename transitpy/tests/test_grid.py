@@ -0,0 +1,108 @@
+"""
+Regression tests of match_to_grid against distances of each cell to each stop
+"""
+
+import random
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+import transitpy as tp
+from transitpy import spatial
+
+keys = ["grid_index", "route_id", "direction_id", "day"]
+
+
+@pytest.fixture(scope="module")
+def feed(gtfs_path):
+    random.seed(0)
+    feed = tp.Feed(gtfs_path, crs=2154)
+    feed.normalize()
+    return feed
+
+
+@pytest.fixture(scope="module")
+def grid(feed):
+    xmin, ymin, xmax, ymax = feed.stops.total_bounds
+    cells = [
+        shapely.box(x, y, x + 300, y + 300)
+        for x in np.arange(xmin - 1000, xmax + 1000, 250)
+        for y in np.arange(ymin - 1000, ymax + 1000, 250)
+    ]
+    return gpd.GeoDataFrame({"value": np.arange(len(cells))}, geometry=cells, crs=2154).to_crs(4326)
+
+
+def reference_match(feed, grid, distance):
+    """closest stop of each route, direction and day in distance of each cell centroid"""
+
+    flat = feed.flat()
+    flat = flat.drop_duplicates(["route_id", "direction_id", "day", "stop_id"])
+    routes = dict(zip(feed.routes.route_id, feed.routes.route_type))
+    stops = feed.stops.set_index("stop_id").geometry
+    centroids = grid.to_crs(2154).centroid
+
+    res = []
+    for (route_id, direction_id, day), df in flat.groupby(
+        ["route_id", "direction_id", "day"], observed=True
+    ):
+        d = distance if not isinstance(distance, dict) else distance.get(
+            routes[route_id], min(distance.values())
+        )
+        xy = np.column_stack([stops[df.stop_id].x, stops[df.stop_id].y])
+        for cell, c in centroids.items():
+            dist = np.hypot(xy[:, 0] - c.x, xy[:, 1] - c.y)
+            i = np.argmin(dist)
+            if dist[i] <= d:
+                res.append((cell, route_id, direction_id, day, df.stop_id.iloc[i], dist[i]))
+
+    res = pd.DataFrame(res, columns=keys + ["stop_id", "dist"])
+    return res.sort_values(keys).reset_index(drop=True)
+
+
+def sorted_matches(df):
+    df = pd.DataFrame(df.drop(columns=df.geometry.name))
+    return df.sort_values(keys).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("distance", [300, {3: 400, 0: 250}])
+def test_match_to_grid_as_distances(feed, grid, distance):
+
+    expected = reference_match(feed, grid, distance)
+    res = sorted_matches(spatial.match_to_grid(feed, grid, distance))
+
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(
+        res[keys + ["stop_id"]].astype(str), expected[keys + ["stop_id"]].astype(str)
+    )
+    np.testing.assert_allclose(res.dist, expected.dist)
+    np.testing.assert_array_equal(res.value, grid.value.loc[res.grid_index])
+
+
+def test_match_to_grid_chunks(feed, grid):
+
+    res = sorted_matches(spatial.match_to_grid(feed, grid, 300))
+    chunks = list(spatial.match_to_grid_chunks(feed, grid, 300, tile_size=2000))
+
+    assert len(chunks) > 1
+    pd.testing.assert_frame_equal(sorted_matches(pd.concat(chunks)), res)
+
+
+def test_match_to_grid_parquet(feed, grid, tmp_path):
+
+    res = sorted_matches(spatial.match_to_grid(feed, grid, 300))
+    path = str(tmp_path / "grid")
+
+    files = spatial.match_to_grid_parquet(feed, grid, 300, path, tile_size=2000)
+    assert len(files) > 1
+    pd.testing.assert_frame_equal(sorted_matches(gpd.read_parquet(path)), res)
+
+    # a second run does not mix with the first one
+    with pytest.raises(ValueError):
+        spatial.match_to_grid_parquet(feed, grid, 300, path)
+
+    files = spatial.match_to_grid_parquet(feed, grid, 300, path, tile_size=100000, overwrite=True)
+    assert len(files) == 1
+    pd.testing.assert_frame_equal(sorted_matches(gpd.read_parquet(path)), res)
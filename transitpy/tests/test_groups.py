@@ -0,0 +1,101 @@
+"""
+Regression tests of set_groupid against shared stops counted stop by stop
+"""
+
+import itertools
+
+import numpy as np
+import pytest
+
+import transitpy as tp
+
+
+def similar_routes(feed, distance, share, nb_share):
+    """set of pairs of route_ids sharing enough stops, shared stops counted by pairs of stops"""
+
+    st = feed.stop_times.merge(feed.trips[["trip_id", "route_id", "direction_id"]], on="trip_id")
+    route_types = dict(zip(feed.routes.route_id, feed.routes.route_type))
+    geometry = feed.stops.set_index("stop_id").geometry
+
+    stops = {}
+    for r, d, s in zip(st.route_id, st.direction_id, st.stop_id):
+        stops.setdefault((r, d), set()).add(s)
+
+    def shared(left, right):
+        return sum(
+            any(geometry[a].distance(geometry[b]) <= distance for b in stops[right])
+            for a in stops[left]
+        )
+
+    def value(param, route_type, default):
+        # route types missing from a dict keep their value, as Series.replace
+        if isinstance(param, dict):
+            return param.get(route_type, route_type if default is None else default)
+        return param
+
+    pairs = set()
+    for left, right in itertools.permutations(stops, 2):
+        t = route_types[left[0]]
+        if left[0] == right[0] or t != route_types[right[0]]:
+            continue
+        n = min(shared(left, right), shared(right, left))
+        if n == 0:
+            continue
+        s = value(share, t, None)
+        nb = value(nb_share, t, None)
+        if n > max(len(stops[left]), len(stops[right])) * s or n > nb:
+            pairs.add((left[0], right[0]))
+
+    return pairs
+
+
+def reference_groups(feed, distance, share, nb_share):
+    """set of frozensets of route_ids grouped, connected by similar routes"""
+
+    parent = {r: r for r in feed.routes.route_id}
+
+    def find(r):
+        while parent[r] != r:
+            r = parent[r]
+        return r
+
+    for left, right in similar_routes(feed, distance, share, nb_share):
+        parent[find(left)] = find(right)
+
+    groups = {}
+    for r in parent:
+        groups.setdefault(find(r), set()).add(r)
+
+    return {frozenset(str(r) for r in g) for g in groups.values()}
+
+
+@pytest.mark.parametrize(
+    "distance,share,nb_share",
+    [
+        (0, 0.65, {0: 10, 1: 10, 2: 10, 3: 3}),
+        (0, 0.65, {0: 10, 1: 10, 2: 10, 3: 10}),
+        (0, 0.65, 5.0),
+        (0, 0.3, 1.0),
+        (200, 0.3, 5.0),
+        (200, 0.5, {3: 2}),
+        (400, 0.9, 1.0),
+        (400, 0.65, 3.0),
+    ],
+)
+@pytest.mark.parametrize("categorical_ids", [False, True])
+def test_set_groupid_as_shared_stops(gtfs_path, distance, share, nb_share, categorical_ids):
+
+    feed = tp.Feed(gtfs_path, crs=2154, categorical_ids=categorical_ids)
+    expected = reference_groups(feed, distance, share, nb_share)
+
+    feed.set_groupid(distance=distance, share=share, nb_share=nb_share)
+    routes = feed.routes.astype({"route_id": str, "group_id": str})
+
+    groups = routes.groupby("group_id").route_id.apply(frozenset)
+    assert set(groups) == expected
+
+    # group_id is a route of the group, group_short_name is its name
+    for group_id, route_ids in groups.items():
+        assert group_id in route_ids
+    names = dict(zip(routes.route_id, routes.route_short_name))
+    np.testing.assert_array_equal(routes.group_short_name, routes.group_id.map(names))
@@ -0,0 +1,71 @@
+"""
+Tests of ids stored as categoricals shared by all files against ids read as strings
+"""
+
+import random
+
+import pandas as pd
+import pytest
+
+import transitpy as tp
+
+tables = ["agency", "routes", "trips", "stop_times", "stops", "calendar_dates"]
+
+
+def assert_same_tables(left, right, tables=tables):
+    # categories of an id column without values, as shape_id, are not typed as strings
+    for t in tables:
+        pd.testing.assert_frame_equal(
+            getattr(left, t).reset_index(drop=True),
+            getattr(right, t).reset_index(drop=True),
+            check_dtype=False,
+            obj=t,
+        )
+
+
+def test_categorical_ids_share_categories(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154, categorical_ids=True)
+
+    assert feed.has_categorical_ids()
+    for left, right, c in [
+        ("stops", "stop_times", "stop_id"),
+        ("trips", "stop_times", "trip_id"),
+        ("routes", "trips", "route_id"),
+        ("trips", "calendar_dates", "service_id"),
+    ]:
+        assert isinstance(getattr(feed, left)[c].dtype, pd.CategoricalDtype)
+        assert getattr(feed, left)[c].dtype == getattr(feed, right)[c].dtype
+
+
+def test_decode_ids_as_raw_ids(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154, categorical_ids=True)
+    feed.decode_ids()
+
+    assert not feed.has_categorical_ids()
+    assert_same_tables(feed, tp.Feed(gtfs_path, crs=2154))
+
+    # encoding again gives the same values
+    feed.encode_ids()
+    assert feed.has_categorical_ids()
+    feed.decode_ids()
+    assert_same_tables(feed, tp.Feed(gtfs_path, crs=2154))
+
+
+@pytest.mark.parametrize("engine", ["pandas", "arrow"])
+def test_normalize_keeps_categorical_ids(gtfs_path, engine):
+
+    random.seed(0)
+    feed = tp.Feed(gtfs_path, crs=2154, engine=engine, categorical_ids=True)
+    feed.normalize()
+
+    random.seed(0)
+    expected = tp.Feed(gtfs_path, crs=2154, engine=engine)
+    expected.normalize()
+
+    assert feed.has_categorical_ids()
+    assert isinstance(feed.stop_times.trip_id.dtype, pd.CategoricalDtype)
+
+    feed.decode_ids()
+    assert_same_tables(feed, expected, tables + ["shapes"])
@@ -0,0 +1,58 @@
+"""
+Tests of lazy feeds, files parsed on access, against feeds loaded at once
+"""
+
+import pandas as pd
+import pytest
+
+import transitpy as tp
+
+tables = ["agency", "routes", "trips", "stop_times", "stops", "calendar_dates"]
+
+
+def test_lazy_feed_parses_files_on_access(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154, lazy=True)
+
+    assert not any(t in vars(feed) for t in tables)
+    assert feed.shapes is None
+
+    trips = feed.trips
+    assert "trips" in vars(feed)
+    assert "stop_times" not in vars(feed)
+
+    # a parsed file is not parsed again
+    assert feed.trips is trips
+
+    with pytest.raises(AttributeError):
+        feed.missing_table
+
+
+@pytest.mark.parametrize("engine", ["pandas", "arrow"])
+def test_lazy_load_as_feed(gtfs_path, engine):
+
+    feed = tp.Feed(gtfs_path, crs=2154, engine=engine, lazy=True)
+    feed.stops
+    feed.load()
+
+    expected = tp.Feed(gtfs_path, crs=2154, engine=engine)
+    for t in tables:
+        pd.testing.assert_frame_equal(getattr(feed, t), getattr(expected, t), obj=t)
+    pd.testing.assert_frame_equal(feed.dropped, expected.dropped)
+
+    # loading steps are applied once
+    feed.load()
+    pd.testing.assert_frame_equal(feed.dropped, expected.dropped)
+
+
+def test_lazy_filter_loads_feed(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154, lazy=True)
+    expected = tp.Feed(gtfs_path, crs=2154)
+
+    res = feed.modal_filter(3)
+
+    for t in tables:
+        pd.testing.assert_frame_equal(
+            getattr(res, t), getattr(expected.modal_filter(3), t), obj=t
+        )
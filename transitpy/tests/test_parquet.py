@@ -0,0 +1,100 @@
+"""
+Tests of parquet feeds and of the normalized feed cache against feeds read from GTFS files
+"""
+
+import os
+import random
+import shutil
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+
+import transitpy as tp
+
+tables = ["agency", "routes", "trips", "stop_times", "stops", "calendar_dates"]
+
+
+def assert_same_feed(left, right, tables=tables):
+    # categories of encoded ids are the ids kept in the feed
+    for t in tables:
+        pd.testing.assert_frame_equal(
+            getattr(left, t).reset_index(drop=True),
+            getattr(right, t).reset_index(drop=True),
+            check_categorical=False,
+            obj=t,
+        )
+    pd.testing.assert_frame_equal(
+        left.dropped.astype(str), right.dropped.astype(str), obj="dropped"
+    )
+
+
+@pytest.mark.parametrize("categorical_ids", [False, True])
+def test_parquet_as_feed(gtfs_path, tmp_path, categorical_ids):
+
+    feed = tp.Feed(gtfs_path, crs=2154, categorical_ids=categorical_ids)
+    path = str(tmp_path / "feed")
+    feed.to_parquet(path)
+
+    res = tp.Feed.from_parquet(path)
+
+    assert res.name == feed.name
+    assert res.projected_crs == feed.projected_crs
+    assert res.has_categorical_ids() == categorical_ids
+    assert isinstance(res.stops, gpd.GeoDataFrame)
+    assert res.stops.crs == feed.stops.crs
+    assert res.shapes is None
+    assert_same_feed(res, feed)
+
+
+def normalized(path, **kwargs):
+    random.seed(0)
+    return tp.normalized_feed(path, **kwargs)
+
+
+def test_normalized_feed_cache(gtfs_path, tmp_path, monkeypatch):
+
+    path = shutil.copytree(gtfs_path, str(tmp_path / "gtfs"))
+    cache_dir = str(tmp_path / "cache")
+
+    feed = normalized(path, cache_dir=cache_dir, crs=2154)
+    assert len(os.listdir(cache_dir)) == 1
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("normalized again")
+
+    # same source and parameters are read from the cache
+    with monkeypatch.context() as m:
+        m.setattr(tp.Feed, "normalize", fail)
+        res = normalized(path, cache_dir=cache_dir, crs=2154)
+    assert_same_feed(res, feed, tables + ["shapes"])
+
+    # other parameters are a new entry
+    normalized(path, cache_dir=cache_dir, crs=2154, group_distance=50)
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_normalized_feed_cache_invalidation(gtfs_path, tmp_path, monkeypatch):
+
+    path = shutil.copytree(gtfs_path, str(tmp_path / "gtfs"))
+    cache_dir = str(tmp_path / "cache")
+    normalized(path, cache_dir=cache_dir, crs=2154)
+
+    # a modified source is normalized again, not read from the previous entry
+    with open(os.path.join(path, "routes.txt")) as f:
+        routes = f.read()
+    with open(os.path.join(path, "routes.txt"), "w") as f:
+        f.write(routes.replace(",L0,", ",M0,"))
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("normalized again")
+
+    with monkeypatch.context() as m:
+        m.setattr(tp.Feed, "normalize", fail)
+        with pytest.raises(RuntimeError):
+            normalized(path, cache_dir=cache_dir, crs=2154)
+
+    res = normalized(path, cache_dir=cache_dir, crs=2154)
+    assert len(os.listdir(cache_dir)) == 2
+    assert "M0" in set(res.routes.route_short_name)
+    assert "L0" not in set(res.routes.route_short_name)
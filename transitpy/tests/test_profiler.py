@@ -0,0 +1,83 @@
+"""
+Tests of normalize step profiles against rows of feed files
+"""
+
+import random
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import transitpy as tp
+from transitpy import utils
+
+
+def test_normalize_profile_rows(gtfs_path):
+
+    random.seed(0)
+    feed = tp.Feed(gtfs_path, crs=2154)
+    records = []
+
+    df = feed.normalize(profile=True, callback=records.append)
+
+    assert list(df.index) == [r["step"] for r in records]
+    assert (df.seconds >= 0).all()
+    assert "peak_memory" in df.columns
+
+    # rows after a step are rows before the next one, rows after the last step are the feed rows
+    files = [c[: -len("_after")] for c in df.columns if c.endswith("_after")]
+    assert "stop_times" in files
+    for f in files:
+        np.testing.assert_array_equal(df[f + "_after"].iloc[:-1], df[f + "_before"].iloc[1:])
+        assert df[f + "_after"].iloc[-1] == len(getattr(feed, f))
+
+
+def test_step_profiler_run(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    n = len(feed.trips)
+
+    with utils.Step_profiler(feed) as profiler:
+        res = profiler.run("head", lambda k: setattr(feed, "trips", feed.trips.head(k)) or k, 5)
+
+    assert res == 5
+    df = profiler.to_frame()
+    assert list(df.index) == ["head"]
+    assert df.loc["head", "trips_before"] == n
+    assert df.loc["head", "trips_after"] == 5
+
+
+@pytest.mark.parametrize("trace_python", [False, True])
+def test_step_profiler_memory(gtfs_path, trace_python):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+
+    with utils.Step_profiler(feed, trace_python=trace_python) as profiler:
+        profiler.run("copy", lambda: np.ones(10**7).sum())
+        assert tracemalloc.is_tracing() == trace_python
+    assert not tracemalloc.is_tracing()
+
+    df = profiler.to_frame()
+    assert "peak_arrow_memory" in df.columns
+    assert ("peak_python_memory" in df.columns) == trace_python
+    if trace_python:
+        assert df.loc["copy", "peak_python_memory"] >= 8 * 10**7
+
+
+def test_step_profiler_lazy_feed(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154, lazy=True)
+    stops = len(feed.stops)
+
+    with utils.Step_profiler(feed) as profiler:
+        profiler.run("load", feed.load)
+        profiler.run("none", lambda: None)
+
+    # pending files are not parsed to count rows before the step
+    df = profiler.to_frame()
+    assert df.loc["load", "stops_before"] == stops
+    assert np.isnan(df.loc["load", "trips_before"])
+    assert "calendar_before" not in df.columns
+    for f in ["trips", "stop_times", "stops", "calendar_dates"]:
+        assert df.loc["load", f + "_after"] == len(getattr(feed, f))
+        assert df.loc["none", f + "_before"] == len(getattr(feed, f))
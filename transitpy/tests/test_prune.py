@@ -0,0 +1,141 @@
+"""
+Regression tests of prune_ids against the previous iterative prune on isin
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import transitpy as tp
+
+tables = ["agency", "routes", "trips", "stop_times", "stops", "calendar_dates"]
+
+
+def reference_sequence_ids(stop_times):
+    """previous sequence ids, a new sequence when trip_id changes or stop_sequence decreases"""
+
+    shifted = stop_times[["stop_sequence", "trip_id"]].shift(1)
+    change = (stop_times.stop_sequence < shifted.stop_sequence) | (
+        stop_times.trip_id != shifted.trip_id
+    )
+    return change.cumsum().to_numpy()
+
+
+def reference_prune(tbl):
+    """previous prune, each key is checked again until no table loses rows"""
+
+    tbl = dict(tbl)
+    tbl["stop_times"] = tbl["stop_times"].assign(
+        sequence_id=reference_sequence_ids(tbl["stop_times"])
+    )
+
+    def lengths():
+        return {k: len(v) for k, v in tbl.items()}
+
+    def prune(unique=None, others=()):
+        if unique is not None:
+            df = tbl[unique[0]]
+            tbl[unique[0]] = df.loc[~df.duplicated(keep=False)]
+
+        cols = list(others) + ([unique] if unique is not None else [])
+        ids = set.intersection(*[set(tbl[f][n].tolist()) for f, n in cols])
+
+        for f, n in cols:
+            df = tbl[f]
+            if f == "stop_times":
+                seq = df.loc[~df[n].isin(ids), "sequence_id"]
+                tbl[f] = df.loc[~df.sequence_id.isin(seq)]
+            else:
+                tbl[f] = df.loc[df[n].isin(ids)]
+
+    previous = None
+    while previous != lengths():
+        previous = lengths()
+
+        st = tbl["stop_times"]
+        tbl["stop_times"] = st.loc[st.groupby("sequence_id").sequence_id.transform("size") > 1]
+
+        prune(("stops", "stop_id"), [("stop_times", "stop_id")])
+        prune(("agency", "agency_id"), [("routes", "agency_id")])
+        prune(("routes", "route_id"), [("trips", "route_id")])
+        prune(None, [("trips", "service_id"), ("calendar_dates", "service_id")])
+        prune(None, [("trips", "trip_id"), ("stop_times", "trip_id")])
+
+    tbl["stop_times"] = tbl["stop_times"].drop(columns="sequence_id")
+
+    return tbl
+
+
+def damaged_feed(path, seed, **kwargs):
+    """feed with random rows removed from each table and duplicated stops"""
+
+    feed = tp.Feed(path, crs=2154, **kwargs)
+    rng = np.random.default_rng(seed)
+    for t, frac in [
+        ("stops", 0.15),
+        ("routes", 0.2),
+        ("trips", 0.1),
+        ("stop_times", 0.05),
+        ("calendar_dates", 0.3),
+    ]:
+        df = getattr(feed, t)
+        setattr(feed, t, df.loc[rng.random(len(df)) > frac])
+    feed.stops = pd.concat([feed.stops, feed.stops.head(2)])
+
+    return feed
+
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("categorical_ids", [False, True])
+def test_prune_ids_as_previous_prune(gtfs_path, seed, categorical_ids):
+
+    feed = damaged_feed(gtfs_path, seed, categorical_ids=categorical_ids)
+    expected = reference_prune({t: getattr(feed, t) for t in tables})
+
+    feed.prune_ids(step_text="test")
+
+    for t in tables:
+        pd.testing.assert_frame_equal(
+            getattr(feed, t).reset_index(drop=True),
+            expected[t].reset_index(drop=True),
+            obj=t,
+        )
+
+
+def test_prune_ids_keeps_valid_feed(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    before = {t: getattr(feed, t).copy() for t in tables}
+
+    feed.prune_ids()
+
+    for t in tables:
+        pd.testing.assert_frame_equal(getattr(feed, t), before[t], obj=t)
+    assert "_code_stop_id" not in feed.stop_times.columns
+
+
+def test_prune_ids_drops_lonely_and_orphan_trips(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+
+    trip_ids = set(feed.trips.trip_id.astype(str))
+    assert "T_lonely" not in trip_ids
+    assert "T_orphan" not in trip_ids
+    assert "S999" not in set(feed.stops.stop_id.astype(str))
+    assert "T_lonely" in set(feed.dropped.id.astype(str))
+
+
+def test_prune_ids_failure_keeps_columns(gtfs_path, monkeypatch):
+
+    feed = damaged_feed(gtfs_path, 0)
+    columns = {t: list(getattr(feed, t).columns) for t in tables}
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("failed")
+
+    monkeypatch.setattr(tp.Feed, "_min_stop_times_length", fail)
+    with pytest.raises(RuntimeError):
+        feed.prune_ids()
+
+    for t in tables:
+        assert list(getattr(feed, t).columns) == columns[t]
@@ -0,0 +1,135 @@
+"""
+Tests of feed loading, the arrow engine, zip files and times parsing against the pandas engine
+"""
+
+import os
+import shutil
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import transitpy as tp
+from transitpy import utils
+from transitpy.readers import GTFS_Source
+
+tables = ["agency", "routes", "trips", "stop_times", "stops", "calendar_dates"]
+
+
+def assert_same_feed(left, right):
+    for t in tables:
+        pd.testing.assert_frame_equal(getattr(left, t), getattr(right, t), obj=t)
+    pd.testing.assert_frame_equal(left.dropped, right.dropped, obj="dropped")
+
+
+def test_arrow_engine_as_pandas(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154, engine="arrow")
+
+    assert_same_feed(feed, tp.Feed(gtfs_path, crs=2154))
+
+
+@pytest.mark.parametrize("zipped", [False, True])
+def test_arrow_header_only_files(gtfs_path, tmp_path, zipped):
+
+    path = shutil.copytree(gtfs_path, str(tmp_path / "gtfs"))
+    for file, header in [
+        ("transfers.txt", "from_stop_id,to_stop_id,transfer_type,min_transfer_time"),
+        ("frequencies.txt", "trip_id,start_time,end_time,headway_secs"),
+    ]:
+        with open(os.path.join(path, file), "w") as f:
+            f.write(header + "\n")
+    if zipped:
+        path = zip_gtfs(path, str(tmp_path / "gtfs.zip"))
+
+    feed = tp.Feed(path, crs=2154, engine="arrow")
+    expected = tp.Feed(path, crs=2154)
+
+    assert_same_feed(feed, expected)
+    for t in ["transfers", "frequencies"]:
+        assert len(getattr(feed, t)) == 0
+        pd.testing.assert_frame_equal(getattr(feed, t), getattr(expected, t), obj=t)
+
+
+def test_unknown_engine(gtfs_path):
+
+    with pytest.raises(ValueError):
+        tp.Feed(gtfs_path, engine="csv")
+
+
+def zip_gtfs(path, zip_path):
+    """zip the files of a GTFS directory in a sub directory of the archive"""
+
+    with zipfile.ZipFile(zip_path, "w") as z:
+        for f in sorted(os.listdir(path)):
+            z.write(os.path.join(path, f), os.path.join("feed", f))
+
+    return zip_path
+
+
+@pytest.mark.parametrize("engine", ["pandas", "arrow"])
+def test_zip_as_directory(gtfs_path, tmp_path, engine):
+
+    path = zip_gtfs(gtfs_path, str(tmp_path / "gtfs.zip"))
+    feed = tp.Feed(path, crs=2154, engine=engine)
+
+    assert feed.name == "gtfs"
+    assert_same_feed(feed, tp.Feed(gtfs_path, crs=2154))
+
+
+def test_gtfs_source_header(gtfs_path, tmp_path):
+
+    path = zip_gtfs(gtfs_path, str(tmp_path / "gtfs.zip"))
+
+    for p in [gtfs_path, path]:
+        with GTFS_Source(p) as source:
+            assert "stops.txt" in source.files
+            assert source.open("shapes.txt") is None
+
+            header, f = source.open_with_header("routes.txt")
+            with f:
+                assert header == [
+                    "route_id", "agency_id", "route_short_name", "route_long_name", "route_type"
+                ]
+                assert f.readline() == b"R0,A1,L0,Long 0,3\n"
+
+
+def reference_seconds(times):
+    """seconds of H:MM:SS strings split one by one, blank strings are missing"""
+
+    res = []
+    for t in times:
+        if pd.isna(t) or t.strip() == "":
+            res.append(pd.NA)
+        else:
+            h, m, s = t.strip().split(":")
+            res.append(int(h) * 3600 + int(m) * 60 + int(s))
+
+    return pd.Series(res, dtype="Int32", name=times.name)
+
+
+def test_gtfs_seconds_as_split_strings():
+
+    times = pd.Series(
+        ["06:00:00", " 7:05:09", "25:10:00", "", None, "100:00:01", "00:00:00"], name="time"
+    )
+
+    pd.testing.assert_series_equal(utils.gtfs_seconds(times), reference_seconds(times))
+
+    with pytest.raises(ValueError):
+        utils.gtfs_seconds(pd.Series(["06:00"]))
+
+
+@pytest.mark.parametrize("engine", ["pandas", "arrow"])
+def test_seconds_time_format(gtfs_path, engine):
+
+    feed = tp.Feed(gtfs_path, crs=2154, engine=engine, time_format="seconds")
+    expected = tp.Feed(gtfs_path, crs=2154)
+
+    for c in ["arrival_time", "departure_time"]:
+        assert str(feed.stop_times[c].dtype) == "Int32"
+        np.testing.assert_array_equal(
+            utils.total_seconds(feed.stop_times[c]).to_numpy(dtype=float, na_value=np.nan),
+            expected.stop_times[c].dt.total_seconds().to_numpy(),
+        )
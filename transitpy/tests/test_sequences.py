@@ -0,0 +1,166 @@
+"""
+Regression tests of Stop_sequences and time interpolation against row by row loops
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import transitpy as tp
+from transitpy import utils
+from transitpy.sequences import Stop_sequences
+
+
+def random_stop_times(seed, n=300):
+    rng = np.random.default_rng(seed)
+    trip_ids = pd.Series(np.sort(rng.choice(["A", "B", "C", "D", "E", "F"], n)))
+    stop_sequence = pd.Series(rng.integers(0, 6, n))
+    return trip_ids, stop_sequence
+
+
+def reference_ids(trip_ids, stop_sequence):
+    """previous sequence ids, a new sequence when trip_id changes or stop_sequence decreases"""
+
+    ids = []
+    for i in range(len(trip_ids)):
+        new = i == 0 or trip_ids[i] != trip_ids[i - 1] or stop_sequence[i] < stop_sequence[i - 1]
+        ids.append((ids[-1] if ids else 0) + int(new))
+    return np.array(ids)
+
+
+def reference_interpolate(trip_ids, values, distances, step=60):
+    """interpolate each trip run row by row"""
+
+    res = np.array(values, dtype=float)
+    trip_ids = np.asarray(trip_ids)
+    starts = [0] + [i for i in range(1, len(res)) if trip_ids[i] != trip_ids[i - 1]]
+
+    for s, e in zip(starts, starts[1:] + [len(res)]):
+        known = [i for i in range(s, e) if not np.isnan(values[i])]
+        if len(known) == 0:
+            continue
+        for i in range(s, e):
+            if not np.isnan(values[i]):
+                continue
+            before = [k for k in known if k < i]
+            after = [k for k in known if k > i]
+            if before and after:
+                p, q = before[-1], after[0]
+                w = (i - p) / (q - p)
+                if distances is not None and distances[q] > distances[p]:
+                    dw = (distances[i] - distances[p]) / (distances[q] - distances[p])
+                    if 0 <= dw <= 1:
+                        w = dw
+                res[i] = values[p] + w * (values[q] - values[p])
+            elif after:
+                res[i] = values[after[0]] - step * (after[0] - i)
+            else:
+                res[i] = values[before[-1]] + step * (i - before[-1])
+
+    return res
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("categorical", [False, True])
+def test_sequences_as_previous_ids(seed, categorical):
+
+    trip_ids, stop_sequence = random_stop_times(seed)
+    runs = Stop_sequences(trip_ids.astype("category") if categorical else trip_ids, stop_sequence)
+    ids = reference_ids(trip_ids, stop_sequence)
+
+    np.testing.assert_array_equal(runs.ids, ids)
+    np.testing.assert_array_equal(runs.counts, np.bincount(ids)[1:])
+    np.testing.assert_array_equal(runs.row_counts(), np.bincount(ids)[ids])
+    np.testing.assert_array_equal(runs.offsets, pd.Series(ids).groupby(ids).cumcount())
+    np.testing.assert_array_equal(
+        runs.trip_reduce(np.maximum, stop_sequence.to_numpy()),
+        stop_sequence.groupby(trip_ids).max().to_numpy(),
+    )
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("with_distances", [False, True])
+def test_interpolate_as_row_loop(seed, with_distances):
+
+    rng = np.random.default_rng(seed)
+    trip_ids, stop_sequence = random_stop_times(seed)
+    values = np.cumsum(rng.integers(30, 200, len(trip_ids))).astype(float)
+    values[rng.random(len(values)) < 0.4] = np.nan
+    distances = None
+    if with_distances:
+        distances = np.cumsum(rng.integers(-50, 500, len(trip_ids))).astype(float)
+
+    runs = Stop_sequences(trip_ids, stop_sequence)
+
+    np.testing.assert_allclose(
+        runs.interpolate(values, distances=distances),
+        reference_interpolate(trip_ids, values, distances),
+    )
+
+
+def test_interpolate_constant_distances():
+
+    trip_ids, stop_sequence = random_stop_times(0)
+    values = np.arange(len(trip_ids), dtype=float) * 60
+    values[1::3] = np.nan
+    distances = np.full(len(values), 300.0)
+
+    runs = Stop_sequences(trip_ids, stop_sequence)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        res = runs.interpolate(values, distances=distances)
+
+    # weights by row position when distances do not increase
+    np.testing.assert_allclose(res, runs.interpolate(values))
+
+
+def test_fill_times_restores_linear_times(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    st = feed.stop_times
+    assert st.arrival_time.isna().any()
+
+    feed.fill_times()
+    st = feed.stop_times
+
+    # fixture times are 120 seconds by stop, distances 300 by stop
+    seconds = utils.total_seconds(st.departure_time).to_numpy()
+    first = pd.Series(seconds).groupby(st.trip_id.to_numpy()).transform("first").to_numpy()
+    np.testing.assert_array_equal(seconds, first + 120 * (st.stop_sequence.to_numpy() - 1))
+    assert st.arrival_time.equals(st.departure_time)
+    assert not (feed.dropped.step == "trips without times").any()
+
+
+def test_fill_times_drops_trips_without_times(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    st = feed.stop_times.copy()
+    st.loc[st.trip_id == "T5", ["arrival_time", "departure_time"]] = None
+    feed.stop_times = st
+
+    feed.fill_times()
+    dropped = feed.dropped
+    dropped = dropped.loc[dropped.step == "trips without times"]
+
+    assert "T5" not in set(feed.trips.trip_id)
+    assert not feed.stop_times.trip_id.isin(["T5"]).any()
+    assert list(dropped.id) == ["T5"]
+    assert list(dropped.type) == ["trip_id"]
+
+
+def test_stop_sequences_follow_stop_times(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    runs = feed.stop_sequences()
+
+    # cached arrays are read only
+    with pytest.raises(ValueError):
+        runs.ids[0] = 10
+
+    feed.stop_times = feed.stop_times.iloc[8:]
+    np.testing.assert_array_equal(
+        feed.stop_sequences().ids,
+        reference_ids(feed.stop_times.trip_id.to_numpy(), feed.stop_times.stop_sequence.to_numpy()),
+    )
@@ -0,0 +1,166 @@
+"""
+Tests of pair and stop index queries against distances computed between all points
+"""
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+import transitpy as tp
+from transitpy import spatial
+
+
+def random_points(seed, n=300):
+    """points in a 2 km square, with a few points at the same place"""
+
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, 2000, (n, 2))
+    xy[-10:] = xy[:10]
+    return gpd.GeoSeries(gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs=2154)
+
+
+def reference_pairs(xy, distance, self_pairs, left=None, right=None):
+    """left, right positions and distances of all pairs in distance, by left then right"""
+
+    left = xy if left is None else left
+    right = xy if right is None else right
+    dist = np.hypot(left[:, None, 0] - right[None, :, 0], left[:, None, 1] - right[None, :, 1])
+    i, j = np.nonzero(dist <= distance)
+    if not self_pairs:
+        mask = i != j
+        i, j = i[mask], j[mask]
+
+    return i, j, dist[i, j]
+
+
+def coordinates(points):
+    return np.column_stack([points.x.to_numpy(), points.y.to_numpy()])
+
+
+def assert_same_pairs(res, expected):
+    for r, e in zip(res[:2], expected[:2]):
+        np.testing.assert_array_equal(r, e)
+    np.testing.assert_allclose(res[2], expected[2])
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("self_pairs", [True, False])
+def test_pair_indices_as_distances(seed, self_pairs):
+
+    points = random_points(seed)
+    res = spatial.pair_indices(points, 150, self_pairs=self_pairs)
+
+    assert_same_pairs(res, reference_pairs(coordinates(points), 150, self_pairs))
+
+
+def test_query_pairs_columns():
+
+    points = gpd.GeoDataFrame(
+        {"name": ["p{0}".format(i) for i in range(300)]}, geometry=random_points(0)
+    )
+    res = spatial.query_pairs(points, 150, self_pairs=False, line=True, columns=["name"])
+
+    left, right, dist = reference_pairs(coordinates(points.geometry), 150, False)
+    np.testing.assert_array_equal(res.name_l, points.name.to_numpy()[left])
+    np.testing.assert_array_equal(res.name_r, points.name.to_numpy()[right])
+    np.testing.assert_allclose(res["distance"], dist)
+    np.testing.assert_allclose(res.geometry.length, dist)
+
+
+@pytest.mark.parametrize("self_pairs", [True, False])
+@pytest.mark.parametrize("with_items", [False, True])
+def test_stop_index_pairs_as_distances(self_pairs, with_items):
+
+    points = random_points(1)
+    index = spatial.Stop_index(np.arange(len(points)), points)
+    xy = coordinates(points)
+
+    items = None
+    if with_items:
+        # several items at some stops, no item at others
+        items = np.random.default_rng(1).integers(0, len(points), 400)
+        xy = xy[items]
+
+    res = index.pairs(150, self_pairs=self_pairs, items=items)
+
+    assert_same_pairs(res, reference_pairs(xy, 150, self_pairs))
+
+
+def test_stop_index_neighbours():
+
+    points = random_points(2)
+    index = spatial.Stop_index(np.arange(len(points)), points)
+
+    left, right, dist = reference_pairs(coordinates(points), 150, True)
+    expected = np.zeros((len(points), len(points)), dtype=bool)
+    expected[left, right] = True
+
+    np.testing.assert_array_equal(index.neighbours(150).toarray(), expected)
+
+
+def test_stop_index_radius_and_nearest():
+
+    points = random_points(3)
+    index = spatial.Stop_index(np.arange(len(points)), points)
+    xy = coordinates(points)
+    coords = np.random.default_rng(3).uniform(0, 2000, (50, 2))
+
+    res = index.radius(coords, 200)
+    assert_same_pairs(res, reference_pairs(xy, 200, True, left=coords))
+
+    # nearest stops by distance, within distance
+    p, s, d = index.nearest(coords, k=3, distance=100)
+    _, _, dist = reference_pairs(xy, np.inf, True, left=coords)
+    dist = dist.reshape(len(coords), -1)
+    for i in range(len(coords)):
+        expected = np.sort(dist[i])[:3]
+        expected = expected[expected <= 100]
+        np.testing.assert_allclose(d[p == i], expected)
+        np.testing.assert_allclose(dist[i, s[p == i]], expected)
+
+
+def test_stop_index_query():
+
+    points = random_points(4)
+    index = spatial.Stop_index(np.arange(len(points)), points)
+    xy = coordinates(points)
+
+    box = index.bbox(500, 500, 1000, 800)
+    inside = (xy[:, 0] >= 500) & (xy[:, 0] <= 1000) & (xy[:, 1] >= 500) & (xy[:, 1] <= 800)
+    np.testing.assert_array_equal(box, np.flatnonzero(inside))
+
+    polygons = [shapely.Point(1000, 1000).buffer(300), shapely.box(0, 0, 400, 400)]
+    geoms, stops = index.query(polygons)
+    for g, polygon in enumerate(polygons):
+        expected = np.flatnonzero(points.intersects(polygon).to_numpy())
+        np.testing.assert_array_equal(np.sort(stops[geoms == g]), expected)
+
+
+def test_feed_stop_index(gtfs_path):
+
+    feed = tp.Feed(gtfs_path, crs=2154)
+    index = feed.stop_index()
+
+    assert feed.stop_index() is index
+    pd.testing.assert_index_equal(index.stop_ids, pd.Index(feed.stops.stop_id))
+    np.testing.assert_array_equal(index.positions(["S3", "missing"]), [3, -1])
+
+    feed.stops = feed.stops.iloc[3:]
+    assert len(feed.stop_index()) == len(feed.stops)
+
+
+@pytest.mark.parametrize("self_pairs", [True, False])
+def test_stop_index_pairs_as_pair_indices(self_pairs, monkeypatch):
+
+    points = random_points(5)
+    index = spatial.Stop_index(np.arange(len(points)), points)
+    expected = spatial.pair_indices(points, 150, self_pairs=self_pairs)
+
+    # pairs are queried from the tree of the index
+    with monkeypatch.context() as m:
+        m.setattr(spatial.sp, "cKDTree", None)
+        res = index.pairs(150, self_pairs=self_pairs)
+
+    assert_same_pairs(res, expected)
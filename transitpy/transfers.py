@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
-from datetime import timedelta
-
+import geopandas as gpd
+import numpy as np
 import pandas as pd
 
 from . import spatial, utils
@@ -54,7 +54,7 @@ def find_transfers(
 
     # filter out of range transfers
     mask1 = (
-        res[pairs_time + source] + timedelta(minutes=max_wait)
+        res[pairs_time + source] + utils.to_time(max_wait * 60, res[pairs_time + source])
         >= res[range_cols[0] + target]
     )
     mask2 = res[pairs_time + source] <= res[range_cols[1] + target]
@@ -82,7 +82,7 @@ def find_transfers(
     ).dropna()
 
     res[wait] = res[trips_time + target] - res[pairs_time + source]
-    res[wait] = res[wait].dt.total_seconds().floordiv(60).astype("Int64")
+    res[wait] = utils.total_seconds(res[wait]).floordiv(60).astype("Int64")
 
     remove_cols = ["_transfer_time", min_transfer, trips_time + target]
 
@@ -102,10 +102,10 @@ def find_transfers(
             right_on=trips_time + "_rev",
             direction=rev_direction,
         )
-        res[rev_wait] = (
+        res[rev_wait] = utils.total_seconds(
             res[trips_time + "_rev"] - res[pairs_time + source] - res[min_transfer]
         ) / 60
-        res[rev_wait] = res[rev_wait].dt.total_seconds().floordiv(60).astype("Int64")
+        res[rev_wait] = res[rev_wait].floordiv(60).astype("Int64")
 
         remove_cols.extend([tripid + "_rev", trips_time + "_rev"])
 
@@ -165,20 +165,11 @@ def make_transfers(
         ]
     ]
 
-    # convert ids to integers to speed calculation and memory use
+    # replace ids by their integer codes to speed calculation and memory use
     # cache values and drop from original dataframe
-    df, trid = utils.integer_id(
-        df,
-        "trip_id",
-        "trip_u",
-        "agency_name",
-    )
-    df, rid = utils.integer_id(
-        df, "route_id", "route_u", "agency_name", keep_cols=["route_short_name"]
-    )
-    df, sid = utils.integer_id(
-        df, "stop_id", "stop_u", "agency_name", keep_cols=["stop_name"]
-    )
+    df, trid = _id_codes(df, "trip_id", "trip_u", keep_cols=["agency_name"])
+    df, rid = _id_codes(df, "route_id", "route_u", keep_cols=["route_short_name"])
+    df, sid = _id_codes(df, "stop_id", "stop_u", keep_cols=["stop_name"])
 
     stops = df.groupby(["stop_u", "route_u", "direction_id"]).agg(
         start=("departure_time", 'min'),
@@ -210,7 +201,7 @@ def make_transfers(
     # add minimum transfer by route_type to stops
     if type(min_transfers) is dict:
         m = pd.Series(data=min_transfers)
-        m = pd.to_timedelta(m, unit="minutes")
+        m = utils.to_time(m * 60, df["arrival_time"])
         stops = pd.merge(
             stops,
             m.to_frame("min_transfer"),
@@ -219,55 +210,69 @@ def make_transfers(
             how="left",
         )
         stops["min_transfer"] = stops["min_transfer"].fillna(
-            (pd.Timedelta(seconds=min(min_transfers.values())))
+            utils.to_time(min(min_transfers.values()), df["arrival_time"])
         )
     else:
-        stops["min_transfer"] = timedelta(minutes=min_transfers)
+        stops["min_transfer"] = utils.to_time(min_transfers * 60, df["arrival_time"])
 
-    # find pairs by maximum distance
+    # find pairs by maximum distance, filter on arrays before adding pair columns
+    # pairs of stops from the feed stop index, expanded to stops by route and direction
     dist = stops["max_distance"].max()
-    pairs = spatial.query_pairs(stops, distance=dist, self_pairs=False)
+    items = feed.stop_index().positions(sid["stop_id"].reindex(stops["stop_u"]))
+    left, right, distance = feed.stop_index().pairs(dist, self_pairs=False, items=items)
 
     # filter maximum distance
-    pairs["max_distance"] = pairs[["max_distance_l", "max_distance_r"]].max(axis=1)
-    
-    pairs = pairs.loc[pairs['distance'] <= pairs['max_distance']]
-
-    # find minimum transfer time depending on route_types and distance and walk_speed
-    pairs["min_transfer"] = pairs[["min_transfer_l", "min_transfer_r"]].max(axis=1)
-    pairs["distance"] = pd.to_timedelta(pairs["distance"] * walk_speed, unit="minutes")
-    pairs["min_transfer"] = pairs[["min_transfer", "distance"]].max(axis=1)
+    max_distance = stops["max_distance"].to_numpy(dtype=float)
+    mask = distance <= np.maximum(max_distance[left], max_distance[right])
 
     # filter pairs on conditions
     if filter_agencies:
-        pairs = pairs.loc[pairs.agency_name_l != pairs.agency_name_r]
+        agency = stops["agency_name"].to_numpy()
+        mask &= agency[left] != agency[right]
 
     if filter_groups:
-        pairs = pairs.loc[pairs.group_id_l != pairs.group_id_r]
+        group = stops["group_id"].to_numpy()
+        mask &= group[left] != group[right]
     else:
-        pairs = pairs.loc[pairs.route_u_l != pairs.route_u_r]
+        route = stops["route_u"].to_numpy()
+        mask &= route[left] != route[right]
 
     # filter start end intervals
-    pairs = pairs.loc[pairs.end_l + timedelta(minutes=max_wait) >= pairs.start_r]
-    pairs = pairs.loc[pairs.start_l - timedelta(minutes=max_wait) <= pairs.end_r]
-
-    pairs = pairs.sort_values("distance", ascending=True)
-
-    pairs = pairs.drop(
+    max_wait_time = max_wait * 60
+    start = utils.total_seconds(stops["start"]).to_numpy(dtype=float, na_value=np.nan)
+    end = utils.total_seconds(stops["end"]).to_numpy(dtype=float, na_value=np.nan)
+    mask &= end[left] + max_wait_time >= start[right]
+    mask &= start[left] - max_wait_time <= end[right]
+
+    # nearest pairs first
+    order = np.flatnonzero(mask)
+    order = order[np.argsort(distance[order], kind="stable")]
+    left, right, distance = left[order], right[order], distance[order]
+
+    pairs = spatial.take_pairs(
+        stops,
+        left,
+        right,
         columns=[
-            "group_id_l",
-            "group_id_r",
-            "agency_name_l",
-            "agency_name_r",
-            "min_transfer_l",
-            "min_transfer_r",
-            "max_distance_l",
-            "max_distance_r",
-            "max_distance",
-            "distance",
-            "route_type_l",
-            "route_type_r",
-        ]
+            "stop_u",
+            "route_u",
+            "direction_id",
+            "start",
+            "end",
+            "geometry",
+            "group_short_name",
+        ],
+    )
+    pairs = gpd.GeoDataFrame(pairs, geometry="geometry_l", crs=stops.crs)
+
+    # find minimum transfer time depending on route_types and distance and walk_speed
+    min_transfer = stops["min_transfer"]
+    walk = utils.to_time(pd.Series(distance * walk_speed * 60), df["arrival_time"])
+    pairs["min_transfer"] = np.maximum(
+        np.maximum(
+            min_transfer.take(left).to_numpy(), min_transfer.take(right).to_numpy()
+        ),
+        walk.astype(min_transfer.dtype).to_numpy(),
     )
 
     if reverse_transfers:
@@ -306,7 +311,6 @@ def make_transfers(
         res, trid.add_suffix("_r"), left_on="trip_u_r", right_index=True, how="left"
     )
 
-    rid = rid.drop(columns=["agency_name"])
     res = pd.merge(
         res, rid.add_suffix("_l"), left_on="route_u_l", right_index=True, how="left"
     )
@@ -314,7 +318,6 @@ def make_transfers(
         res, rid.add_suffix("_r"), left_on="route_u_r", right_index=True, how="left"
     )
 
-    sid = sid.drop(columns=["agency_name"])
     res = pd.merge(
         res, sid.add_suffix("_l"), left_on="stop_u_l", right_index=True, how="left"
     )
@@ -340,4 +343,28 @@ def make_transfers(
     return res
 
 
+def _id_codes(df, id_col, new_col, keep_cols=None):
+    """
+    replace id_col by integer codes in new_col, codes are the shared categorical codes
+    of feed ids if id_col is categorical (see Feed.encode_ids), else factorized values
+
+    returns a tuple of :
+        the DataFrame with id_col replaced by new_col
+        a DataFrame indexed by new_col with id_col and first values of keep_cols by code
+    """
+
+    values = df[id_col]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+
+    ids = pd.DataFrame({id_col: uniques})
+    ids.index = ids.index.rename(new_col)
+    if keep_cols is not None:
+        ids = ids.join(df[keep_cols].groupby(codes).first())
+
+    df = df.drop(columns=id_col)
+    df[new_col] = codes
 
+    return df, ids
@@ -1,18 +1,321 @@
 # -*- coding: utf-8 -*-
 
+import functools
+import hashlib
+import os
 import random
+import threading
+import time
+import tracemalloc
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pandas.api.types import is_timedelta64_dtype
+
+from transitpy.config.gtfs_def import gtfs_all_files
 
 
 def format_timedelta(td):
+    """format timedelta or integer seconds to HH:MM text, days are ignored"""
+
+    if is_timedelta64_dtype(td):
+        df = td.dt.components[["hours", "minutes"]]
+    else:
+        s = day_seconds(td)
+        df = pd.DataFrame({"hours": s // 3600, "minutes": s % 3600 // 60}, index=td.index)
+        df = df.astype(object)
 
-    df = td.dt.components[["hours", "minutes"]]
     df["hours"] = df["hours"].map(str).str.zfill(2)
     df["minutes"] = df["minutes"].map(str).str.zfill(2)
     return df.hours.str.cat(df.minutes, ":")
 
 
+def gtfs_seconds(times):
+    """
+    convert a Series of GTFS time strings H:MM:SS to seconds since service day start,
+    hours may be larger than 24, blank values are NA
+
+    returns an Int32 Series
+    """
+
+    arr = pa.array(times, type=pa.string(), from_pandas=True)
+    arr = pc.utf8_trim_whitespace(arr)
+    valid = pc.fill_null(pc.not_equal(arr, ""), False)
+
+    parts = pc.split_pattern(pc.filter(arr, valid), ":")
+    if pc.all(pc.equal(pc.list_value_length(parts), 3)).as_py() is False:
+        raise ValueError("Invalid GTFS : times must be formatted as HH:MM:SS")
+
+    hms = pc.cast(pc.list_flatten(parts), pa.int32()).to_numpy().reshape(-1, 3)
+
+    seconds = np.zeros(len(arr), dtype="int32")
+    mask = valid.to_numpy(zero_copy_only=False)
+    seconds[mask] = hms[:, 0] * 3600 + hms[:, 1] * 60 + hms[:, 2]
+
+    return pd.Series(
+        pd.arrays.IntegerArray(seconds, ~mask), index=times.index, name=times.name
+    )
+
+
+def to_time(seconds, like):
+    """convert seconds, a scalar or a Series, to the time representation of like Series"""
+
+    if is_timedelta64_dtype(like):
+        return pd.to_timedelta(seconds, unit="s")
+    return np.round(seconds)
+
+
+def total_seconds(times):
+    """return a float Series of seconds from a timedelta or integer seconds Series"""
+
+    if is_timedelta64_dtype(times):
+        return times.dt.total_seconds()
+    return times.astype(float)
+
+
+def day_seconds(times):
+    """return seconds in day of a timedelta or integer seconds Series, days are ignored"""
+
+    if is_timedelta64_dtype(times):
+        return times.dt.seconds
+    return times % 86400
+
+
+def days(times):
+    """return number of days of a timedelta or integer seconds Series"""
+
+    if is_timedelta64_dtype(times):
+        return times.dt.days
+    return times // 86400
+
+
+def requires(*tables):
+    """
+    decorator of feed methods declaring the files they use and may modify (stops, stop_times...),
+    pending files of a lazy feed are parsed together before the method runs,
+    cached data using the files is invalid when the method starts and after it runs
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            self.load_tables(tables)
+            self._modified(tables)
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self._modified(tables)
+
+        wrapper.tables = tables
+        return wrapper
+
+    return decorator
+
+
+def raw_ids(*id_types):
+    """
+    decorator of feed methods creating or rewriting ids of id_types (stop_id, trip_id...),
+    if ids are stored as shared categoricals, columns of id_types are decoded before the
+    method runs and encoded again after, other ids stay encoded
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            encoded = self.has_categorical_ids(id_types)
+            if encoded:
+                self.decode_ids(id_types)
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                if encoded:
+                    self.encode_ids(id_types)
+
+        return wrapper
+
+    return decorator
+
+
+def cached(*names):
+    """
+    decorator of feed methods returning data derived from files or attributes
+    (stops, projected_crs...), results are cached by arguments and reused until one
+    of the names is assigned, modified by a method decorated by requires, or its
+    rows or columns change in place
+
+    values of existing columns modified in place are not detected, call clear_cache,
+    cached DataFrames are returned as copies, numpy arrays of other objects are read only
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            self.load_tables(names)
+            return self._cached_call(func, names, args, kwargs)
+
+        wrapper.tables = names
+        return wrapper
+
+    return decorator
+
+
+def copy_on_write():
+    """
+    True if pandas defers copies of shared data until they are modified,
+    always on with pandas >= 3, set pd.options.mode.copy_on_write = True with pandas 2
+    """
+
+    if int(pd.__version__.split(".")[0]) >= 3:
+        return True
+    return pd.options.mode.copy_on_write is True
+
+
+def _rss():
+    """resident memory of the process in bytes, None if not available (not linux)"""
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class Step_profiler(object):
+    """
+    run feed methods as named steps and record for each step :
+        - seconds : wall time
+        - peak_memory : peak of process resident memory during the step, in bytes,
+                        from the resident memory at step start, NaN if not available
+        - peak_arrow_memory : peak of memory allocated by pyarrow (feed tables buffers)
+                              during the step, in bytes, from the allocation at step start
+        - peak_python_memory : if trace_python, peak of memory allocated by python objects
+                               and numpy arrays, traced by tracemalloc
+        - rows of each feed file before and after the step, files still pending in a
+          lazy feed are not parsed and have no rows
+
+    peaks are sampled every interval seconds in a thread, tracemalloc slows down steps
+    and is only started if trace_python, until exit when used as a context manager
+    callback : optional function called with the record dict of each step
+    """
+
+    def __init__(self, feed, callback=None, interval=0.01, trace_python=False):
+
+        self.feed = feed
+        self.callback = callback
+        self.interval = interval
+        self.trace_python = trace_python
+        self.records = []
+        self._tracing = False
+
+    def __enter__(self):
+        if self.trace_python and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        return self
+
+    def __exit__(self, *args):
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    @staticmethod
+    def _sample(peaks):
+        """update peaks dict with current resident and arrow memory"""
+
+        rss = _rss()
+        if rss is not None:
+            peaks["rss"] = max(peaks["rss"], rss)
+        peaks["arrow"] = max(peaks["arrow"], pa.total_allocated_bytes())
+
+    def _sampler(self, stop, peaks):
+        while not stop.wait(self.interval):
+            self._sample(peaks)
+
+    def run(self, step, func, *args, **kwargs):
+        """run func with args and kwargs as step, return func result"""
+
+        before = self._rows()
+
+        rss = _rss()
+        peaks = {"rss": rss if rss is not None else 0, "arrow": pa.total_allocated_bytes()}
+        memory = dict(peaks)
+        if tracemalloc.is_tracing():
+            python_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sampler, args=(stop, peaks), daemon=True)
+        start = time.perf_counter()
+        sampler.start()
+
+        try:
+            res = func(*args, **kwargs)
+        finally:
+            stop.set()
+            sampler.join()
+
+        seconds = time.perf_counter() - start
+        self._sample(peaks)
+
+        record = {
+            "step": step,
+            "seconds": seconds,
+            "peak_memory": peaks["rss"] - memory["rss"] if rss is not None else np.nan,
+            "peak_arrow_memory": peaks["arrow"] - memory["arrow"],
+        }
+        if tracemalloc.is_tracing():
+            record["peak_python_memory"] = tracemalloc.get_traced_memory()[1] - python_memory
+        record["rows_before"] = before
+        record["rows_after"] = self._rows()
+        self.records.append(record)
+
+        if self.callback is not None:
+            self.callback(record)
+
+        return res
+
+    def _rows(self):
+        """Series of rows of feed files already loaded, by file name without extension"""
+
+        tables = vars(self.feed)
+        pending = tables.get("_pending", {})
+        rows = {}
+        for k in gtfs_all_files().keys():
+            name = k[:-4]
+            if name in pending:
+                continue
+            df = tables.get(name)
+            rows[name] = 0 if df is None else df.shape[0]
+
+        return pd.Series(rows, dtype="int64")
+
+    def to_frame(self):
+        """
+        return a DataFrame of records, indexed by step, with seconds, memory peaks and
+        <file>_before, <file>_after row columns of files with rows
+        """
+
+        memory = ["peak_memory", "peak_arrow_memory", "peak_python_memory"]
+        memory = [c for c in memory if any(c in r for r in self.records)]
+        df = pd.DataFrame(
+            [{k: v for k, v in r.items() if not k.startswith("rows")} for r in self.records],
+            columns=["step", "seconds"] + memory,
+        )
+
+        for k in ["before", "after"]:
+            rows = pd.DataFrame([r["rows_" + k] for r in self.records], index=df.index)
+            rows = rows.loc[:, (rows > 0).any()]
+            df[[c + "_" + k for c in rows.columns]] = rows.to_numpy()
+
+        # before and after columns of a file side by side
+        cols = df.columns[2 + len(memory) :]
+        cols = sorted(cols, key=lambda c: (c.rsplit("_", 1)[0], c.endswith("_after")))
+
+        return df[["step", "seconds"] + memory + cols].set_index("step")
+
+
 def random_color():
     """
     returns a list of n random colors as html color code (GTFS spec)
@@ -20,6 +323,27 @@ def random_color():
     return "#{:06x}".format(random.randint(0, 0xFFFFFF)).upper()
 
 
+def content_hash(path):
+    """sha256 of a zip file or of all files of a directory, read by chunks"""
+
+    h = hashlib.sha256()
+
+    if os.path.isdir(path):
+        files = sorted(os.listdir(path))
+        paths = [os.path.join(path, f) for f in files]
+    else:
+        files = [""]
+        paths = [path]
+
+    for f, p in zip(files, paths):
+        h.update(f.encode("utf-8"))
+        with open(p, "rb") as stream:
+            for chunk in iter(lambda: stream.read(1 << 20), b""):
+                h.update(chunk)
+
+    return h.hexdigest()
+
+
 def integer_id(df, id_col, new_col, unique_col=None, keep_cols=None, dtype="Int64"):
     """
     create unique integer keys for each pair in keys/group_key, add a suffix to key names